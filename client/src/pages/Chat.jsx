@@ -18,8 +18,14 @@ function Chat() {
   const [playingAudioId, setPlayingAudioId] = useState(null);
   const [isProcessingAudio, setIsProcessingAudio] = useState(false);
   const [isCheckingUser, setIsCheckingUser] = useState(true);
+  const [speakReplies, setSpeakReplies] = useState(false);
+  // Word the learner double-clicked, with its translation once looked up
+  const [lookup, setLookup] = useState(null);
   const messagesEndRef = useRef(null);
   const audioRef = useRef(null);
+  // Sentences of a spoken reply, played in order as they arrive
+  const speechQueueRef = useRef([]);
+  const speechAudioRef = useRef(null);
 
   // Get user info on mount
   useEffect(() => {
@@ -80,9 +86,45 @@ function Chat() {
         audioRef.current.pause();
         audioRef.current = null;
       }
+      stopSpeech();
     };
   }, []);
 
+  const playNextSentence = () => {
+    if (speechAudioRef.current) return;
+    const next = speechQueueRef.current.shift();
+    if (!next) return;
+
+    const bytes = Uint8Array.from(atob(next.audio), c => c.charCodeAt(0));
+    const audioUrl = URL.createObjectURL(new Blob([bytes], { type: next.format === 'mp3' ? 'audio/mpeg' : 'audio/wav' }));
+    const audio = new Audio(audioUrl);
+    speechAudioRef.current = audio;
+
+    const done = () => {
+      URL.revokeObjectURL(audioUrl);
+      speechAudioRef.current = null;
+      playNextSentence();
+    };
+    audio.onended = done;
+    audio.onerror = done;
+    audio.play().catch(done);
+  };
+
+  const queueSentence = (sentence) => {
+    // A sentence that failed to synthesize is skipped; the rest still play
+    if (!sentence.audio) return;
+    speechQueueRef.current.push(sentence);
+    playNextSentence();
+  };
+
+  const stopSpeech = () => {
+    speechQueueRef.current = [];
+    if (speechAudioRef.current) {
+      speechAudioRef.current.pause();
+      speechAudioRef.current = null;
+    }
+  };
+
   const detectLanguage = (text) => {
     try {
       const detected = franc(text);
@@ -158,6 +200,46 @@ function Chat() {
     return languages[langCode] || 'English';
   };
 
+  const lookupWord = async (messageId) => {
+    const word = window.getSelection().toString().trim();
+    if (!word || word.length > 60) return;
+    setLookup({ messageId, word });
+    try {
+      const res = await fetch(`http://localhost:5000/lookup?word=${encodeURIComponent(word)}`, {
+        credentials: 'include'
+      });
+      const data = await res.json();
+      setLookup({ messageId, word, result: res.ok ? data : null });
+    } catch (err) {
+      console.error('Lookup error:', err);
+      setLookup({ messageId, word, result: null });
+    }
+  };
+
+  // Grammar feedback is worked out after the reply; poll until its job finishes
+  const showFeedback = async (messageId, jobId) => {
+    for (let attempt = 0; attempt < 10; attempt++) {
+      await new Promise(resolve => setTimeout(resolve, 1000 + attempt * 500));
+      try {
+        const res = await fetch(`http://localhost:5000/jobs/${jobId}`, { credentials: 'include' });
+        if (!res.ok) return;
+        const job = await res.json();
+        if (job.status === 'failed') return;
+        if (job.status === 'done') {
+          if (job.result && !job.result.ok) {
+            setMessages(prev => prev.map(msg =>
+              msg.id === messageId ? { ...msg, feedback: job.result } : msg
+            ));
+          }
+          return;
+        }
+      } catch (err) {
+        console.error('Feedback error:', err);
+        return;
+      }
+    }
+  };
+
   const handleSend = async (text) => {
     if (!text.trim() || isLoading) return;
   
@@ -169,20 +251,73 @@ function Chat() {
     try {
       const res = await fetch('http://localhost:5000/chat', {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        // Lets the server answer a retried or double-sent message only once
+        headers: { 'Content-Type': 'application/json', 'Idempotency-Key': crypto.randomUUID() },
         credentials: 'include',
-        body: JSON.stringify({ message: text })
+        // Spoken replies come back as text deltas plus audio, one sentence at a time
+        body: JSON.stringify(speakReplies
+          ? { message: text, stream: true, speech: true, format: 'mp3' }
+          : { message: text, stream: true })
       });
-  
-      const data = await res.json();
-      
-      // Add bot response
-      const botMessage = {
-        id: Date.now() + 1,
-        text: data.response || "Sorry, I couldn't understand that.",
-        sender: 'bot'
+
+      if (res.status === 429) {
+        const retryAfter = res.headers.get('Retry-After');
+        setMessages(prev => [...prev, {
+          id: Date.now() + 1,
+          text: `You're sending messages quickly. Please wait ${retryAfter || 'a few'} seconds and try again.`,
+          sender: 'bot'
+        }]);
+        return;
+      }
+      if (!res.ok || !res.body) throw new Error('Chat request failed');
+
+      // Show the reply as it streams in
+      const botId = Date.now() + 1;
+      let botText = '';
+      const updateBotMessage = (newText) => {
+        botText = newText;
+        setMessages(prev => {
+          if (prev.some(msg => msg.id === botId)) {
+            return prev.map(msg => msg.id === botId ? { ...msg, text: botText } : msg);
+          }
+          return [...prev, { id: botId, text: botText, sender: 'bot' }];
+        });
       };
-      setMessages(prev => [...prev, botMessage]);
+
+      const reader = res.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        // Server-sent events are separated by a blank line
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+
+        for (const rawEvent of events) {
+          let eventType = 'message';
+          let payload = '';
+          for (const line of rawEvent.split('\n')) {
+            if (line.startsWith('event: ')) eventType = line.slice(7);
+            else if (line.startsWith('data: ')) payload += line.slice(6);
+          }
+          if (!payload) continue;
+          const data = JSON.parse(payload);
+
+          if (eventType === 'error') throw new Error(data.error);
+          if (eventType === 'audio') queueSentence(data);
+          else if (eventType === 'done') {
+            updateBotMessage(data.response || botText);
+            if (data.jobs?.grammar) showFeedback(userMessage.id, data.jobs.grammar);
+          }
+          else if (data.delta) updateBotMessage(botText + data.delta);
+        }
+      }
+
+      if (!botText) updateBotMessage("Sorry, I couldn't understand that.");
   
     } catch (err) {
       console.error('Chat error:', err);
@@ -226,7 +361,7 @@ function Chat() {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         credentials: 'include',
-        body: JSON.stringify({ text, language })
+        body: JSON.stringify({ text, language, format: 'mp3' })
       });
 
       if (!response.ok) throw new Error('TTS failed');
@@ -271,6 +406,7 @@ function Chat() {
       ]);
       setPlayingAudioId(null);
       audioRef.current?.pause();
+      stopSpeech();
       
     } catch (err) {
       console.error('Reset error:', err);
@@ -299,6 +435,17 @@ function Chat() {
           <div className="user-info-bar">
             <span>Learning: {userInfo.background?.target_lang?.toUpperCase()}</span>
             <span>Level: {userInfo.background?.skill_level}</span>
+            <label className="speak-toggle">
+              <input
+                type="checkbox"
+                checked={speakReplies}
+                onChange={e => {
+                  setSpeakReplies(e.target.checked);
+                  if (!e.target.checked) stopSpeech();
+                }}
+              />
+              Speak replies
+            </label>
           </div>
         )}
 
@@ -322,12 +469,31 @@ function Chat() {
                     {playingAudioId === msg.id ? '⏹' : '🔊'}
                   </button>
                 </div>
-                <div className="message-text">{msg.text}</div>
+                <div className="message-text" onDoubleClick={() => lookupWord(msg.id)}>{msg.text}</div>
+                {lookup?.messageId === msg.id && (
+                  <div className="word-lookup" onClick={() => setLookup(null)}>
+                    <strong>{lookup.result?.word || lookup.word}</strong>
+                    {lookup.result === undefined ? ' …' : lookup.result ? (
+                      <>
+                        {lookup.result.pos && <em> {lookup.result.pos}</em>}
+                        {' — '}{lookup.result.translations.join(', ')}
+                      </>
+                    ) : ' — not found'}
+                  </div>
+                )}
+                {msg.feedback && (
+                  <div className="message-feedback">
+                    <span className="feedback-corrected">✏️ {msg.feedback.corrected}</span>
+                    {msg.feedback.explanation && (
+                      <span className="feedback-explanation">{msg.feedback.explanation}</span>
+                    )}
+                  </div>
+                )}
               </div>
             </div>
           ))}
           
-          {isLoading && (
+          {isLoading && messages[messages.length - 1]?.sender !== 'bot' && (
             <div className="message-row bot">
               <div className="message-bubble bot loading">
                 <span>AI is thinking...</span>
@@ -1,19 +1,184 @@
+import { useState, useEffect } from 'react';
 import './Readings.css';
 
+const LANGUAGES = {
+  es: 'Spanish',
+  fr: 'French',
+  de: 'German',
+  it: 'Italian',
+  zh: 'Chinese',
+  en: 'English'
+};
+const LEVELS = ['beginner', 'intermediate', 'advanced'];
+
 function Readings() {
+  const [lang, setLang] = useState('es');
+  const [level, setLevel] = useState('beginner');
+  const [catalog, setCatalog] = useState([]);
+  const [reading, setReading] = useState(null);
+  const [isLoading, setIsLoading] = useState(true);
+  const [error, setError] = useState('');
+
+  // Start from the learner's own language and level when logged in
+  useEffect(() => {
+    const loadUserLevel = async () => {
+      try {
+        const response = await fetch('http://localhost:5000/get_user_info', {
+          credentials: 'include'
+        });
+        const data = await response.json();
+        if (data.logged_in) {
+          setLang(data.background?.target_lang || 'es');
+          setLevel(data.background?.skill_level || 'beginner');
+        }
+      } catch (err) {
+        console.error('Error getting user info:', err);
+      }
+    };
+    loadUserLevel();
+  }, []);
+
+  // The server sends ETags, so the browser revalidates rather than re-downloading
+  useEffect(() => {
+    const loadCatalog = async () => {
+      setIsLoading(true);
+      setError('');
+      setReading(null);
+      try {
+        const response = await fetch(
+          `http://localhost:5000/readings?lang=${lang}&level=${level}`,
+          { credentials: 'include' }
+        );
+        if (!response.ok) {
+          throw new Error(`HTTP ${response.status}`);
+        }
+        const data = await response.json();
+        setCatalog(data.readings);
+      } catch (err) {
+        console.error('Error loading readings:', err);
+        setError('Could not load readings. Please try again later.');
+      } finally {
+        setIsLoading(false);
+      }
+    };
+    loadCatalog();
+  }, [lang, level]);
+
+  const openReading = async (readingId) => {
+    try {
+      const response = await fetch(`http://localhost:5000/readings/${readingId}`, {
+        credentials: 'include'
+      });
+      if (!response.ok) {
+        throw new Error(`HTTP ${response.status}`);
+      }
+      setReading(await response.json());
+      window.scrollTo(0, 0);
+    } catch (err) {
+      console.error('Error loading reading:', err);
+      setError('Could not load this reading.');
+    }
+  };
+
+  const byTopic = catalog.reduce((groups, item) => {
+    (groups[item.topic] = groups[item.topic] || []).push(item);
+    return groups;
+  }, {});
+
+  if (reading) {
+    return (
+      <div className="readings-page">
+        <button className="back-button" onClick={() => setReading(null)}>
+          ← All readings
+        </button>
+        <article className="reading">
+          <h1>{reading.title}</h1>
+          <p className="reading-meta">{reading.topic} · {reading.skill_level}</p>
+          {reading.text.split(/\n+/).map((paragraph, i) => (
+            <p key={i} className="reading-text">{paragraph}</p>
+          ))}
+
+          {reading.glossary.length > 0 && (
+            <section className="reading-section">
+              <h2>Vocabulary</h2>
+              <dl className="glossary">
+                {reading.glossary.map((entry) => (
+                  <div key={entry.term} className="glossary-entry">
+                    <dt>{entry.term}</dt>
+                    <dd>{entry.meaning}</dd>
+                  </div>
+                ))}
+              </dl>
+            </section>
+          )}
+
+          {reading.questions.length > 0 && (
+            <section className="reading-section">
+              <h2>Questions</h2>
+              <ol>
+                {reading.questions.map((question, i) => (
+                  <li key={i}>{question}</li>
+                ))}
+              </ol>
+            </section>
+          )}
+        </article>
+      </div>
+    );
+  }
+
   return (
     <div className="readings-page">
       <h1>Readings</h1>
       <p className="page-intro">
-        This section will contain various reading materials and topics for language learners.
+        Short passages written for your level, with vocabulary and comprehension questions.
       </p>
-      
-      <div className="placeholder-message">
-        <p>📚 Reading content coming soon!</p>
-        <p>Check back later for engaging articles and topics.</p>
+
+      <div className="reading-filters">
+        <select value={lang} onChange={(e) => setLang(e.target.value)}>
+          {Object.entries(LANGUAGES).map(([code, name]) => (
+            <option key={code} value={code}>{name}</option>
+          ))}
+        </select>
+        <select value={level} onChange={(e) => setLevel(e.target.value)}>
+          {LEVELS.map((name) => (
+            <option key={name} value={name}>
+              {name.charAt(0).toUpperCase() + name.slice(1)}
+            </option>
+          ))}
+        </select>
       </div>
+
+      {error && <div className="error-message">{error}</div>}
+
+      {isLoading ? (
+        <p className="page-intro">Loading readings...</p>
+      ) : catalog.length === 0 ? (
+        <div className="placeholder-message">
+          <p>📚 No readings yet for this language and level.</p>
+          <p>Check back later for new passages.</p>
+        </div>
+      ) : (
+        Object.entries(byTopic).map(([topic, items]) => (
+          <section key={topic} className="reading-topic">
+            <h2>{topic.charAt(0).toUpperCase() + topic.slice(1)}</h2>
+            <div className="reading-cards">
+              {items.map((item) => (
+                <button
+                  key={item.reading_id}
+                  className="reading-card"
+                  onClick={() => openReading(item.reading_id)}
+                >
+                  <span className="reading-title">{item.title}</span>
+                  <span className="reading-words">{item.words} words</span>
+                </button>
+              ))}
+            </div>
+          </section>
+        ))
+      )}
     </div>
   );
 }
 
-export default Readings;
\ No newline at end of file
+export default Readings;
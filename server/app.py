@@ -1,27 +1,51 @@
-from flask import Flask, request, jsonify, session, send_file
+from flask import Blueprint, Flask, request, jsonify, session, send_file, Response, stream_with_context, g, after_this_request
 from flask_cors import CORS
-# from flask_session import Session
-from openai import OpenAI
+import base64
 import json
+import math
 import os
 import io
-import tempfile
-import azure.cognitiveservices.speech as speechsdk
+import threading
+import time
+from concurrent.futures import TimeoutError as FutureTimeout
 from bots.base_bot import BaseBot
-from bots.system_prompts import get_system_message
-from bots.intent_bot import IntentBot
+from bots.grammar_bot import GrammarBot
+from bots.dictionary_bot import DictionaryBot
+from bots.intent_router import IntentRouter
+from bots.llm_cache import llm_cache
+from bots.dispatch import Turn, TurnDispatcher
+from bots.context_window import ContextWindow, message_tokens
+from bots.prompt_assembly import prompt_assembler
+from bots.model_policy import model_policy
+from user_store import open_user_store
+from conversation_store import open_conversation_store
+from tts_cache import open_tts_cache
+from readings import SKILL_LEVELS, ReadingCache, open_reading_store
+from vocab import open_vocab_tracker
+from dictionary import open_dictionaries
+from jobs import QueueFull, open_job_queue
+from speech_pool import AUDIO_FORMATS, SynthesisError, create_speech_pool
+from speech_pipeline import SpeechPipeline
+from metrics import metrics
+from shared_state import shared_state
+from request_guard import COALESCE_TIMEOUT, ChatAborted, RateLimited, RequestGuard, TokenBuckets
+from upstream import create_client
+from startup import Lazy, Startup
+from logs import get_logger
 from dotenv import load_dotenv
 
 load_dotenv()
+log = get_logger("app")
 api_key = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=api_key)
-
-app = Flask(__name__)
-app.secret_key = "mateoias"  # Replace with a strong secret key
-app.config["SESSION_COOKIE_HTTPONLY"] = True
-app.config["SESSION_COOKIE_SAMESITE"] = "Lax"
-app.config["PERMANENT_SESSION_LIFETIME"] = 86400 
-CORS(app, supports_credentials=True, origins=["http://localhost:5173", "http://localhost:5174"])
+# When to build the subsystems below: background (default), sync, or off (first use)
+STARTUP_WARMUP = os.getenv('STARTUP_WARMUP', 'background')
+# Check each learner message for mistakes in a background job
+GRAMMAR_FEEDBACK = os.getenv('GRAMMAR_FEEDBACK', '1') == '1'
+# Model calls for words the local dictionaries don't have, per user
+LOOKUP_MODEL_PER_MINUTE = float(os.getenv('LOOKUP_MODEL_PER_MINUTE', '10'))
+LOOKUP_MODEL_BURST = float(os.getenv('LOOKUP_MODEL_BURST', '10'))
+SESSION_LIFETIME = 86400
+CORS_ORIGINS = ["http://localhost:5173", "http://localhost:5174"]
 USER_FILE = 'users.json'
 
 # Azure Speech Configuration
@@ -38,30 +62,138 @@ LANGUAGE_VOICES = {
     'zh': 'zh-CN-XiaoxiaoNeural',
 }
 
-def get_speech_config():
-    """Initialize Azure Speech configuration"""
-    if not AZURE_SPEECH_KEY:
-        return None
-    
-    speech_config = speechsdk.SpeechConfig(
-        subscription=AZURE_SPEECH_KEY,
-        region=AZURE_SPEECH_REGION
-    )
-    return speech_config
+TTS_DEFAULT_FORMAT = os.getenv('TTS_DEFAULT_FORMAT', 'wav')
+TTS_BACKEND = os.getenv('TTS_BACKEND', 'azure')
+
+# Subsystems are built on first use, or by the warm-up create_app() starts,
+# so a worker can answer /ready (and chat-only workers never load speech)
+startup = Startup()
+# Rate limits, coalesced turns and cross-worker locks, per SHARED_STATE
+startup.register(shared_state)
+# Memoized intent and lookup answers, per LLM_CACHE
+startup.register(llm_cache, required=False)
+# Pooled, retrying (and with UPSTREAM_HEDGE=1, hedging) OpenAI client
+client = startup.register(Lazy('openai', lambda: create_client(api_key)))
+user_store = startup.register(Lazy('user_store', lambda: open_user_store(json_path=USER_FILE)))
+# Chat history and user background live server-side; the cookie only holds the session id
+conversation_store = startup.register(
+    Lazy('conversation_store', lambda: open_conversation_store(max_idle=SESSION_LIFETIME))
+)
+# Words each learner has used, from which their skill_level is estimated
+vocab_tracker = startup.register(Lazy('vocab', open_vocab_tracker))
+# Work done after the response: grammar feedback, vocabulary and profile updates
+job_queue = startup.register(Lazy('jobs', lambda: create_job_queue()))
+# Synthesized clips, so replaying a message doesn't call Azure again
+tts_cache = startup.register(Lazy('tts_cache', open_tts_cache), required=False)
+# Graded passages written ahead of time by generate_readings.py
+reading_cache = startup.register(
+    Lazy('readings', lambda: ReadingCache(open_reading_store())), required=False
+)
+# Memory-mapped word lists for /lookup, rebuilt from dictionary/sources when stale
+dictionaries = startup.register(Lazy('dictionary', open_dictionaries), required=False)
+
+def warm_speech_pool(pool):
+    if os.getenv('TTS_POOL_WARMUP', '1') == '1' and speech_configured():
+        pool.warm_up(LANGUAGE_VOICES.values(), TTS_DEFAULT_FORMAT)
+
+# Ready-made synthesizers per voice, so requests don't pay connection setup
+speech_pool = startup.register(
+    Lazy('speech_pool', lambda: create_speech_pool(AZURE_SPEECH_KEY, AZURE_SPEECH_REGION)),
+    required=False, warm=warm_speech_pool
+)
+
+# Keeps the history sent with each chat turn within CONTEXT_TOKEN_BUDGET
+context_window = ContextWindow(client)
+# Picks the conversation/grammar/confused prompt for each turn
+intent_router = IntentRouter()
+# Answers unsure turns speculatively while IntentBot decides (SPECULATIVE_DISPATCH)
+dispatcher = TurnDispatcher(intent_router)
+
+routes = Blueprint('routes', __name__)
+
+# Merges duplicate /chat requests and limits how much of the server one user can take
+request_guard = RequestGuard()
+lookup_buckets = TokenBuckets(LOOKUP_MODEL_PER_MINUTE, LOOKUP_MODEL_BURST, namespace='lookup_rate')
+
+# Synthesizes the sentences of a spoken reply while the rest is still generating
+speech_pipeline = SpeechPipeline()
 
-# Load users
-def load_users():
-    if os.path.exists(USER_FILE):
-        with open(USER_FILE, 'r') as f:
-            return json.load(f)
-    return {}
+def collect_component_stats():
+    """Counters kept by the router and the speech pool, for /metrics"""
+    routing = intent_router.stats.snapshot()
+    for intent, count in routing["by_intent"].items():
+        yield "intent_routed_total", "counter", {"intent": intent}, count
+    yield "intent_fallbacks_total", "counter", {}, routing["fallbacks"]
+    for outcome, count in routing["speculation"].items():
+        yield "intent_speculation_total", "counter", {"outcome": outcome}, count
+    # Scraping shouldn't build the pool in a worker that hasn't spoken yet
+    for event, count in (speech_pool.stats.items() if speech_pool.loaded else ()):
+        yield "tts_pool_events_total", "counter", {"event": event}, count
+    for model in model_policy.tiers.values():
+        yield "model_degraded", "gauge", {"model": model}, int(model_policy.degraded(model))
+    if job_queue.loaded:
+        yield "jobs_pending", "gauge", {}, job_queue.pending()
 
-# Save users
-def save_users(users):
-    with open(USER_FILE, 'w') as f:
-        json.dump(users, f, indent=2)
+metrics.add_collector(collect_component_stats)
+
+@routes.before_app_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@routes.after_app_request
+def record_request_latency(response):
+    start = g.get('request_start')
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        method, status = request.method, response.status_code
+
+        # Streamed responses are timed until their last chunk is sent
+        def observe():
+            metrics.observe('http_request_duration_seconds', time.perf_counter() - start,
+                            route=route, method=method, status=status)
+        response.call_on_close(observe)
+    return response
+
+def start_chat_session(user_id, user_background, personalization=None, sess=None):
+    """Create a server-side conversation for the user and remember its id in the cookie"""
+    sess = session if sess is None else sess
+    old_sid = sess.get('sid')
+    if old_sid:
+        conversation_store.delete(old_sid)
+
+    state = {'user_background': user_background}
+    if personalization:
+        state['personalization'] = personalization
+    sess['sid'] = conversation_store.new_session(user_id, state)
+    return sess['sid']
+
+def get_chat_session_id(sess=None):
+    """Server-side conversation id for the logged-in user, recreated if it has expired.
+
+    `sess` is the Flask session by default; the async server passes the
+    decoded cookie as a plain dict.
+    """
+    sess = session if sess is None else sess
+    sid = sess.get('sid')
+    if sid and conversation_store.exists(sid):
+        return sid
+
+    target_lang = sess.get('target_lang', 'es')
+    user_background = {
+        'native_lang': sess.get('native_lang', 'en'),
+        'target_lang': target_lang,
+        'skill_level': vocab_tracker.skill_level(sess.get('user_id'), target_lang)
+    }
+    return start_chat_session(sess.get('user_id'), user_background, sess=sess)
 
-@app.route('/signup', methods=['POST'])
+def sse_event(payload, event=None):
+    """Format a payload as a server-sent event"""
+    message = f"data: {json.dumps(payload)}\n\n"
+    if event:
+        message = f"event: {event}\n" + message
+    return message
+
+@routes.route('/signup', methods=['POST'])
 def signup():
     data = request.json
     email = data.get('email')
@@ -69,34 +201,30 @@ def signup():
     native_lang = data.get('nativeLang', 'en')  # Get from request
     target_lang = data.get('targetLang', 'es')  # Get from request
 
-    users = load_users()
+    # Create new user with language preferences
+    with metrics.span('user_store.save'):
+        created = user_store.create(email, {
+            'password': password,
+            'native_lang': native_lang,
+            'target_lang': target_lang,
+            'personalization': {}
+        })
 
-    if email in users:
+    if not created:
         return jsonify({'success': False, 'message': 'User already exists'}), 400
-
-    # Create new user with language preferences
-    users[email] = {
-        'password': password,
-        'native_lang': native_lang,
-        'target_lang': target_lang,
-        'personalization': {}
-    }
-    save_users(users)
     
     # Auto-login with their actual language choices
     session['user_id'] = email
     session['username'] = email
     session['native_lang'] = native_lang  # Use actual choice
     session['target_lang'] = target_lang  # Use actual choice
-    session['user_background'] = {
+    start_chat_session(email, {
         'native_lang': native_lang,
         'target_lang': target_lang,
         'skill_level': 'beginner',
         'interests': [],
         'learning_goals': 'conversation practice'
-    }
-    session['current_conversation'] = []
-    session.modified = True
+    })
 
     return jsonify({
         'success': True, 
@@ -104,7 +232,7 @@ def signup():
         'auto_logged_in': True
     })
 
-@app.route('/login', methods=['POST'])
+@routes.route('/login', methods=['POST'])
 def login():
     data = request.get_json()
     username = data.get('username')
@@ -112,12 +240,12 @@ def login():
     native_lang = data.get('nativeLang')
     target_lang = data.get('targetLang')
 
-    # Load users
-    users = load_users()
+    # Load user
+    with metrics.span('user_store.load'):
+        user_data = user_store.get(username)
     
     # Check credentials
-    if username in users and users[username]['password'] == password:
-        user_data = users[username]
+    if user_data and user_data['password'] == password:
         
         # Store user session data
         session['user_id'] = username
@@ -126,34 +254,30 @@ def login():
         session['target_lang'] = target_lang
         
         # Initialize user background
-        session['user_background'] = {
+        user_background = {
             'native_lang': native_lang,
             'target_lang': target_lang,
-            'skill_level': 'beginner',
+            'skill_level': vocab_tracker.skill_level(username, target_lang),
             'interests': ['travel', 'food'],
             'learning_goals': 'conversation practice'
         }
         
         # IMPORTANT: Load personalization from user data if it exists
-        if 'personalization' in user_data and user_data['personalization']:
-            print(f"Loading personalization from file: {user_data['personalization']}")
-            session['user_background']['personalization'] = user_data['personalization']
-            session['personalization'] = user_data['personalization']
+        personalization = user_data.get('personalization')
+        if personalization:
+            user_background['personalization'] = personalization
             
             # Also add the name to user_background root if it exists
-            if 'name' in user_data['personalization']:
-                session['user_background']['name'] = user_data['personalization']['name']
-        else:
-            print("No personalization found in user file")
+            if 'name' in personalization:
+                user_background['name'] = personalization['name']
         
         # Initialize empty conversation
-        session['current_conversation'] = []
-        session.modified = True
+        start_chat_session(username, user_background, personalization)
         
         # Check if user has completed personalization
         has_personalization = user_data.get('personalization', {}).get('completed', False)
         
-        print(f"Login complete - session user_background: {session['user_background']}")
+        log.debug("login", user_id=username, user_background=user_background)
         
         return jsonify({
             'success': True, 
@@ -163,7 +287,7 @@ def login():
     else:
         return jsonify({'success': False, 'message': 'Invalid username or password'}), 400
     
-@app.route('/save_personalization', methods=['POST'])
+@routes.route('/save_personalization', methods=['POST'])
 def save_personalization():
     try:
         data = request.get_json()
@@ -172,45 +296,24 @@ def save_personalization():
         if not user_id:
             return jsonify({'success': False, 'message': 'Not logged in'}), 401
         
-        print(f"Saving personalization for user: {user_id}")  # Debug
-        
-        # Load users
-        users = load_users()
-        
-        # Make sure user exists
-        if user_id not in users:
-            print(f"User {user_id} not found in users file")  # Debug
+        # Save personalization to user data. This stays in the request: /login and
+        # /get_user_info read it back, and success means it is saved.
+        data['completed'] = True
+        with metrics.span('user_store.save'):
+            updated = user_store.update(user_id, {'personalization': data})
+        if updated is None:
+            log.warning("personalization.unknown_user", user_id=user_id)
             return jsonify({'success': False, 'message': 'User not found'}), 404
         
-        # Save personalization to user data
-        users[user_id]['personalization'] = data
-        users[user_id]['personalization']['completed'] = True
-        
-        # Save to file
-        save_users(users)
-        print(f"Saved personalization to file for {user_id}")  # Debug
-        
-        # Also store in session for immediate use
-        session['personalization'] = data
-        session['personalization']['completed'] = True
-        session.modified = True
-        
-        # Update user background for chat bot
-        if 'user_background' not in session:
-            session['user_background'] = {
-                    'native_lang': session.get('native_lang', 'en'),
-                    'target_lang': session.get('target_lang', 'es'),
-                    'skill_level': 'beginner'
-    }
-            
-        session['user_background'].update({
-            'name': data.get('name', ''),
-
-        })
-        session['user_background']['personalization'] = data
-
+        # Also store in the chat session for immediate use
+        sid = get_chat_session_id()
+        conversation_store.update_state(sid, {
+            'user_background': {'name': data.get('name', ''), 'personalization': data},
+            'personalization': data
+        }, merge=('user_background',))
         
-        print("Session updated successfully")  # Debug
+        prompt_assembler.invalidate(user_id)
+        log.debug("personalization.saved", user_id=user_id, personalization=data)
         
         return jsonify({
             'success': True, 
@@ -218,21 +321,22 @@ def save_personalization():
             'data': data
         })
         
-    except Exception as e:
-        print(f"Error saving personalization: {str(e)}")
-        import traceback
-        traceback.print_exc()
+    except Exception:
+        log.exception("personalization.error")
         return jsonify({'success': False, 'message': 'Failed to save'}), 500
-@app.route('/logout', methods=['POST'])
+@routes.route('/logout', methods=['POST'])
 def logout():
     try:
+        sid = session.get('sid')
+        if sid:
+            conversation_store.delete(sid)
         session.clear()
         return jsonify({"message": "Logged out"}), 200
-    except Exception as e:
-        print("Logout failed:", str(e))
+    except Exception:
+        log.exception("logout.error")
         return jsonify({"error": "Logout failed"}), 500
 
-@app.route('/chat', methods=['POST'])
+@routes.route('/chat', methods=['POST'])
 def chat():
     try:
         # Check if user is logged in
@@ -245,180 +349,416 @@ def chat():
         if not user_input:
             return jsonify({"error": "Empty message"}), 400
 
-        # Get current conversation and user background from session
-        conversation = session.get("current_conversation", [])
-        user_background = session.get("user_background", {})
-        
-        # DEBUG: Let's see what we have
-        print(f"\n=== CHAT DEBUG ===")
-        print(f"User ID: {user_id}")
-        print(f"user_background from session: {user_background}")
-        print(f"Has personalization in user_background: {'personalization' in user_background}")
-        print(f"Has personalization in session root: {'personalization' in session}")
-        
-        if 'personalization' not in user_background and 'personalization' in session:
-            print("Copying personalization from session to user_background")
-            user_background['personalization'] = session['personalization']
-            # IMPORTANT: Update the session with the modified user_background
-            session['user_background'] = user_background
-            session.modified = True
-        
-        # DEBUG: Check after copy
-        print(f"user_background after copy: {user_background}")
-        
-        # Add user message to conversation
-        conversation.append({"role": "user", "content": user_input})
+        # Spoken replies stream text and audio together
+        speech = data.get("speech")
+        audio_format = data.get("format", TTS_DEFAULT_FORMAT)
+        if speech and audio_format not in AUDIO_FORMATS:
+            return jsonify({'error': f'Unsupported audio format: {audio_format}'}), 400
+        if speech and not speech_configured():
+            return jsonify({'error': 'Azure Speech not configured'}), 500
 
-        # Create bot with user background for personalization
-        bot = BaseBot(conversation, client, user_background=user_background)
-        
-        # DEBUG: Verify bot received it
-        print(f"Bot's user_background: {bot.user_background}")
+        try:
+            request_guard.limit_rate(user_id)
+        except RateLimited as e:
+            return rate_limited(e)
+
+        # A duplicate (double click, client retry) gets the original's result instead of a second turn
+        idempotency_key = request.headers.get('Idempotency-Key')
+        key = request_guard.key(user_id, user_input, idempotency_key)
+        future, leader = request_guard.join(key)
+        if not leader:
+            return replay_chat(future, stream=bool(speech or data.get("stream")))
+        keep = bool(idempotency_key)
+
+        try:
+            request_guard.acquire(user_id)
+        except RateLimited as e:
+            request_guard.reject(key, e)
+            return rate_limited(e)
+
+        @after_this_request
+        def release_slot(response):
+            # Streamed replies hold their slot until the last chunk is sent
+            response.call_on_close(lambda: request_guard.release(user_id))
+            return response
+
+        try:
+            sid = get_chat_session_id()
+            bot = prepare_chat_turn(sid, user_id, user_input)
+            
+            # Local rules pick the prompt; IntentBot is only asked when they're unsure
+            if speech:
+                voice_name = reply_voice(bot, data.get("language"))
+                return speak_chat(bot, sid, voice_name, audio_format, key, keep)
+            if data.get("stream"):
+                return stream_chat(bot, sid, key, keep)
+
+            bot_response, turn = dispatcher.answer(bot, client)
         
-        # For now, use simple conversation system message
-        # Later we'll add intent detection back
-        system_message = get_system_message("conversation")
-        bot_response = bot.ask_openai(system_message)
+            # Add bot response to conversation
+            jobs = finish_chat_turn(sid, bot, bot_response)
+        except Exception as e:
+            request_guard.reject(key, e)
+            raise
+
+        payload = {"response": bot_response, "usage": turn.bot.prompt_stats, "routing": turn.routing, "jobs": jobs}
+        request_guard.resolve(key, payload, keep)
+        with metrics.span('response.serialize'):
+            return jsonify(payload)
+
+    except Exception:
+        log.exception("chat.error")
+        return jsonify({'error': 'Something went wrong on the server.'}), 500
     
-        # Add bot response to conversation
-        conversation.append({"role": "assistant", "content": bot_response})
-        
-        # Update session
-        session["current_conversation"] = conversation
-        session.modified = True
-        
-        return jsonify({"response": bot_response})
+def rate_limited(error):
+    return jsonify({'error': str(error)}), 429, {'Retry-After': str(error.retry_after)}
 
-    except Exception as e:
-        print("Error during chat:", str(e))
-        import traceback
-        traceback.print_exc()
+def replay_chat(future, stream=False):
+    """Answer a duplicate request with the result of the turn it duplicates"""
+    try:
+        payload = future.result(timeout=COALESCE_TIMEOUT)
+    except FutureTimeout:
+        return jsonify({'error': 'Timed out waiting for the original request'}), 504
+    except RateLimited as e:
+        return rate_limited(e)
+    except Exception:
         return jsonify({'error': 'Something went wrong on the server.'}), 500
+
+    if stream:
+        # The reply is complete, so it is sent as a single 'done' event
+        return Response(sse_event(payload, event='done'), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'Idempotent-Replayed': 'true'})
+    response = jsonify(payload)
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+def prepare_chat_turn(sid, user_id, user_input, llm_client=None):
+    """Record the user's message and build a bot over the conversation that fits the context window.
+
+    Shared by the Flask route and the async server, which passes an AsyncOpenAI client.
+    """
+    # Get current conversation and user background from the conversation store
+    with metrics.span('conversation_store.load'):
+        state = conversation_store.get_state(sid)
+    user_background = state.get("user_background", {})
     
+    if 'personalization' not in user_background and 'personalization' in state:
+        user_background['personalization'] = state['personalization']
+        # IMPORTANT: Update the session with the modified user_background
+        with metrics.span('conversation_store.save'):
+            conversation_store.update_state(sid, {'user_background': {'personalization': state['personalization']}},
+                                            merge=('user_background',))
+    
+    log.debug("chat.turn", user_id=user_id, sid=sid, user_background=user_background)
+    
+    # Add user message to conversation
+    user_message = {"role": "user", "content": user_input}
+    with metrics.span('conversation_store.save'):
+        conversation_store.append(sid, "user", user_input, tokens=message_tokens(user_message))
+
+    # Only the turns not yet folded into the summary are loaded
+    summary = state.get("summary")
+    with metrics.span('conversation_store.load'):
+        turns = conversation_store.turns(sid, after_seq=summary["upto"] if summary else 0)
+    with metrics.span('context.fit'):
+        conversation, summary, context_stats = context_window.fit(turns, summary)
+    if context_stats["summary_refreshed"]:
+        conversation_store.update_state(sid, {"summary": summary})
+
+    # Create bot with user background for personalization
+    bot = BaseBot(conversation, llm_client or client, user_background=user_background,
+                  summary=summary["text"], context_stats=context_stats, user_id=user_id)
+    return bot
+
+def finish_chat_turn(sid, bot, bot_response):
+    """Save the reply and queue the turn's background work; return {kind: job_id} for the client"""
+    assistant_message = {"role": "assistant", "content": bot_response}
+    with metrics.span('conversation_store.save'):
+        conversation_store.append(sid, "assistant", bot_response, tokens=message_tokens(assistant_message))
+
+    user_input = next((m["content"] for m in reversed(bot.messages) if m["role"] == "user"), None)
+    if not bot.user_id or not user_input:
+        return {}
+    payload = {"sid": sid, "user_id": bot.user_id, "text": user_input, "user_background": bot.user_background}
+    kinds = ["vocab", "grammar"] if GRAMMAR_FEEDBACK else ["vocab"]
+    jobs = {}
+    with metrics.span('jobs.submit'):
+        for kind in kinds:
+            try:
+                jobs[kind] = job_queue.submit(kind, payload, user_id=bot.user_id)
+            except QueueFull:
+                # Nothing here is needed for the reply; under backpressure it is skipped
+                log.warning("jobs.shed", kind=kind, user_id=bot.user_id)
+    return jobs
+
+def update_vocabulary(payload):
+    """Job: add the learner's words to their vocabulary and follow the estimated level"""
+    user_background = payload["user_background"]
+    target_lang = user_background.get('target_lang')
+    if not target_lang:
+        return None
+    profile = vocab_tracker.observe(payload["user_id"], target_lang, payload["text"], user_background.get('native_lang'))
+    level = profile and profile['skill_level']
+    if level and level != user_background.get('skill_level'):
+        log.info("vocab.level_changed", user_id=payload["user_id"], old=user_background.get('skill_level'), new=level)
+        # Prompts and model choice read the level from user_background from the next turn on
+        try:
+            conversation_store.update_state(payload["sid"], {'user_background': {'skill_level': level}},
+                                            merge=('user_background',))
+        except KeyError:
+            # The conversation ended before the job ran
+            pass
+    return profile
 
-@app.route('/text-to-speech', methods=['POST'])
+def grammar_feedback(payload):
+    """Job: GrammarBot's corrections of the learner's message"""
+    user_background = payload["user_background"]
+    choice = model_policy.select("feedback", user_background.get('skill_level'))
+    bot = GrammarBot([{"role": "user", "content": payload["text"]}], client, user_background=user_background,
+                     user_id=payload["user_id"], model=choice["model"])
+    return {"text": payload["text"], **bot.get_feedback()}
+
+def create_job_queue():
+    queue = open_job_queue()
+    queue.register("vocab", update_vocabulary)
+    queue.register("grammar", grammar_feedback)
+    queue.start()
+    return queue
+
+def stream_chat(bot, sid, key=None, keep=False):
+    """Relay the bot's reply to the client as server-sent events.
+
+    `key` is the request's coalescing key; duplicates waiting on it get the final payload.
+    """
+    def generate():
+        turn = Turn(bot)
+        try:
+            for delta in dispatcher.stream(bot, client, turn):
+                yield sse_event({"delta": delta})
+
+            bot_response = turn.response
+            jobs = finish_chat_turn(sid, bot, bot_response)
+            payload = {"response": bot_response, "usage": turn.bot.prompt_stats, "routing": turn.routing,
+                       "jobs": jobs}
+            request_guard.resolve(key, payload, keep)
+            yield sse_event(payload, event='done')
+        except Exception as e:
+            request_guard.reject(key, e)
+            log.exception("chat.stream_error")
+            yield sse_event({'error': 'Something went wrong on the server.'}, event='error')
+        finally:
+            # The client went away mid-stream
+            request_guard.reject(key, ChatAborted())
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+def speech_configured():
+    return TTS_BACKEND != 'azure' or bool(AZURE_SPEECH_KEY and AZURE_SPEECH_REGION)
+
+def reply_voice(bot, language=None):
+    """The voice for the learner's target language, unless the client asked for another"""
+    language = language or bot.user_background.get('target_lang', 'en')
+    return LANGUAGE_VOICES.get(language, LANGUAGE_VOICES['en'])
+
+def speak_sentence(text, voice_name, audio_format):
+    """Audio for one sentence of a spoken reply, from the cache when it was spoken before"""
+    cache_key = tts_cache.key(text, voice_name, audio_format)
+    audio_data = tts_cache.get(cache_key)
+    if audio_data is not None:
+        metrics.inc('tts_cache_requests_total', result='hit')
+        return audio_data
+    metrics.inc('tts_cache_requests_total', result='miss')
+    return synthesize_speech(text, voice_name, audio_format, cache_key)
+
+def audio_event(index, sentence, audio_data, error, audio_format):
+    """SSE payload for one synthesized sentence"""
+    if error is not None:
+        log.error("tts.sentence_failed", index=index, error=str(error))
+        return sse_event({"index": index, "text": sentence, "error": "Synthesis failed"}, event='audio')
+    return sse_event({
+        "index": index,
+        "text": sentence,
+        "format": audio_format,
+        "audio": base64.b64encode(audio_data).decode('ascii'),
+    }, event='audio')
+
+def speak_chat(bot, sid, voice_name, audio_format, key=None, keep=False):
+    """Stream the reply as text deltas plus one audio event per sentence, in order"""
+    def synthesize(sentence):
+        return speak_sentence(sentence, voice_name, audio_format)
+
+    def generate():
+        turn = Turn(bot)
+        sentences = 0
+        try:
+            for event in speech_pipeline.run(dispatcher.stream(bot, client, turn), synthesize):
+                if event[0] == 'delta':
+                    yield sse_event({"delta": event[1]})
+                else:
+                    sentences += 1
+                    yield audio_event(*event[1:], audio_format)
+
+            bot_response = turn.response
+            jobs = finish_chat_turn(sid, bot, bot_response)
+            payload = {"response": bot_response, "usage": turn.bot.prompt_stats, "routing": turn.routing,
+                       "sentences": sentences, "jobs": jobs}
+            request_guard.resolve(key, payload, keep)
+            yield sse_event(payload, event='done')
+        except Exception as e:
+            request_guard.reject(key, e)
+            log.exception("chat.speech_error")
+            yield sse_event({'error': 'Something went wrong on the server.'}, event='error')
+        finally:
+            request_guard.reject(key, ChatAborted())
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@routes.route('/text-to-speech', methods=['POST'])
 def text_to_speech():
     """Convert text to speech using Azure Speech Services"""
     try:
-        print("=== TTS Request Started ===")
         data = request.get_json()
         text = data.get('text', '')
         language = data.get('language', 'en')
-        
-        print(f"Text: {text[:50]}...")
-        print(f"Language: {language}")
+        audio_format = data.get('format', TTS_DEFAULT_FORMAT)
+        stream = data.get('stream', False)
         
         if not text:
-            print("Error: No text provided")
             return jsonify({'error': 'No text provided'}), 400
+
+        if audio_format not in AUDIO_FORMATS:
+            return jsonify({'error': f'Unsupported audio format: {audio_format}'}), 400
+        mimetype = AUDIO_FORMATS[audio_format][1]
+
+        # Get appropriate voice for language
+        voice_name = LANGUAGE_VOICES.get(language, LANGUAGE_VOICES['en'])
+
+        # Replays are served straight from the cache
+        cache_key = tts_cache.key(text, voice_name, audio_format)
+        audio_data = tts_cache.get(cache_key)
+        if audio_data is not None:
+            metrics.inc('tts_cache_requests_total', result='hit')
+            response = send_audio(audio_data, audio_format)
+            response.headers['X-TTS-Cache'] = 'hit'
+            return response
             
         # Check Azure configuration
-        if not AZURE_SPEECH_KEY:
-            print("Error: AZURE_SPEECH_KEY not set")
-            return jsonify({'error': 'Azure Speech not configured - missing API key'}), 500
-            
-        if not AZURE_SPEECH_REGION:
-            print("Error: AZURE_SPEECH_REGION not set")
-            return jsonify({'error': 'Azure Speech not configured - missing region'}), 500
-            
-        print(f"Azure Speech Key: {AZURE_SPEECH_KEY[:10]}... (truncated)")
-        print(f"Azure Speech Region: {AZURE_SPEECH_REGION}")
-        
-        # Get Azure Speech configuration
-        try:
-            speech_config = speechsdk.SpeechConfig(
-                subscription=AZURE_SPEECH_KEY,
-                region=AZURE_SPEECH_REGION
-            )
-            print("Speech config created successfully")
-        except Exception as e:
-            print(f"Error creating speech config: {e}")
-            return jsonify({'error': f'Failed to create speech config: {str(e)}'}), 500
+        if TTS_BACKEND == 'azure':
+            if not AZURE_SPEECH_KEY:
+                log.error("tts.not_configured", missing="AZURE_SPEECH_KEY")
+                return jsonify({'error': 'Azure Speech not configured - missing API key'}), 500
+                
+            if not AZURE_SPEECH_REGION:
+                log.error("tts.not_configured", missing="AZURE_SPEECH_REGION")
+                return jsonify({'error': 'Azure Speech not configured - missing region'}), 500
             
-        # Get appropriate voice for language
-        voice_name = LANGUAGE_VOICES.get(language, LANGUAGE_VOICES['en'])
-        speech_config.speech_synthesis_voice_name = voice_name
-        print(f"Using voice: {voice_name}")
+        metrics.inc('tts_cache_requests_total', result='miss')
+        log.debug("tts.synthesize", voice=voice_name, format=audio_format, chars=len(text))
         
-        # Use a simpler approach - synthesize to WAV format
         try:
-            synthesizer = speechsdk.SpeechSynthesizer(speech_config=speech_config)
-            print("Synthesizer created, starting synthesis...")
-            
-            result = synthesizer.speak_text_async(text).get()
-            print(f"Synthesis result reason: {result.reason}")
-            
-            if result.reason == speechsdk.ResultReason.SynthesizingAudioCompleted:
-                print("Synthesis completed successfully")
-                audio_data = result.audio_data
-                
-                # Create temporary file
-                import tempfile
-                temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.wav')
-                temp_file.write(audio_data)
-                temp_file.close()
-                
-                print(f"Audio file created: {temp_file.name}, size: {len(audio_data)} bytes")
-                
-                # Return audio file
-                return send_file(
-                    temp_file.name,
-                    mimetype='audio/wav',
-                    as_attachment=False,
-                    download_name='speech.wav'
+            if stream:
+                audio_stream = stream_speech(text, voice_name, audio_format, cache_key)
+                # Pull the first chunk here so a failed synthesis still gets a JSON error
+                first_chunk = next(audio_stream, b'')
+
+                def generate():
+                    yield first_chunk
+                    yield from audio_stream
+
+                return Response(
+                    stream_with_context(generate()),
+                    mimetype=mimetype,
+                    headers={'X-TTS-Cache': 'miss'}
                 )
-            elif result.reason == speechsdk.ResultReason.Canceled:
-                cancellation_details = result.cancellation_details
-                print(f"Speech synthesis canceled: {cancellation_details.reason}")
-                if cancellation_details.reason == speechsdk.CancellationReason.Error:
-                    print(f"Error details: {cancellation_details.error_details}")
-                    return jsonify({
-                        'error': f'Speech synthesis failed: {cancellation_details.error_details}'
-                    }), 500
-                else:
-                    return jsonify({
-                        'error': f'Speech synthesis canceled: {cancellation_details.reason}'
-                    }), 500
-            else:
-                print(f"Unexpected result reason: {result.reason}")
-                return jsonify({
-                    'error': f'Unexpected synthesis result: {result.reason}'
-                }), 500
+            
+            audio_data = synthesize_speech(text, voice_name, audio_format, cache_key)
+
+            # Serve the audio from memory
+            response = send_audio(audio_data, audio_format)
+            response.headers['X-TTS-Cache'] = 'miss'
+            return response
+
+        except SynthesisError as e:
+            log.error("tts.failed", voice=voice_name, error=str(e))
+            return jsonify({'error': str(e)}), 500
                 
         except Exception as e:
-            print(f"Error during synthesis: {e}")
-            import traceback
-            traceback.print_exc()
+            log.exception("tts.synthesis_error", voice=voice_name)
             return jsonify({'error': f'Synthesis failed: {str(e)}'}), 500
             
     except Exception as e:
-        print(f"General error in text-to-speech: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("tts.error")
         return jsonify({'error': f'TTS service error: {str(e)}'}), 500
+
+def send_audio(audio_data, audio_format):
+    _, mimetype, download_name = AUDIO_FORMATS[audio_format]
+    return send_file(
+        io.BytesIO(audio_data),
+        mimetype=mimetype,
+        as_attachment=False,
+        download_name=download_name
+    )
+
+def synthesize_speech(text, voice_name, audio_format, cache_key):
+    """Synthesize a whole clip on a pooled synthesizer and cache it"""
+    with metrics.span('tts.synthesize', backend=TTS_BACKEND):
+        with speech_pool.checkout(voice_name, audio_format) as synthesizer:
+            audio_data = synthesizer.synthesize(text)
+    tts_cache.put(cache_key, audio_data)
+    return audio_data
+
+def stream_speech(text, voice_name, audio_format, cache_key):
+    """Yield audio chunks as a pooled synthesizer produces them, caching the clip if it completes"""
+    chunks = []
+    with metrics.span('tts.stream', backend=TTS_BACKEND):
+        with speech_pool.checkout(voice_name, audio_format) as synthesizer:
+            for chunk in synthesizer.stream(text):
+                chunks.append(chunk)
+                yield chunk
+    tts_cache.put(cache_key, b''.join(chunks))
     
-@app.route('/reset_chat', methods=['POST'])
+@routes.route('/intent_stats', methods=['GET'])
+def intent_stats():
+    """How turns have been routed: fallback rate to IntentBot and routing latency"""
+    return jsonify(intent_router.stats.snapshot())
+
+@routes.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Latency histograms, token usage and component counters in Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@routes.route('/reset_chat', methods=['POST'])
 def reset_chat():
     """Reset current conversation but keep user background"""
-    session['current_conversation'] = []
-    session.modified = True
+    if session.get('user_id'):
+        sid = get_chat_session_id()
+        conversation_store.reset(sid)
+        conversation_store.update_state(sid, {'summary': None})
     return jsonify({'success': True, 'message': 'Chat history cleared.'})
 
-@app.route('/get_user_info', methods=['GET'])
+@routes.route('/get_user_info', methods=['GET'])
 def get_user_info():
-    # Debug logging
-    print("Session contents:", dict(session))
-    
     # Check both username and user_id for compatibility
     user_id = session.get('username') or session.get('user_id')
     
     if not user_id:
         return jsonify({'logged_in': False})
+
+    sid = get_chat_session_id()
+    state = conversation_store.get_state(sid)
     
-    # Load user data from file
-    users = load_users()
-    user_data = users.get(user_id, {})
-    personalization = user_data.get('personalization', session.get('personalization', {}))
+    # Load user data from the store
+    with metrics.span('user_store.load'):
+        user_data = user_store.get(user_id) or {}
+    personalization = user_data.get('personalization', state.get('personalization', {}))
 
     response_data = {
         'logged_in': True,
@@ -426,29 +766,176 @@ def get_user_info():
         'background': {
             'native_lang': user_data.get('native_lang', session.get('native_lang', 'en')),
             'target_lang': user_data.get('target_lang', session.get('target_lang', 'es')),
-            'skill_level': session.get('skill_level', 'beginner')
+            'skill_level': state.get('user_background', {}).get('skill_level', 'beginner')
         },
         'personalization': personalization,
-        'conversation_length': len(session.get('current_conversation', []))
+        'conversation_length': conversation_store.count(sid)
     }
     
-    print(f"Returning user info: {response_data}")
+    log.debug("user_info", user_id=user_id, conversation_length=response_data['conversation_length'])
     return jsonify(response_data)
 
 
-@app.route('/get_personalization', methods=['GET'])
+@routes.route('/get_personalization', methods=['GET'])
 def get_personalization():
     user_id = session.get('user_id')
     if not user_id:
         return jsonify({'logged_in': False}), 401
     
-    # For now, return from session. Later this will come from Neo4j
-    personalization = session.get('personalization', {})
+    # For now, return from the chat session. Later this will come from Neo4j
+    personalization = conversation_store.get_state(get_chat_session_id()).get('personalization', {})
     
     return jsonify({
         'success': True,
         'personalization': personalization
     })
 
+def cached_json(body, etag, kind):
+    """A pre-encoded JSON body with its ETag; 304 if the client has this version"""
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    # Stored by the browser, but revalidated on each use so a new catalog shows up
+    response.headers['Cache-Control'] = 'no-cache'
+    response.make_conditional(request)
+    result = 'not_modified' if response.status_code == 304 else 'ok'
+    metrics.inc('readings_requests_total', kind=kind, result=result)
+    return response
+
+@routes.route('/readings', methods=['GET'])
+def readings_catalog():
+    """Passages for ?lang= (default the learner's target language) and ?level="""
+    target_lang = request.args.get('lang') or session.get('target_lang', 'es')
+    skill_level = request.args.get('level', 'beginner')
+    if skill_level not in SKILL_LEVELS:
+        return jsonify({'error': f'level must be one of {", ".join(SKILL_LEVELS)}'}), 400
+    body, etag = reading_cache.catalog(target_lang, skill_level)
+    response = cached_json(body, etag, 'catalog')
+    # The default language comes from the session
+    response.vary.add('Cookie')
+    return response
+
+@routes.route('/readings/<reading_id>', methods=['GET'])
+def reading(reading_id):
+    cached = reading_cache.reading(reading_id)
+    if cached is None:
+        metrics.inc('readings_requests_total', kind='reading', result='missing')
+        return jsonify({'error': 'Reading not found'}), 404
+    return cached_json(*cached, 'reading')
+
+def lookup_languages():
+    """(from, to) for a lookup: ?from= and ?to=, or the learner's target and native languages"""
+    source_lang = request.args.get('from') or session.get('target_lang', 'es')
+    target_lang = request.args.get('to') or session.get('native_lang', 'en')
+    if source_lang not in LANGUAGE_VOICES or target_lang not in LANGUAGE_VOICES or source_lang == target_lang:
+        return None
+    return source_lang, target_lang
+
+@routes.route('/lookup', methods=['GET'])
+def lookup():
+    """Translate ?word=, from the local dictionary or, for logged-in users, the model"""
+    word = (request.args.get('word') or '').strip()
+    languages = lookup_languages()
+    if not word or len(word) > 60 or languages is None:
+        return jsonify({'error': 'word (at most 60 characters) and two different languages are required'}), 400
+    source_lang, target_lang = languages
+
+    with metrics.span('dictionary.lookup'):
+        entry = dictionaries.lookup(word, source_lang, target_lang)
+    source = 'dictionary'
+    user_id = session.get('user_id')
+    if entry is None and user_id:
+        def admit():
+            wait = lookup_buckets.take(user_id)
+            if wait:
+                metrics.inc('dictionary_lookups_total', source='rate_limited')
+                raise RateLimited('Too many lookups, slow down', math.ceil(wait))
+
+        # Misses go to the model once; llm_cache keeps the answer, and only
+        # uncached calls count against the user's lookup rate
+        try:
+            with metrics.span('dictionary.model'):
+                entry = DictionaryBot([], client).define(word, source_lang, target_lang, admit=admit)
+        except RateLimited as e:
+            return rate_limited(e)
+        except Exception:
+            log.exception("lookup.error", word=word, source_lang=source_lang, target_lang=target_lang)
+            return jsonify({'error': 'Lookup failed'}), 502
+        source = 'model'
+    if not entry or not entry['translations']:
+        metrics.inc('dictionary_lookups_total', source='missing')
+        return jsonify({'error': 'Word not found', 'word': word}), 404
+
+    metrics.inc('dictionary_lookups_total', source=source)
+    response = jsonify(dict(entry, source=source, **{'from': source_lang, 'to': target_lang}))
+    response.headers['Cache-Control'] = 'private, max-age=86400'
+    # The default languages come from the session
+    response.vary.add('Cookie')
+    return response
+
+@routes.route('/lookup/suggest', methods=['GET'])
+def lookup_suggest():
+    """Dictionary words starting with ?prefix=, for autocomplete"""
+    prefix = (request.args.get('prefix') or '').strip()
+    languages = lookup_languages()
+    if not prefix or languages is None:
+        return jsonify({'error': 'prefix and two different languages are required'}), 400
+    limit = min(request.args.get('limit', 10, type=int), 50)
+    return jsonify({'words': dictionaries.complete(prefix, *languages, limit=limit)})
+
+@routes.route('/jobs', methods=['GET'])
+def list_jobs():
+    """The logged-in user's recent background jobs, newest first"""
+    user_id = session.get('user_id') or session.get('username')
+    if not user_id:
+        return jsonify({'error': 'Not logged in'}), 401
+    limit = min(request.args.get('limit', 20, type=int), 100)
+    return jsonify({'jobs': job_queue.for_user(user_id, kind=request.args.get('kind'), limit=limit)})
+
+@routes.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """One job's status and, once done, its result"""
+    user_id = session.get('user_id') or session.get('username')
+    if not user_id:
+        return jsonify({'error': 'Not logged in'}), 401
+    job = job_queue.get(job_id, user_id=user_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@routes.route('/ready', methods=['GET'])
+def ready():
+    """200 once the subsystems a chat turn needs are loaded, 503 until then"""
+    status = startup.status()
+    return jsonify(status), 200 if status['ready'] else 503
+
+
+def create_app(warm_up=None):
+    """The Flask app. `warm_up` (default STARTUP_WARMUP) says when subsystems load:
+
+    - background: on a thread, so the worker can answer /ready (503) at once
+    - sync: required ones before this returns, the rest on a thread
+    - off: on first use; /ready is 200 straight away
+    """
+    app = Flask(__name__)
+    app.secret_key = "mateoias"  # Replace with a strong secret key
+    app.config["SESSION_COOKIE_HTTPONLY"] = True
+    app.config["SESSION_COOKIE_SAMESITE"] = "Lax"
+    app.config["PERMANENT_SESSION_LIFETIME"] = SESSION_LIFETIME
+    CORS(app, supports_credentials=True, origins=CORS_ORIGINS, expose_headers=["Retry-After"])
+    app.register_blueprint(routes)
+
+    mode = warm_up or STARTUP_WARMUP
+    if mode == 'sync':
+        startup.warm_up(wait_for_optional=False)
+    elif mode == 'background':
+        threading.Thread(target=startup.warm_up, daemon=True, name='warm-up').start()
+    elif mode == 'off':
+        startup.mark_ready()
+    else:
+        raise ValueError(f"Unknown STARTUP_WARMUP mode: {mode}")
+    return app
+
+app = create_app()
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,477 @@
+#!/usr/bin/env python3
+"""Async production server.
+
+`python app.py` runs Flask's debug server, where every /chat or
+/text-to-speech request holds a thread for the whole OpenAI or Azure call.
+This module serves those two routes with async handlers instead: chat uses
+AsyncOpenAI, and speech synthesis (the Azure SDK is blocking) runs on a
+bounded thread pool. A single process can then hold hundreds of
+conversations in flight. Every other route is passed through to the Flask
+app unchanged, with the same session cookie.
+
+    python asgi.py                       # HOST, PORT, WEB_CONCURRENCY
+    uvicorn asgi:application --workers 4
+"""
+import asyncio
+import json
+import os
+import time
+from http.cookies import SimpleCookie
+
+import anyio
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from itsdangerous import BadSignature
+from werkzeug.http import dump_cookie
+
+import app as flask_module
+from app import app as flask_app
+from bots.dispatch import Turn
+from logs import get_logger
+from metrics import metrics
+from request_guard import COALESCE_TIMEOUT, ChatAborted, RateLimited
+from speech_pool import AUDIO_FORMATS, SynthesisError
+from startup import Lazy
+from upstream import create_async_client
+
+log = get_logger("asgi")
+# Built on first use like the Flask app's client; cheap once that one has loaded the SDK
+async_client = flask_module.startup.register(
+    Lazy('openai_async', lambda: create_async_client(flask_module.api_key)), required=False
+)
+
+
+class FlaskInstance(WsgiToAsgiInstance):
+    """One pass-through request to the Flask app.
+
+    asgiref runs WSGI apps on a single shared thread, which fails with
+    "would deadlock" as soon as two requests overlap; Flask is thread-safe,
+    so requests run on the thread pool instead. The response iterable is
+    also closed afterwards, as WSGI requires, so Flask's teardown and
+    call_on_close hooks run.
+    """
+
+    @sync_to_async(thread_sensitive=False)
+    def run_wsgi_app(self, body):
+        environ = self.build_environ(self.scope, body)
+        response = self.wsgi_application(environ, self.start_response)
+        try:
+            for output in response:
+                if not self.response_started:
+                    self.response_started = True
+                    self.sync_send(self.response_start)
+                self.sync_send({"type": "http.response.body", "body": output, "more_body": True})
+        finally:
+            if hasattr(response, "close"):
+                response.close()
+        if not self.response_started:
+            self.response_started = True
+            self.sync_send(self.response_start)
+        self.sync_send({"type": "http.response.body"})
+
+
+class FlaskToAsgi(WsgiToAsgi):
+    async def __call__(self, scope, receive, send):
+        await FlaskInstance(self.wsgi_application)(scope, receive, send)
+
+
+flask_asgi = FlaskToAsgi(flask_app)
+
+# Blocking speech synthesis calls allowed at once
+TTS_THREADS = int(os.getenv('ASYNC_TTS_THREADS', '16'))
+_tts_limiter = None
+
+
+def get_tts_limiter():
+    # Capacity limiters have to be created inside the event loop
+    global _tts_limiter
+    if _tts_limiter is None:
+        _tts_limiter = anyio.CapacityLimiter(TTS_THREADS)
+    return _tts_limiter
+
+
+# --- Minimal request/response helpers ---
+
+def get_header(scope, name):
+    name = name.lower().encode('latin-1')
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+
+async def read_json(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    return json.loads(body) if body else {}
+
+
+def cors_headers(scope):
+    """The headers Flask-CORS would add for an allowed origin"""
+    origin = get_header(scope, 'origin')
+    if origin not in flask_module.CORS_ORIGINS:
+        return []
+    return [
+        (b'access-control-allow-origin', origin.encode('latin-1')),
+        (b'access-control-allow-credentials', b'true'),
+        (b'access-control-expose-headers', b'Retry-After'),
+        (b'vary', b'Origin'),
+    ]
+
+
+def load_session(scope):
+    """Decode Flask's signed session cookie into a plain dict"""
+    cookies = SimpleCookie(get_header(scope, 'cookie') or '')
+    morsel = cookies.get(flask_app.config['SESSION_COOKIE_NAME'])
+    if morsel is None:
+        return {}
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    max_age = int(flask_app.permanent_session_lifetime.total_seconds())
+    try:
+        return serializer.loads(morsel.value, max_age=max_age)
+    except BadSignature:
+        return {}
+
+
+def session_cookie_header(session):
+    """Set-Cookie header carrying an updated session, signed the way Flask signs it"""
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    cookie = dump_cookie(
+        flask_app.config['SESSION_COOKIE_NAME'],
+        serializer.dumps(dict(session)),
+        path=flask_app.config['SESSION_COOKIE_PATH'] or '/',
+        httponly=flask_app.config['SESSION_COOKIE_HTTPONLY'],
+        samesite=flask_app.config['SESSION_COOKIE_SAMESITE'],
+    )
+    return (b'set-cookie', cookie.encode('latin-1'))
+
+
+async def send_response(send, status, body, content_type, headers=()):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type.encode('latin-1'))] + list(headers),
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_json(send, payload, status=200, headers=()):
+    with metrics.span('response.serialize'):
+        body = json.dumps(payload).encode('utf-8')
+    await send_response(send, status, body, 'application/json', headers)
+
+
+async def start_stream(send, content_type, headers=()):
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', content_type.encode('latin-1'))] + list(headers),
+    })
+
+
+async def send_chunk(send, body, more_body=True):
+    await send({'type': 'http.response.body', 'body': body, 'more_body': more_body})
+
+
+# --- Routes ---
+
+async def chat(scope, receive, send):
+    headers = cors_headers(scope)
+    try:
+        session = load_session(scope)
+        user_id = session.get('user_id')
+        if not user_id:
+            return await send_json(send, {'error': 'Not logged in'}, 401, headers)
+
+        data = await read_json(receive)
+        user_input = data.get("message")
+        if not user_input:
+            return await send_json(send, {"error": "Empty message"}, 400, headers)
+
+        speech = data.get("speech")
+        audio_format = data.get("format", flask_module.TTS_DEFAULT_FORMAT)
+        if speech and audio_format not in AUDIO_FORMATS:
+            return await send_json(send, {'error': f'Unsupported audio format: {audio_format}'}, 400, headers)
+        if speech and not flask_module.speech_configured():
+            return await send_json(send, {'error': 'Azure Speech not configured'}, 500, headers)
+
+        request_guard = flask_module.request_guard
+        try:
+            request_guard.limit_rate(user_id)
+        except RateLimited as e:
+            return await send_rate_limited(send, e, headers)
+
+        idempotency_key = get_header(scope, 'idempotency-key')
+        key = request_guard.key(user_id, user_input, idempotency_key)
+        future, leader = request_guard.join(key)
+        if not leader:
+            return await replay_chat(send, future, headers, stream=bool(speech or data.get("stream")))
+
+        try:
+            request_guard.acquire(user_id)
+        except RateLimited as e:
+            request_guard.reject(key, e)
+            return await send_rate_limited(send, e, headers)
+
+        try:
+            await run_chat_turn(send, session, user_id, user_input, data, headers, key, bool(idempotency_key))
+        finally:
+            # Duplicates of a turn that failed or was cut off stop waiting
+            request_guard.reject(key, ChatAborted())
+            request_guard.release(user_id)
+
+    except Exception:
+        log.exception("chat.error")
+        await send_json(send, {'error': 'Something went wrong on the server.'}, 500, headers)
+
+
+async def send_rate_limited(send, error, headers):
+    retry_after = (b'retry-after', str(error.retry_after).encode('latin-1'))
+    await send_json(send, {'error': str(error)}, 429, headers + [retry_after])
+
+
+async def run_chat_turn(send, session, user_id, user_input, data, headers, key, keep):
+    # The store is local SQLite; keep its calls off the event loop anyway
+    old_sid = session.get('sid')
+    sid = await anyio.to_thread.run_sync(flask_module.get_chat_session_id, session)
+    if sid != old_sid:
+        headers.append(session_cookie_header(session))
+
+    bot = await anyio.to_thread.run_sync(
+        flask_module.prepare_chat_turn, sid, user_id, user_input, async_client
+    )
+    if data.get("speech"):
+        voice_name = flask_module.reply_voice(bot, data.get("language"))
+        audio_format = data.get("format", flask_module.TTS_DEFAULT_FORMAT)
+        return await speak_chat(send, bot, sid, headers, voice_name, audio_format, key, keep)
+    if data.get("stream"):
+        return await stream_chat(send, bot, sid, headers, key, keep)
+
+    bot_response, turn = await flask_module.dispatcher.answer_async(bot, async_client)
+    jobs = await anyio.to_thread.run_sync(flask_module.finish_chat_turn, sid, bot, bot_response)
+    payload = {"response": bot_response, "usage": turn.bot.prompt_stats, "routing": turn.routing, "jobs": jobs}
+    flask_module.request_guard.resolve(key, payload, keep)
+    await send_json(send, payload, 200, headers)
+
+
+async def replay_chat(send, future, headers, stream=False):
+    """Answer a duplicate request with the result of the turn it duplicates"""
+    try:
+        # shield: a timeout here must not cancel the future other duplicates share
+        payload = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), COALESCE_TIMEOUT)
+    except asyncio.TimeoutError:
+        return await send_json(send, {'error': 'Timed out waiting for the original request'}, 504, headers)
+    except RateLimited as e:
+        return await send_rate_limited(send, e, headers)
+    except Exception:
+        return await send_json(send, {'error': 'Something went wrong on the server.'}, 500, headers)
+
+    replayed = headers + [(b'idempotent-replayed', b'true')]
+    if stream:
+        body = flask_module.sse_event(payload, event='done').encode('utf-8')
+        return await send_response(send, 200, body, 'text/event-stream', replayed + [(b'cache-control', b'no-cache')])
+    await send_json(send, payload, 200, replayed)
+
+
+async def stream_chat(send, bot, sid, headers, key=None, keep=False):
+    """Relay the bot's reply as server-sent events"""
+    await start_stream(send, 'text/event-stream', headers + [
+        (b'cache-control', b'no-cache'),
+        (b'x-accel-buffering', b'no'),
+    ])
+    turn = Turn(bot)
+    try:
+        async for delta in flask_module.dispatcher.stream_async(bot, async_client, turn):
+            await send_chunk(send, flask_module.sse_event({"delta": delta}).encode('utf-8'))
+
+        bot_response = turn.response
+        jobs = await anyio.to_thread.run_sync(flask_module.finish_chat_turn, sid, bot, bot_response)
+        payload = {"response": bot_response, "usage": turn.bot.prompt_stats, "routing": turn.routing, "jobs": jobs}
+        flask_module.request_guard.resolve(key, payload, keep)
+    except Exception:
+        # The headers are sent, so the error goes in the stream, not as a 500
+        log.exception("chat.stream_error")
+        error = flask_module.sse_event({'error': 'Something went wrong on the server.'}, event='error')
+        return await send_chunk(send, error.encode('utf-8'), more_body=False)
+
+    done = flask_module.sse_event(payload, event='done')
+    await send_chunk(send, done.encode('utf-8'), more_body=False)
+
+
+async def speak_chat(send, bot, sid, headers, voice_name, audio_format, key=None, keep=False):
+    """Stream the reply as text deltas plus one audio event per sentence, in order"""
+    await start_stream(send, 'text/event-stream', headers + [
+        (b'cache-control', b'no-cache'),
+        (b'x-accel-buffering', b'no'),
+    ])
+
+    def synthesize(sentence):
+        return flask_module.speak_sentence(sentence, voice_name, audio_format)
+
+    turn = Turn(bot)
+    sentences = 0
+    deltas = flask_module.dispatcher.stream_async(bot, async_client, turn)
+    try:
+        async for event in flask_module.speech_pipeline.run_async(deltas, synthesize, get_tts_limiter()):
+            if event[0] == 'delta':
+                message = flask_module.sse_event({"delta": event[1]})
+            else:
+                sentences += 1
+                message = flask_module.audio_event(*event[1:], audio_format)
+            await send_chunk(send, message.encode('utf-8'))
+
+        bot_response = turn.response
+        jobs = await anyio.to_thread.run_sync(flask_module.finish_chat_turn, sid, bot, bot_response)
+        payload = {"response": bot_response, "usage": turn.bot.prompt_stats, "routing": turn.routing,
+                   "sentences": sentences, "jobs": jobs}
+        flask_module.request_guard.resolve(key, payload, keep)
+    except Exception:
+        log.exception("chat.speech_error")
+        error = flask_module.sse_event({'error': 'Something went wrong on the server.'}, event='error')
+        return await send_chunk(send, error.encode('utf-8'), more_body=False)
+
+    done = flask_module.sse_event(payload, event='done')
+    await send_chunk(send, done.encode('utf-8'), more_body=False)
+
+
+async def text_to_speech(scope, receive, send):
+    headers = cors_headers(scope)
+    try:
+        data = await read_json(receive)
+        text = data.get('text', '')
+        language = data.get('language', 'en')
+        audio_format = data.get('format', flask_module.TTS_DEFAULT_FORMAT)
+
+        if not text:
+            return await send_json(send, {'error': 'No text provided'}, 400, headers)
+        if audio_format not in AUDIO_FORMATS:
+            return await send_json(send, {'error': f'Unsupported audio format: {audio_format}'}, 400, headers)
+        mimetype = AUDIO_FORMATS[audio_format][1]
+
+        voices = flask_module.LANGUAGE_VOICES
+        voice_name = voices.get(language, voices['en'])
+
+        tts_cache = flask_module.tts_cache
+        cache_key = tts_cache.key(text, voice_name, audio_format)
+        audio_data = await anyio.to_thread.run_sync(tts_cache.get, cache_key)
+        if audio_data is not None:
+            metrics.inc('tts_cache_requests_total', result='hit')
+            return await send_response(send, 200, audio_data, mimetype, headers + [(b'x-tts-cache', b'hit')])
+
+        if flask_module.TTS_BACKEND == 'azure' and not (flask_module.AZURE_SPEECH_KEY and flask_module.AZURE_SPEECH_REGION):
+            return await send_json(send, {'error': 'Azure Speech not configured'}, 500, headers)
+
+        metrics.inc('tts_cache_requests_total', result='miss')
+        limiter = get_tts_limiter()
+        if data.get('stream'):
+            audio_stream = flask_module.stream_speech(text, voice_name, audio_format, cache_key)
+            # Pull the first chunk before answering so a failed synthesis still gets a JSON error
+            chunk = await anyio.to_thread.run_sync(next, audio_stream, b'', limiter=limiter)
+            return await stream_audio(send, receive, audio_stream, chunk, mimetype,
+                                      headers + [(b'x-tts-cache', b'miss')], limiter)
+
+        audio_data = await anyio.to_thread.run_sync(
+            flask_module.synthesize_speech, text, voice_name, audio_format, cache_key, limiter=limiter
+        )
+        await send_response(send, 200, audio_data, mimetype, headers + [(b'x-tts-cache', b'miss')])
+
+    except SynthesisError as e:
+        log.error("tts.failed", error=str(e))
+        await send_json(send, {'error': str(e)}, 500, headers)
+    except Exception as e:
+        log.exception("tts.error")
+        await send_json(send, {'error': f'TTS service error: {str(e)}'}, 500, headers)
+
+
+async def stream_audio(send, receive, audio_stream, chunk, mimetype, headers, limiter):
+    """Send audio chunks as they are synthesized, and stop synthesizing if the client goes away"""
+    disconnected = asyncio.Event()
+
+    async def watch():
+        # The request body has been read, so the next message is the disconnect
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        disconnected.set()
+
+    watcher = asyncio.create_task(watch())
+    try:
+        await start_stream(send, mimetype, headers)
+        while chunk and not disconnected.is_set():
+            await send_chunk(send, chunk)
+            chunk = await anyio.to_thread.run_sync(next, audio_stream, b'', limiter=limiter)
+        if not disconnected.is_set():
+            await send_chunk(send, b'', more_body=False)
+    except Exception:
+        # The headers are sent and the body is audio, so neither a JSON error nor
+        # an event can follow: end the clip where it stopped
+        log.exception("tts.stream_error")
+        if not disconnected.is_set():
+            try:
+                await send_chunk(send, b'', more_body=False)
+            except Exception:
+                pass
+    finally:
+        watcher.cancel()
+        # Stops the synthesizer and returns it to the pool; an unfinished clip isn't cached
+        await anyio.to_thread.run_sync(audio_stream.close)
+
+
+ASYNC_ROUTES = {
+    '/chat': chat,
+    '/text-to-speech': text_to_speech,
+}
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if async_client.loaded:
+                await async_client.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def timed(handler, scope, receive, send):
+    """Run an async route, recording its latency until the last byte is sent"""
+    start = time.perf_counter()
+    status = [500]
+
+    async def send_and_capture(message):
+        if message['type'] == 'http.response.start':
+            status[0] = message['status']
+        await send(message)
+
+    try:
+        await handler(scope, receive, send_and_capture)
+    finally:
+        metrics.observe('http_request_duration_seconds', time.perf_counter() - start,
+                        route=scope['path'], method=scope['method'], status=status[0])
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    handler = ASYNC_ROUTES.get(scope['path'])
+    if scope['type'] == 'http' and scope['method'] == 'POST' and handler:
+        return await timed(handler, scope, receive, send)
+
+    # Everything else, including CORS preflights, goes to Flask
+    await flask_asgi(scope, receive, send)
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(
+        'asgi:application',
+        host=os.getenv('HOST', '127.0.0.1'),
+        port=int(os.getenv('PORT', '5000')),
+        workers=int(os.getenv('WEB_CONCURRENCY', '1')),
+    )
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""Local stand-in for the OpenAI chat completions API.
+
+Answers POST /v1/chat/completions like OpenAI would, streamed or not,
+with usage fields, after a configurable delay, so the server can be load
+tested without spending money. Point the app at it with
+
+    OPENAI_BASE_URL=http://127.0.0.1:8089/v1 OPENAI_API_KEY=bench python app.py
+
+    python -m bench.fake_openai --port 8089 --latency-ms 300 --token-ms 15
+
+--model-latency-ms gpt-4o=900 gives one model its own delay before the
+first token, e.g. to push it over the server's latency SLO. --tail-share
+makes that fraction of requests wait an extra --tail-ms, and --error-share
+answers that fraction with a 503, to exercise the client's hedging and
+retries.
+
+Intent classification, summary, grammar feedback, word lookup and
+reading passage requests are recognised from their system prompts and
+answered in kind; intents follow a fixed mix so routing and speculative
+dispatch see both hits and misses.
+"""
+import argparse
+import hashlib
+import json
+import random
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPLY_WORDS = (
+    "¡Muy bien! Me gusta mucho hablar contigo. ¿Qué hiciste ayer por la tarde? "
+    "Yo fui al mercado y compré frutas frescas. ¿Te gusta cocinar en casa o prefieres comer fuera?"
+).split()
+
+# Share of classifier answers per intent, out of 100
+INTENT_MIX = (("conversation", 80), ("grammar", 15), ("confused", 5))
+
+
+def count_tokens(text):
+    return max(1, len(text) // 4)
+
+
+def pick_intent(messages):
+    # Deterministic per message, so repeated runs route the same way
+    last = messages[-2]["content"] if len(messages) > 1 else ""
+    bucket = int(hashlib.sha1(last.encode("utf-8")).hexdigest(), 16) % 100
+    for intent, share in INTENT_MIX:
+        if bucket < share:
+            return intent
+        bucket -= share
+    return "conversation"
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            return self._send_json(200, {"object": "list", "data": [{"id": "gpt-4o-mini", "object": "model"}]})
+        self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.rfile.read(length)
+            return self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if random.random() < self.server.error_share:
+            return self._send_json(503, {"error": {"message": "Overloaded", "type": "server_error"}})
+        delay = self.server.model_latency.get(request.get("model"), self.server.latency)
+        if random.random() < self.server.tail_share:
+            delay += self.server.tail_delay
+
+        tokens = self._reply_tokens(request["messages"])
+        usage = {
+            "prompt_tokens": sum(count_tokens(str(m.get("content", ""))) for m in request["messages"]),
+            "completion_tokens": len(tokens),
+            "prompt_tokens_details": {"cached_tokens": 0},
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+
+        if request.get("stream"):
+            return self._stream(request, tokens, usage, delay)
+
+        time.sleep(delay + self.server.token_delay * len(tokens))
+        self._send_json(200, {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "gpt-4o-mini"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "".join(tokens)},
+                "finish_reason": "stop",
+            }],
+            "usage": usage,
+        })
+
+    def _reply_tokens(self, messages):
+        system = messages[0]["content"] if messages and messages[0]["role"] == "system" else ""
+        if system.startswith("You are an intent classifier"):
+            return [pick_intent(messages)]
+        if system.startswith("You keep a running summary"):
+            words = "The learner talked about food, travel and their weekend plans.".split()
+        elif system.startswith("You check a language learner's message"):
+            # About half the messages need a correction
+            last = messages[-1]["content"]
+            if hashlib.sha1(last.encode("utf-8")).digest()[0] % 2:
+                return ["OK"]
+            words = f"{last}\nCheck the verb endings.".split(" ")
+        elif system.startswith("You are a bilingual dictionary"):
+            word = messages[-1]["content"]
+            words = json.dumps({"word": word, "pos": "noun", "translations": [f"{word} (translated)"]},
+                               ensure_ascii=False).split(" ")
+        elif system.startswith("You write graded reading passages"):
+            words = json.dumps({
+                "title": "Un día en el mercado",
+                "text": " ".join(REPLY_WORDS),
+                "glossary": [{"term": "mercado", "meaning": "market"}, {"term": "frutas", "meaning": "fruit"}],
+                "questions": ["¿Adónde fue?", "¿Qué compró?"],
+            }, ensure_ascii=False).split(" ")
+        else:
+            words = (REPLY_WORDS * (self.server.reply_tokens // len(REPLY_WORDS) + 1))[:self.server.reply_tokens]
+        return [word if i == 0 else " " + word for i, word in enumerate(words)]
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream(self, request, tokens, usage, delay):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        base = {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": request.get("model", "gpt-4o-mini"),
+        }
+
+        def event(data):
+            chunk = f"data: {data}\n\n".encode("utf-8")
+            self.wfile.write(f"{len(chunk):x}\r\n".encode("ascii") + chunk + b"\r\n")
+            self.wfile.flush()
+
+        try:
+            time.sleep(delay)
+            for i, token in enumerate(tokens):
+                if i:
+                    time.sleep(self.server.token_delay)
+                delta = {"content": token} if i else {"role": "assistant", "content": token}
+                event(json.dumps(dict(base, choices=[{"index": 0, "delta": delta, "finish_reason": None}])))
+            event(json.dumps(dict(base, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}])))
+            if (request.get("stream_options") or {}).get("include_usage"):
+                event(json.dumps(dict(base, choices=[], usage=usage)))
+            event("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client closed the stream early, e.g. a discarded speculative answer
+            self.close_connection = True
+
+
+def make_server(host="127.0.0.1", port=8089, latency_ms=300, token_ms=15, reply_tokens=40,
+                tail_share=0.0, tail_ms=2000, error_share=0.0, model_latency_ms=None):
+    server = ThreadingHTTPServer((host, port), FakeOpenAIHandler)
+    server.daemon_threads = True
+    server.latency = latency_ms / 1000
+    server.token_delay = token_ms / 1000
+    server.reply_tokens = reply_tokens
+    server.tail_share = tail_share
+    server.tail_delay = tail_ms / 1000
+    server.error_share = error_share
+    server.model_latency = {model: ms / 1000 for model, ms in (model_latency_ms or {}).items()}
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a fake OpenAI chat completions API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency-ms", type=float, default=300, help="delay before the first token")
+    parser.add_argument("--token-ms", type=float, default=15, help="delay between streamed tokens")
+    parser.add_argument("--reply-tokens", type=int, default=40, help="length of chat replies")
+    parser.add_argument("--tail-share", type=float, default=0.0, help="fraction of requests that are slow")
+    parser.add_argument("--tail-ms", type=float, default=2000, help="extra delay of a slow request")
+    parser.add_argument("--error-share", type=float, default=0.0, help="fraction of requests answered with a 503")
+    parser.add_argument("--model-latency-ms", action="append", default=[], metavar="MODEL=MS",
+                        help="delay before the first token for one model")
+    args = parser.parse_args()
+    model_latency = {model: float(ms) for model, ms in (item.split("=", 1) for item in args.model_latency_ms)}
+
+    server = make_server(args.host, args.port, args.latency_ms, args.token_ms, args.reply_tokens,
+                         args.tail_share, args.tail_ms, args.error_share, model_latency)
+    print(f"Fake OpenAI listening on http://{args.host}:{server.server_address[1]}/v1", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,434 @@
+#!/usr/bin/env python3
+"""Offline load test for the chat server.
+
+Starts the fake OpenAI server and the app (Flask threaded server or the
+async server under uvicorn) in a scratch directory, with TTS_BACKEND=fake,
+then runs concurrent learners through realistic sessions:
+
+    /signup -> /login -> (/chat -> /text-to-speech) x turns -> /reset_chat
+
+Chat turns alternate between JSON and streamed replies, and every other
+clip is a replay that should come from the TTS cache. The report gives
+throughput and p50/p95/p99 latency per endpoint, time to first delta for
+streamed chats, peak memory per server worker, and the server's own span
+timings from /metrics (user store, prompt build, OpenAI calls, ...).
+
+    python -m bench.loadtest --users 20 --turns 6
+    python -m bench.loadtest --server asgi --workers 2 --json result.json
+    python -m bench.loadtest --user-store json --max-error-rate 0.01
+    UPSTREAM_HEDGE=1 python -m bench.loadtest --tail-share 0.05 --tail-ms 2000
+
+Run from the server directory. The exit status is non-zero when the error
+rate exceeds --max-error-rate, so the run can gate CI.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+import httpx
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MESSAGES = {
+    "es": [
+        "Hola, me llamo Ana y vivo en Madrid.",
+        "Ayer fui al cine con mis amigos.",
+        "Me gusta cocinar paella los domingos.",
+        "¿Cuándo se usa el subjuntivo?",
+        "No entiendo, ¿puedes repetir?",
+        "Quiero viajar a México el próximo verano.",
+        "¿Qué significa 'madrugar'?",
+        "Trabajo en una oficina pero prefiero estar al aire libre.",
+    ],
+    "fr": [
+        "Bonjour, je m'appelle Paul.",
+        "Hier, je suis allé au marché.",
+        "Quelle est la différence entre 'savoir' et 'connaître'?",
+        "Je ne comprends pas.",
+        "J'aime lire des romans le soir.",
+    ],
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+# --- Memory ---
+
+def process_tree(pid):
+    """pid and all its descendants, from /proc"""
+    children = defaultdict(list)
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # The command name may contain spaces; the parent pid follows the closing paren
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children[ppid].append(int(entry))
+    tree, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(children.get(current, []))
+    return tree
+
+
+def rss_bytes(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class MemorySampler(threading.Thread):
+    """Records the peak resident memory of each server process"""
+
+    def __init__(self, pid, interval=0.5):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = {}
+        self._done = threading.Event()
+
+    def sample(self):
+        if not os.path.isdir("/proc"):
+            return
+        for pid in process_tree(self.pid):
+            rss = rss_bytes(pid)
+            if rss is not None:
+                self.peak[pid] = max(rss, self.peak.get(pid, 0))
+
+    def run(self):
+        while not self._done.is_set():
+            self.sample()
+            self._done.wait(self.interval)
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        self.sample()
+
+
+# --- Load ---
+
+class Results:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.error_samples = []
+
+    def record(self, name, seconds, ok=True, detail=None):
+        with self._lock:
+            self.latencies[name].append(seconds)
+            if not ok:
+                self.errors[name] += 1
+                if len(self.error_samples) < 5:
+                    self.error_samples.append(f"{name}: {detail}")
+
+
+def timed_post(http, results, name, path, payload):
+    start = time.perf_counter()
+    try:
+        response = http.post(path, json=payload)
+        ok = response.status_code < 400
+        results.record(name, time.perf_counter() - start, ok, None if ok else f"HTTP {response.status_code}")
+        return response if ok else None
+    except httpx.HTTPError as e:
+        results.record(name, time.perf_counter() - start, False, repr(e))
+        return None
+
+
+def streamed_chat(http, results, message):
+    """POST /chat with stream=true. Returns the assembled reply."""
+    start = time.perf_counter()
+    reply = None
+    first_delta = True
+    try:
+        with http.stream("POST", "/chat", json={"message": message, "stream": True}) as response:
+            if response.status_code >= 400:
+                results.record("chat_stream", time.perf_counter() - start, False, f"HTTP {response.status_code}")
+                return None
+            event = None
+            for line in response.iter_lines():
+                if line.startswith("event: "):
+                    event = line[7:]
+                elif line.startswith("data: "):
+                    data = json.loads(line[6:])
+                    if "delta" in data and first_delta:
+                        results.record("chat_stream_first_delta", time.perf_counter() - start)
+                        first_delta = False
+                    if event == "done":
+                        reply = data["response"]
+                    elif event == "error":
+                        results.record("chat_stream", time.perf_counter() - start, False, data.get("error"))
+                        return None
+                elif not line:
+                    event = None
+    except httpx.HTTPError as e:
+        results.record("chat_stream", time.perf_counter() - start, False, repr(e))
+        return None
+    results.record("chat_stream", time.perf_counter() - start, reply is not None, "no done event")
+    return reply
+
+
+def run_learner(base_url, index, args, results, run_id):
+    rng = random.Random(index)
+    language = rng.choice(sorted(MESSAGES))
+    email = f"bench-{run_id}-{index}@example.com"
+    password = "bench-password"
+
+    with httpx.Client(base_url=base_url, timeout=args.timeout) as http:
+        if not timed_post(http, results, "signup", "/signup",
+                          {"email": email, "password": password, "nativeLang": "en", "targetLang": language}):
+            return
+        if not timed_post(http, results, "login", "/login",
+                          {"username": email, "password": password, "nativeLang": "en", "targetLang": language}):
+            return
+
+        previous_reply = None
+        for turn in range(args.turns):
+            message = rng.choice(MESSAGES[language])
+            if turn % 2:
+                reply = streamed_chat(http, results, message)
+            else:
+                response = timed_post(http, results, "chat", "/chat", {"message": message})
+                reply = response.json().get("response") if response else None
+            if reply is None:
+                continue
+
+            # Every other clip replays the previous reply, as learners do
+            text = previous_reply if (turn % 2 and previous_reply) else reply
+            timed_post(http, results, "text_to_speech", "/text-to-speech",
+                       {"text": text[:300], "language": language, "format": "mp3"})
+            previous_reply = reply
+
+            if args.think_ms:
+                time.sleep(rng.uniform(0, 2 * args.think_ms) / 1000)
+
+        timed_post(http, results, "reset_chat", "/reset_chat", {})
+
+
+# --- Servers ---
+
+def start_servers(args, workdir):
+    openai_port = free_port()
+    fake = subprocess.Popen(
+        [sys.executable, "-m", "bench.fake_openai", "--port", str(openai_port),
+         "--latency-ms", str(args.latency_ms), "--token-ms", str(args.token_ms),
+         "--reply-tokens", str(args.reply_tokens), "--tail-share", str(args.tail_share),
+         "--tail-ms", str(args.tail_ms), "--error-share", str(args.error_share)],
+        cwd=SERVER_DIR, stdout=subprocess.DEVNULL,
+    )
+
+    app_port = free_port()
+    env = dict(
+        os.environ,
+        PYTHONPATH=SERVER_DIR,
+        OPENAI_BASE_URL=f"http://127.0.0.1:{openai_port}/v1",
+        OPENAI_API_KEY="bench",
+        TTS_BACKEND="fake",
+        FAKE_TTS_LATENCY_MS=str(args.tts_latency_ms),
+        USER_STORE=args.user_store,
+        LOG_LEVEL="warning",
+        # Learners here type much faster than people; the per-user rate limit would skew the run
+        CHAT_RATE_PER_MINUTE=os.getenv("CHAT_RATE_PER_MINUTE", "0"),
+    )
+    if args.server == "asgi":
+        command = [sys.executable, "-m", "uvicorn", "asgi:application", "--port", str(app_port),
+                   "--workers", str(args.workers), "--log-level", "warning", "--no-access-log"]
+    else:
+        command = [sys.executable, "-m", "flask", "--app", "app", "run", "--port", str(app_port),
+                   "--no-debugger", "--no-reload", "--with-threads"]
+    app = subprocess.Popen(command, cwd=workdir, env=env,
+                           stdout=subprocess.DEVNULL, stderr=None if args.verbose else subprocess.DEVNULL)
+
+    wait_for(f"http://127.0.0.1:{openai_port}/v1/models")
+    base_url = f"http://127.0.0.1:{app_port}"
+    wait_for(f"{base_url}/get_user_info")
+    return fake, app, base_url
+
+
+def stop(process):
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def server_spans(base_url):
+    """Mean duration per span name from the server's /metrics, in ms"""
+    try:
+        text = httpx.get(f"{base_url}/metrics", timeout=10).text
+    except httpx.HTTPError:
+        return {}
+    sums, counts = defaultdict(float), defaultdict(int)
+    for match in re.finditer(r'^span_duration_seconds_(sum|count)\{([^}]*)\} (\S+)$', text, re.MULTILINE):
+        kind, labels, value = match.groups()
+        span = re.search(r'span="([^"]+)"', labels).group(1)
+        if kind == "sum":
+            sums[span] += float(value)
+        else:
+            counts[span] += int(value)
+    return {span: {"count": counts[span], "mean_ms": 1000 * sums[span] / counts[span]}
+            for span in sorted(counts) if counts[span]}
+
+
+# --- Report ---
+
+def summarize(results, elapsed, memory, spans, args):
+    endpoints = {}
+    total = errors = 0
+    for name, values in sorted(results.latencies.items()):
+        count = len(values)
+        failed = results.errors.get(name, 0)
+        if name != "chat_stream_first_delta":
+            total += count
+            errors += failed
+        endpoints[name] = {
+            "count": count,
+            "errors": failed,
+            "rps": count / elapsed,
+            "p50_ms": 1000 * percentile(values, 50),
+            "p95_ms": 1000 * percentile(values, 95),
+            "p99_ms": 1000 * percentile(values, 99),
+        }
+    return {
+        "config": {key: value for key, value in vars(args).items() if key != "json"},
+        "elapsed_s": elapsed,
+        "requests": total,
+        "errors": errors,
+        "error_rate": errors / total if total else 0.0,
+        "throughput_rps": total / elapsed,
+        "endpoints": endpoints,
+        "worker_peak_rss_mb": {str(pid): rss / 2 ** 20 for pid, rss in sorted(memory.items())},
+        "server_spans": spans,
+        "error_samples": results.error_samples,
+    }
+
+
+def print_report(summary):
+    config = summary["config"]
+    print(f"\n{config['users']} learners x {config['turns']} turns against {config['server']} "
+          f"({config['workers']} worker(s), {config['user_store']} user store), "
+          f"OpenAI latency {config['latency_ms']:.0f}ms + {config['token_ms']:.0f}ms/token")
+    print(f"{summary['requests']} requests in {summary['elapsed_s']:.1f}s: "
+          f"{summary['throughput_rps']:.1f} req/s, {summary['errors']} errors\n")
+
+    print(f"{'endpoint':<26}{'count':>7}{'errors':>8}{'req/s':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for name, stats in summary["endpoints"].items():
+        print(f"{name:<26}{stats['count']:>7}{stats['errors']:>8}{stats['rps']:>8.1f}"
+              f"{stats['p50_ms']:>9.1f}{stats['p95_ms']:>9.1f}{stats['p99_ms']:>9.1f}")
+
+    if summary["worker_peak_rss_mb"]:
+        print("\nPeak RSS per server process:")
+        for pid, mb in summary["worker_peak_rss_mb"].items():
+            print(f"  pid {pid}: {mb:.1f} MB")
+
+    if summary["server_spans"]:
+        print("\nServer spans:")
+        for span, stats in summary["server_spans"].items():
+            print(f"  {span:<26}{stats['count']:>7}  {stats['mean_ms']:.2f} ms avg")
+
+    for sample in summary["error_samples"]:
+        print(f"error: {sample}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the chat server against local fakes")
+    parser.add_argument("--users", type=int, default=10, help="concurrent learners")
+    parser.add_argument("--turns", type=int, default=6, help="chat turns per learner")
+    parser.add_argument("--server", choices=["flask", "asgi"], default="flask")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers (asgi only)")
+    parser.add_argument("--user-store", choices=["sqlite", "json"], default="sqlite")
+    parser.add_argument("--latency-ms", type=float, default=300, help="fake OpenAI time to first token")
+    parser.add_argument("--token-ms", type=float, default=15, help="fake OpenAI delay per token")
+    parser.add_argument("--reply-tokens", type=int, default=40)
+    parser.add_argument("--tail-share", type=float, default=0.0, help="fraction of fake OpenAI calls that are slow")
+    parser.add_argument("--tail-ms", type=float, default=2000, help="extra delay of a slow OpenAI call")
+    parser.add_argument("--error-share", type=float, default=0.0, help="fraction of fake OpenAI calls that fail with 503")
+    parser.add_argument("--tts-latency-ms", type=float, default=150, help="fake synthesis time per clip")
+    parser.add_argument("--think-ms", type=float, default=0, help="mean pause between turns")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--max-error-rate", type=float, default=0.0)
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the app server's log")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="chat-buddy-bench-")
+    fake, app, base_url = start_servers(args, workdir)
+    try:
+        memory = MemorySampler(app.pid)
+        memory.start()
+        results = Results()
+        run_id = os.urandom(4).hex()
+        learners = [
+            threading.Thread(target=run_learner, args=(base_url, i, args, results, run_id))
+            for i in range(args.users)
+        ]
+        start = time.perf_counter()
+        for learner in learners:
+            learner.start()
+        for learner in learners:
+            learner.join()
+        elapsed = time.perf_counter() - start
+        memory.stop()
+        # With several workers this only reflects whichever one answers
+        spans = server_spans(base_url)
+    finally:
+        stop(app)
+        stop(fake)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    summary = summarize(results, elapsed, memory.peak, spans, args)
+    print_report(summary)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+
+    if summary["error_rate"] > args.max_error_rate:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""Throughput as the number of server workers grows.
+
+Runs bench.loadtest against the async server once per worker count, with
+the workers sharing state (SHARED_STATE=sqlite by default), and reports
+requests per second, the speedup over the first count, and chat latency.
+The fake OpenAI answers quickly by default, so the run measures the
+server's own work rather than time spent waiting on the model.
+
+    python -m bench.scaling
+    python -m bench.scaling --workers 1,2,4,8 --users 64 --turns 4
+    python -m bench.scaling --shared-state local --json scaling.json
+
+Run from the server directory. Workers beyond the host's CPU count share
+cores, so the speedup flattens there.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from bench.loadtest import SERVER_DIR
+
+
+def run(workers, args):
+    """One loadtest run; return its summary"""
+    with tempfile.NamedTemporaryFile(suffix=".json") as out:
+        command = [
+            sys.executable, "-m", "bench.loadtest", "--server", "asgi", "--workers", str(workers),
+            "--users", str(args.users), "--turns", str(args.turns),
+            "--latency-ms", str(args.latency_ms), "--token-ms", str(args.token_ms),
+            "--tts-latency-ms", str(args.tts_latency_ms), "--max-error-rate", "1", "--json", out.name,
+        ]
+        env = dict(os.environ, SHARED_STATE=args.shared_state)
+        subprocess.run(command, cwd=SERVER_DIR, env=env, check=True, stdout=subprocess.DEVNULL)
+        with open(out.name) as f:
+            return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure throughput against the number of server workers")
+    parser.add_argument("--workers", default="1,2,4", help="comma-separated worker counts")
+    parser.add_argument("--users", type=int, default=32, help="concurrent learners")
+    parser.add_argument("--turns", type=int, default=4, help="chat turns per learner")
+    parser.add_argument("--latency-ms", type=float, default=20, help="fake OpenAI time to first token")
+    parser.add_argument("--token-ms", type=float, default=0, help="fake OpenAI delay per token")
+    parser.add_argument("--tts-latency-ms", type=float, default=5, help="fake synthesis time per clip")
+    parser.add_argument("--shared-state", choices=["sqlite", "local"], default="sqlite")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    counts = [int(count) for count in args.workers.split(",")]
+    print(f"{args.users} learners x {args.turns} turns, SHARED_STATE={args.shared_state}, "
+          f"{os.cpu_count()} CPU(s)\n")
+    print(f"{'workers':>7}{'req/s':>9}{'speedup':>9}{'chat p50':>10}{'chat p95':>10}{'errors':>8}")
+    rows = []
+    for workers in counts:
+        summary = run(workers, args)
+        chat = summary["endpoints"].get("chat", {})
+        row = {
+            "workers": workers,
+            "throughput_rps": summary["throughput_rps"],
+            "speedup": summary["throughput_rps"] / rows[0]["throughput_rps"] if rows else 1.0,
+            "chat_p50_ms": chat.get("p50_ms", 0.0),
+            "chat_p95_ms": chat.get("p95_ms", 0.0),
+            "errors": summary["errors"],
+        }
+        rows.append(row)
+        print(f"{workers:>7}{row['throughput_rps']:>9.1f}{row['speedup']:>8.2f}x"
+              f"{row['chat_p50_ms']:>10.1f}{row['chat_p95_ms']:>10.1f}{row['errors']:>8}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"config": vars(args), "cpus": os.cpu_count(), "runs": rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""Cold start benchmark for the chat server.
+
+Starts the app (Flask threaded server or the async server under uvicorn)
+over and over in a scratch directory, against the fake OpenAI server, and
+times each start from process launch to:
+
+- listening: the first answer from /ready, whatever its status
+- ready: /ready answers 200 (the required subsystems are loaded)
+- first chat: a new learner's first /chat reply
+
+Each STARTUP_WARMUP mode given with --modes is measured, so background
+warm-up can be compared with loading everything before serving (sync) or
+on first use (off). The report gives the median and p90 per mode and the
+mean load time per subsystem as reported by /ready.
+
+    python -m bench.startup
+    python -m bench.startup --server asgi --runs 10 --modes background,off
+    python -m bench.startup --json startup.json
+
+Run from the server directory.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import httpx
+
+from bench.loadtest import SERVER_DIR, free_port, percentile, stop, wait_for
+
+# Frequent enough to resolve startup phases, rare enough not to slow the worker down
+POLL_INTERVAL = 0.05
+
+
+def poll(url, until, timeout):
+    """Poll url until `until(response)` holds; return the response"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            response = httpx.get(url, timeout=1)
+            if until(response):
+                return response
+        except httpx.HTTPError:
+            pass
+        time.sleep(POLL_INTERVAL)
+    raise RuntimeError(f"{url} not ready within {timeout}s")
+
+
+def start_app(args, mode, openai_port, workdir):
+    port = free_port()
+    env = dict(
+        os.environ,
+        PYTHONPATH=SERVER_DIR,
+        OPENAI_BASE_URL=f"http://127.0.0.1:{openai_port}/v1",
+        OPENAI_API_KEY="bench",
+        TTS_BACKEND="fake",
+        LOG_LEVEL="warning",
+        STARTUP_WARMUP=mode,
+    )
+    if args.server == "asgi":
+        command = [sys.executable, "-m", "uvicorn", "asgi:application", "--port", str(port),
+                   "--log-level", "warning", "--no-access-log"]
+    else:
+        command = [sys.executable, "-m", "flask", "--app", "app", "run", "--port", str(port),
+                   "--no-debugger", "--no-reload", "--with-threads"]
+    process = subprocess.Popen(command, cwd=workdir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=None if args.verbose else subprocess.DEVNULL)
+    return process, f"http://127.0.0.1:{port}"
+
+
+def measure(args, mode, openai_port, run):
+    """Start one server and time how long it takes to listen, be ready and answer a chat"""
+    workdir = tempfile.mkdtemp(prefix="chat-buddy-startup-")
+    launched = time.perf_counter()
+    process, base_url = start_app(args, mode, openai_port, workdir)
+    try:
+        poll(f"{base_url}/ready", lambda r: True, args.timeout)
+        listening = time.perf_counter() - launched
+        status = poll(f"{base_url}/ready", lambda r: r.status_code == 200, args.timeout).json()
+        ready = time.perf_counter() - launched
+
+        with httpx.Client(base_url=base_url, timeout=args.timeout) as http:
+            email = f"startup-{run}@bench.local"
+            http.post("/signup", json={"email": email, "password": "pw", "nativeLang": "en", "targetLang": "es"})
+            response = http.post("/chat", json={"message": "Hola, ¿qué tal?"})
+            response.raise_for_status()
+        first_chat = time.perf_counter() - launched
+        # Subsystems loaded by the chat itself, when warm-up is off
+        status = httpx.get(f"{base_url}/ready", timeout=5).json()
+    finally:
+        stop(process)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    loads = {name: sub["seconds"] for name, sub in status["subsystems"].items() if sub["seconds"] is not None}
+    return {"listening_s": listening, "ready_s": ready, "first_chat_s": first_chat, "subsystems": loads}
+
+
+def summarize(runs):
+    summary = {}
+    for metric in ("listening_s", "ready_s", "first_chat_s"):
+        values = [run[metric] for run in runs]
+        summary[metric] = {"p50": percentile(values, 50), "p90": percentile(values, 90)}
+    loads = defaultdict(list)
+    for run in runs:
+        for name, seconds in run["subsystems"].items():
+            loads[name].append(seconds)
+    summary["subsystem_mean_s"] = {name: sum(values) / len(values) for name, values in loads.items()}
+    return summary
+
+
+def print_report(args, results):
+    print(f"\n{args.runs} cold starts per mode against {args.server}\n")
+    print(f"{'mode':<12}{'listen p50':>12}{'p90':>8}{'ready p50':>12}{'p90':>8}{'1st chat p50':>14}{'p90':>8}")
+    for mode, summary in results.items():
+        row = f"{mode:<12}"
+        for metric, width in (("listening_s", 12), ("ready_s", 12), ("first_chat_s", 14)):
+            row += f"{summary[metric]['p50']:>{width}.3f}{summary[metric]['p90']:>8.3f}"
+        print(row)
+
+    print("\nSubsystem load time (mean s):")
+    for mode, summary in results.items():
+        loads = ", ".join(f"{name} {seconds:.3f}" for name, seconds in summary["subsystem_mean_s"].items())
+        print(f"  {mode:<12}{loads}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time how fast a fresh chat server takes traffic")
+    parser.add_argument("--server", choices=["flask", "asgi"], default="flask")
+    parser.add_argument("--runs", type=int, default=5, help="cold starts per mode")
+    parser.add_argument("--modes", default="background,sync,off", help="STARTUP_WARMUP modes to compare")
+    parser.add_argument("--latency-ms", type=float, default=50, help="fake OpenAI time to first token")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the app server's log")
+    args = parser.parse_args()
+
+    openai_port = free_port()
+    fake = subprocess.Popen(
+        [sys.executable, "-m", "bench.fake_openai", "--port", str(openai_port),
+         "--latency-ms", str(args.latency_ms), "--token-ms", "0"],
+        cwd=SERVER_DIR, stdout=subprocess.DEVNULL,
+    )
+    try:
+        wait_for(f"http://127.0.0.1:{openai_port}/v1/models")
+        results = {}
+        for mode in args.modes.split(","):
+            runs = [measure(args, mode, openai_port, run) for run in range(args.runs)]
+            results[mode] = summarize(runs)
+    finally:
+        stop(fake)
+
+    print_report(args, results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,34 +1,148 @@
-from bots.personalization_builder import build_personalization_context
+import time
+
+from bots.context_window import message_tokens
+from bots.model_policy import FALLBACK_TIER, TIERS, model_policy
+from bots.prompt_assembly import prompt_assembler
+from metrics import metrics
 
 class BaseBot:
-    def __init__(self, messages, client, user_background=None):
+    def __init__(self, messages, client, user_background=None, summary=None, context_stats=None, user_id=None,
+                 model=None):
         self.messages = messages
         self.client = client
+        # Set per turn by the dispatcher from the model policy
+        self.model = model or TIERS[FALLBACK_TIER]
         self.user_background = user_background or {}
+        # Keys the memoized personalization block
+        self.user_id = user_id
+        # Rolling summary of older turns that were dropped from self.messages
+        self.summary = summary
+        # Token stats for the last prompt, starting with what the ContextWindow reported
+        self.prompt_stats = dict(context_stats or {})
+
 
+    def fork(self):
+        """A copy with its own message list and stats, for a speculative answer"""
+        return BaseBot(list(self.messages), self.client, user_background=self.user_background,
+                       summary=self.summary, context_stats=self.prompt_stats, user_id=self.user_id,
+                       model=self.model)
 
     def build_prompt(self, system_message):
         """Build prompt with user personalization context"""
-        # Get personalization context
-        personalization_context = build_personalization_context(self.user_background)
-        
-        # Combine with system message if we have personalization
-        if personalization_context:
-            full_system_message = f"{personalization_context}\n\n{system_message}\n\nRemember to tailor your responses to the user's skill level and interests."
-        else:
-            full_system_message = system_message
-            
-        return [{"role": "system", "content": full_system_message}] + self.messages + [{
-            "role": "user",
-            "content": "Use the target language wants to chat and use the native language if they have a grammar or vocabulary question. Remember to make your response short so I have a chance to speak more."
-        }]
-
-    def ask_openai(self, system_message):
+        # Static system prompt first, then the user's block, so prompts share the longest prefix
+        with metrics.span("prompt.build"):
+            prompt = prompt_assembler.build(system_message, self.messages, user_id=self.user_id,
+                                            user_background=self.user_background, summary=self.summary)
+
+        self.prompt_stats["prompt_tokens"] = sum(message_tokens(message) for message in prompt)
+        return prompt
+
+    def record_usage(self, usage):
+        """Add the token counts OpenAI reported for the last call"""
+        if usage is not None:
+            # Tokens are priced per model
+            self.prompt_stats["model"] = self.model
+            self.prompt_stats["api_prompt_tokens"] = usage.prompt_tokens
+            self.prompt_stats["api_completion_tokens"] = usage.completion_tokens
+            # Prompt tokens served from OpenAI's prefix cache
+            details = getattr(usage, "prompt_tokens_details", None)
+            self.prompt_stats["api_cached_tokens"] = getattr(details, "cached_tokens", None) or 0
+            metrics.inc("llm_tokens_total", usage.prompt_tokens, model=self.model, kind="prompt")
+            metrics.inc("llm_tokens_total", usage.completion_tokens, model=self.model, kind="completion")
+            metrics.inc("llm_tokens_total", self.prompt_stats["api_cached_tokens"], model=self.model, kind="cached")
+
+    def _first_token(self, start):
+        seconds = time.perf_counter() - start
+        metrics.observe("llm_time_to_first_token_seconds", seconds, model=self.model)
+        model_policy.observe(self.model, "first_token", seconds)
+
+    def ask_openai(self, system_message, operation="reply"):
         """Get response from OpenAI with personalized prompt"""
         prompt = self.build_prompt(system_message)
-        print ("current prompt is: ", prompt)
-        response = self.client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=prompt
-        )
-        return response.choices[0].message.content
\ No newline at end of file
+        start = time.perf_counter()
+        with metrics.span("llm.call", model=self.model):
+            response = self.client.chat.completions.create(
+                model=self.model,
+                messages=prompt,
+                operation=operation
+            )
+        model_policy.observe(self.model, "call", time.perf_counter() - start)
+        self.record_usage(response.usage)
+        return response.choices[0].message.content
+
+    def ask_openai_stream(self, system_message):
+        """Stream the response from OpenAI, yielding text as it arrives.
+
+        Once the stream closes the assembled reply is appended to the
+        conversation, just like the caller of ask_openai would do.
+        """
+        prompt = self.build_prompt(system_message)
+        start = time.perf_counter()
+        with metrics.span("llm.stream", model=self.model):
+            stream = self.client.chat.completions.create(
+                model=self.model,
+                messages=prompt,
+                stream=True,
+                stream_options={"include_usage": True},
+                operation="reply"
+            )
+            parts = []
+            try:
+                for chunk in stream:
+                    # The final chunk has no choices, only the usage totals
+                    self.record_usage(getattr(chunk, "usage", None))
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        if not parts:
+                            self._first_token(start)
+                        parts.append(delta)
+                        yield delta
+            finally:
+                stream.close()
+
+        self.messages.append({"role": "assistant", "content": "".join(parts)})
+
+    async def ask_openai_async(self, system_message):
+        """ask_openai for an AsyncOpenAI client"""
+        prompt = self.build_prompt(system_message)
+        start = time.perf_counter()
+        with metrics.span("llm.call", model=self.model):
+            response = await self.client.chat.completions.create(
+                model=self.model,
+                messages=prompt,
+                operation="reply"
+            )
+        model_policy.observe(self.model, "call", time.perf_counter() - start)
+        self.record_usage(response.usage)
+        return response.choices[0].message.content
+
+    async def ask_openai_stream_async(self, system_message):
+        """ask_openai_stream for an AsyncOpenAI client"""
+        prompt = self.build_prompt(system_message)
+        start = time.perf_counter()
+        with metrics.span("llm.stream", model=self.model):
+            stream = await self.client.chat.completions.create(
+                model=self.model,
+                messages=prompt,
+                stream=True,
+                stream_options={"include_usage": True},
+                operation="reply"
+            )
+            parts = []
+            try:
+                async for chunk in stream:
+                    self.record_usage(getattr(chunk, "usage", None))
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        if not parts:
+                            self._first_token(start)
+                        parts.append(delta)
+                        yield delta
+            finally:
+                await stream.close()
+
+        self.messages.append({"role": "assistant", "content": "".join(parts)})
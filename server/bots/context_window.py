@@ -0,0 +1,112 @@
+import os
+from functools import lru_cache
+
+from bots.model_policy import model_policy
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("o200k_base")
+except Exception:  # tiktoken is optional; fall back to an estimate
+    _encoding = None
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text):
+    """Count tokens in a message, using tiktoken when it's installed"""
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    # Rough estimate: ~4 characters per token, but CJK characters are
+    # usually a token each
+    wide = sum(1 for ch in text if ord(ch) >= 0x2E80)
+    return wide + (len(text) - wide + 3) // 4
+
+
+def message_tokens(message):
+    # Each message carries a few tokens of role/formatting overhead
+    return count_tokens(message["content"]) + 4
+
+
+SUMMARY_PROMPT = """You keep a running summary of a conversation between a language learner and their conversation partner.
+Update the summary with the new turns. Keep what matters for continuing the conversation: topics discussed, facts the learner shared about themselves, mistakes they keep making and words they struggled with.
+Write at most 120 words. Return only the updated summary."""
+
+
+class ContextWindow:
+    """Keeps the conversation sent to OpenAI within a token budget.
+
+    The most recent turns are sent verbatim. Older turns are folded into a
+    rolling summary, a batch at a time, so the summary is only refreshed
+    every few turns instead of on every request. Until a batch is full the
+    overflowing turns are still sent verbatim, so the budget can be exceeded
+    by at most one batch.
+
+    The summary is a small dict the caller stores between requests:
+    {"text": ..., "upto": <last summarized turn seq>, "turns": ..., "tokens": ...}
+    """
+
+    def __init__(self, client, budget=None, min_recent=None, summary_batch=None):
+        self.client = client
+        self.budget = budget or int(os.getenv("CONTEXT_TOKEN_BUDGET", "1200"))
+        self.min_recent = min_recent or int(os.getenv("CONTEXT_MIN_RECENT", "4"))
+        self.summary_batch = summary_batch or int(os.getenv("CONTEXT_SUMMARY_BATCH", "6"))
+
+    def fit(self, turns, summary=None):
+        """Pick the messages to send for a conversation.
+
+        `turns` are the stored turns not yet covered by the summary, oldest
+        first, each a dict with seq, role, content and (cached) tokens.
+        Returns (messages, summary, stats).
+        """
+        summary = dict(summary or {"text": "", "upto": 0, "turns": 0, "tokens": 0})
+        tokens = [turn.get("tokens") or message_tokens(turn) for turn in turns]
+
+        # Walk back from the newest turn until the budget is used up
+        used = 0
+        keep_from = len(turns)
+        while keep_from > 0:
+            cost = tokens[keep_from - 1]
+            if used + cost > self.budget and len(turns) - keep_from >= self.min_recent:
+                break
+            used += cost
+            keep_from -= 1
+
+        refreshed = False
+        if keep_from >= self.summary_batch:
+            summary = self._fold(summary, turns[:keep_from], sum(tokens[:keep_from]))
+            turns, tokens = turns[keep_from:], tokens[keep_from:]
+            refreshed = True
+
+        messages = [{"role": turn["role"], "content": turn["content"]} for turn in turns]
+        sent_tokens = sum(tokens)
+        summary_tokens = count_tokens(summary["text"])
+        history_tokens = summary["tokens"] + sent_tokens
+        stats = {
+            "history_tokens": history_tokens,
+            "sent_history_tokens": summary_tokens + sent_tokens,
+            "saved_tokens": max(history_tokens - summary_tokens - sent_tokens, 0),
+            "summarized_turns": summary["turns"],
+            "verbatim_turns": len(messages),
+            "summary_refreshed": refreshed,
+        }
+        return messages, summary, stats
+
+    def _fold(self, summary, turns, turn_tokens):
+        """Fold a batch of turns into the rolling summary with one LLM call"""
+        transcript = "\n".join(f"{turn['role']}: {turn['content']}" for turn in turns)
+        response = self.client.chat.completions.create(
+            model=model_policy.select("summary")["model"],
+            messages=[
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": f"Current summary:\n{summary['text'] or '(none)'}\n\nNew turns:\n{transcript}"},
+            ],
+            temperature=0,
+            operation="summary"
+        )
+        return {
+            "text": response.choices[0].message.content.strip(),
+            "upto": turns[-1]["seq"],
+            "turns": summary["turns"] + len(turns),
+            "tokens": summary["tokens"] + turn_tokens,
+        }
@@ -0,0 +1,51 @@
+import json
+
+from bots.base_bot import BaseBot  # 👈 Import BaseBot
+from bots.llm_cache import llm_cache
+from bots.model_policy import model_policy
+from bots.system_prompts import LANGUAGE_NAMES
+
+LOOKUP_PROMPT = """You are a bilingual dictionary from {source} to {target}.
+The user sends one {source} word or short phrase, possibly inflected. Give its dictionary form, its part of speech, and its most common {target} translations, most common first.
+Answer with JSON only: {{"word": "...", "pos": "...", "translations": ["..."]}}. If it is not {source}, answer {{"translations": []}}."""
+
+# temperature 0 makes the entry a function of the word, so it is memoized
+LOOKUP_PARAMS = {"temperature": 0, "response_format": {"type": "json_object"}}
+
+class DictionaryBot(BaseBot):
+    """Looks up the words the local dictionaries don't have"""
+
+    def define(self, word, source_lang, target_lang, admit=None):
+        """{'word', 'pos', 'translations'}; translations is empty if the model doesn't know the word.
+
+        `admit` is called before a model call (not for cached entries) and may raise to refuse it.
+        """
+        prompt = [
+            {"role": "system", "content": LOOKUP_PROMPT.format(
+                source=LANGUAGE_NAMES.get(source_lang, source_lang),
+                target=LANGUAGE_NAMES.get(target_lang, target_lang),
+            )},
+            {"role": "user", "content": word},
+        ]
+        model = model_policy.select("lookup")["model"]
+        key = llm_cache.key(model, LOOKUP_PARAMS, prompt)
+        entry = llm_cache.get(key, "lookup")
+        if entry is not None:
+            return entry
+
+        if admit is not None:
+            admit()
+        response = self.client.chat.completions.create(
+            model=model,
+            messages=prompt,
+            operation="lookup",
+            **LOOKUP_PARAMS
+        )
+        answer = json.loads(response.choices[0].message.content)
+        entry = {
+            "word": str(answer.get("word") or word),
+            "pos": str(answer.get("pos") or ""),
+            "translations": [str(t) for t in answer.get("translations") or []],
+        }
+        llm_cache.put(key, entry)
+        return entry
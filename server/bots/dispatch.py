@@ -0,0 +1,275 @@
+"""Speculative dispatch of chat turns.
+
+Routing a turn the local rules are unsure about means asking IntentBot
+first and only then generating the answer: two LLM round trips in series.
+Most of those turns turn out to be plain conversation, so in speculative
+mode the `conversation` answer is started at the same time as the intent
+call. If the classifier agrees, the answer is already on its way; if it
+picks grammar or confused, the speculative stream is closed and the right
+bot answers instead.
+
+The speculative answer is buffered until the intent is known, so the
+client never sees text from a prompt that was not chosen.
+
+Once the intent is known, the model policy picks the model that answers
+(see model_policy.py); the choice is reported in the turn's routing.
+
+If the intent call fails (a timeout or an upstream error), the turn goes
+ahead with the local rules' guess instead of failing: a speculative answer
+that is already streaming is kept when the guess is conversation. The
+routing source is then "local_fallback".
+"""
+import asyncio
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bots.intent_router import INTENTS
+from bots.model_policy import model_policy
+from bots.system_prompts import get_system_message
+from logs import get_logger
+from metrics import metrics
+
+log = get_logger("dispatch")
+
+_DONE = object()
+
+
+class Turn:
+    """Which bot answered a chat turn, and how the turn was routed"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.routing = None
+        # (confidence, seconds) from the local rules
+        self.local = None
+        # The local rules' intent, used if IntentBot can't be asked
+        self.guess = None
+
+    @property
+    def response(self):
+        # The streaming calls append the assembled reply to their bot's messages
+        return self.bot.messages[-1]["content"]
+
+
+class TurnDispatcher:
+    """Routes a turn with an IntentRouter and gets the answer, speculatively when the rules are unsure"""
+
+    def __init__(self, router, speculative=None, max_workers=None):
+        self.router = router
+        if speculative is None:
+            speculative = os.getenv("SPECULATIVE_DISPATCH", "1") == "1"
+        self.speculative = speculative
+        # Threads streaming speculative answers for the Flask server
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers or int(os.getenv("SPECULATIVE_THREADS", "32")),
+            thread_name_prefix="speculative",
+        )
+
+    def _classify(self, turn):
+        """Route from the local rules alone. Returns the system message, or None when the LLM must decide."""
+        bot = turn.bot
+        intent, confidence, local_seconds, confident = self.router.classify(bot.messages, bot.user_background)
+        turn.local = (confidence, local_seconds)
+        turn.guess = intent
+        if confident:
+            turn.routing = self.router.record(intent, confidence, "local", local_seconds)
+            return self._prepare(turn)
+        return None
+
+    def _resolve(self, turn, intent, fallback_seconds, speculation=None, choice=None, source="llm"):
+        confidence, local_seconds = turn.local
+        turn.routing = self.router.record(intent, None, source, local_seconds, fallback_seconds, speculation)
+        return self._prepare(turn, choice)
+
+    def _detect(self, turn, client):
+        """Ask IntentBot. Returns (intent, seconds, source); the local guess if the call fails."""
+        start = time.perf_counter()
+        try:
+            return (*self.router.detect(turn.bot.messages, client), "llm")
+        except Exception as e:
+            return self._detect_failed(turn, start, e)
+
+    async def _detect_async(self, turn, client):
+        """_detect() for an AsyncOpenAI client"""
+        start = time.perf_counter()
+        try:
+            return (*await self.router.detect_async(turn.bot.messages, client), "llm")
+        except Exception as e:
+            return self._detect_failed(turn, start, e)
+
+    @staticmethod
+    def _detect_failed(turn, start, error):
+        # The answer doesn't need the classifier; routing on the guess beats failing the turn
+        metrics.inc("intent_detect_failures_total")
+        log.warning("intent.detect_failed", error=repr(error), fallback=turn.guess)
+        return turn.guess or "conversation", time.perf_counter() - start, "local_fallback"
+
+    @staticmethod
+    def _select(bot, intent):
+        return model_policy.select(intent, bot.user_background.get("skill_level"))
+
+    def _prepare(self, turn, choice=None):
+        """Set the answering bot's model for the routed intent and return its system message"""
+        intent = turn.routing["intent"]
+        choice = choice or self._select(turn.bot, intent)
+        turn.bot.model = choice["model"]
+        turn.routing.update(model=choice["model"], tier=choice["tier"], model_reason=choice["reason"])
+        return get_system_message(intent)
+
+    def answer(self, bot, client):
+        """Answer the latest user message. Returns (reply, turn)."""
+        turn = Turn(bot)
+        system_message = self._classify(turn)
+        if system_message is None and self.speculative:
+            return "".join(self._speculate(turn, client)), turn
+
+        if system_message is None:
+            intent, seconds, source = self._detect(turn, client)
+            system_message = self._resolve(turn, intent, seconds, source=source)
+        return bot.ask_openai(system_message), turn
+
+    def stream(self, bot, client, turn=None):
+        """Yield the answer to the latest user message as it arrives.
+
+        Pass a Turn to find out afterwards which bot answered and how the
+        turn was routed.
+        """
+        turn = turn or Turn(bot)
+        turn.bot = bot
+        system_message = self._classify(turn)
+        if system_message is None and self.speculative:
+            yield from self._speculate(turn, client)
+            return
+
+        if system_message is None:
+            intent, seconds, source = self._detect(turn, client)
+            system_message = self._resolve(turn, intent, seconds, source=source)
+        yield from bot.ask_openai_stream(system_message)
+
+    def _speculate(self, turn, client):
+        bot = turn.bot
+        speculative = bot.fork()
+        choice = self._select(bot, "conversation")
+        speculative.model = choice["model"]
+        deltas = queue.Queue()
+        cancelled = threading.Event()
+
+        def pump():
+            answer = speculative.ask_openai_stream(get_system_message("conversation"))
+            try:
+                for delta in answer:
+                    if cancelled.is_set():
+                        break
+                    deltas.put(delta)
+            except Exception as e:
+                deltas.put(e)
+            finally:
+                # Closing the generator closes the HTTP stream, even mid-answer
+                answer.close()
+                deltas.put(_DONE)
+
+        self._executor.submit(pump)
+        try:
+            intent, fallback_seconds, source = self._detect(turn, client)
+        except BaseException:
+            # Interrupted, e.g. the client went away
+            cancelled.set()
+            raise
+
+        if intent in INTENTS and intent != "conversation":
+            cancelled.set()
+            system_message = self._resolve(turn, intent, fallback_seconds, "miss", source=source)
+            yield from bot.ask_openai_stream(system_message)
+            return
+
+        turn.bot = speculative
+        self._resolve(turn, intent, fallback_seconds, "hit", choice, source)
+        try:
+            while True:
+                delta = deltas.get()
+                if delta is _DONE:
+                    return
+                if isinstance(delta, Exception):
+                    raise delta
+                yield delta
+        finally:
+            # Client went away: stop the upstream stream too
+            cancelled.set()
+
+    async def answer_async(self, bot, client):
+        """answer() for an AsyncOpenAI client"""
+        turn = Turn(bot)
+        system_message = self._classify(turn)
+        if system_message is None and self.speculative:
+            return "".join([delta async for delta in self._speculate_async(turn, client)]), turn
+
+        if system_message is None:
+            intent, seconds, source = await self._detect_async(turn, client)
+            system_message = self._resolve(turn, intent, seconds, source=source)
+        return await bot.ask_openai_async(system_message), turn
+
+    async def stream_async(self, bot, client, turn=None):
+        """stream() for an AsyncOpenAI client"""
+        turn = turn or Turn(bot)
+        turn.bot = bot
+        system_message = self._classify(turn)
+        if system_message is None and self.speculative:
+            async for delta in self._speculate_async(turn, client):
+                yield delta
+            return
+
+        if system_message is None:
+            intent, seconds, source = await self._detect_async(turn, client)
+            system_message = self._resolve(turn, intent, seconds, source=source)
+        async for delta in bot.ask_openai_stream_async(system_message):
+            yield delta
+
+    async def _speculate_async(self, turn, client):
+        bot = turn.bot
+        speculative = bot.fork()
+        choice = self._select(bot, "conversation")
+        speculative.model = choice["model"]
+        deltas = asyncio.Queue()
+
+        async def pump():
+            try:
+                async for delta in speculative.ask_openai_stream_async(get_system_message("conversation")):
+                    await deltas.put(delta)
+            except Exception as e:
+                await deltas.put(e)
+            finally:
+                await deltas.put(_DONE)
+
+        task = asyncio.create_task(pump())
+        try:
+            intent, fallback_seconds, source = await self._detect_async(turn, client)
+        except BaseException:
+            # Cancelled, e.g. the client went away
+            task.cancel()
+            raise
+
+        if intent in INTENTS and intent != "conversation":
+            task.cancel()
+            system_message = self._resolve(turn, intent, fallback_seconds, "miss", source=source)
+            async for delta in bot.ask_openai_stream_async(system_message):
+                yield delta
+            return
+
+        turn.bot = speculative
+        self._resolve(turn, intent, fallback_seconds, "hit", choice, source)
+        try:
+            while True:
+                delta = await deltas.get()
+                if delta is _DONE:
+                    return
+                if isinstance(delta, Exception):
+                    raise delta
+                yield delta
+        finally:
+            task.cancel()
+
+
+metrics.describe("intent_detect_failures_total", "IntentBot calls that failed, so the turn was routed by the local guess")
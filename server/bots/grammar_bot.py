@@ -1,6 +1,41 @@
+import time
+
 from bots.base_bot import BaseBot  # 👈 Import BaseBot
+from bots.model_policy import model_policy
+from bots.system_prompts import LANGUAGE_NAMES
+from metrics import metrics
+
+FEEDBACK_PROMPT = """You check a language learner's message in {target} for mistakes.
+If it has none, answer exactly: OK
+Otherwise answer with the corrected message on the first line, then one or two short sentences in {native} explaining the main mistakes. Don't continue the conversation."""
 
 class GrammarBot(BaseBot):
     def get_response(self):
         system_msg = "You are a helpful grammar tutor. Answer clearly and simply."
-        return self.ask_openai(system_msg)
\ No newline at end of file
+        return self.ask_openai(system_msg)
+
+    def get_feedback(self):
+        """Corrections for the learner's last message: {"ok": True} or {"ok": False, "corrected", "explanation"}"""
+        target = self.user_background.get('target_lang', 'es')
+        native = self.user_background.get('native_lang', 'en')
+        system_msg = FEEDBACK_PROMPT.format(
+            target=LANGUAGE_NAMES.get(target, target), native=LANGUAGE_NAMES.get(native, native)
+        )
+        text = next((m["content"] for m in reversed(self.messages) if m["role"] == "user"), "")
+        # Just the instructions and the message: no chat history, personalization or
+        # closing instruction, which would ask the model to keep the conversation going
+        prompt = [{"role": "system", "content": system_msg}, {"role": "user", "content": text}]
+        start = time.perf_counter()
+        with metrics.span("llm.call", model=self.model):
+            response = self.client.chat.completions.create(
+                model=self.model,
+                messages=prompt,
+                operation="feedback"
+            )
+        model_policy.observe(self.model, "call", time.perf_counter() - start)
+        self.record_usage(response.usage)
+        answer = (response.choices[0].message.content or "").strip()
+        if answer.rstrip('.').upper() == 'OK':
+            return {"ok": True}
+        corrected, _, explanation = answer.partition('\n')
+        return {"ok": False, "corrected": corrected.strip(), "explanation": explanation.strip()}
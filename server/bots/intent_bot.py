@@ -1,7 +1,18 @@
+import os
+
 from bots.base_bot import BaseBot  # 👈 Import BaseBot
+from bots.llm_cache import llm_cache
+from bots.model_policy import model_policy
+from upstream import timeout
+
+# The answer is one word, so a slow classifier call is cut short and retried
+CLASSIFY_TIMEOUT = timeout(read=float(os.getenv("INTENT_READ_TIMEOUT", "5")))
+
+# temperature 0 makes the label a function of the prompt, so it is memoized
+INTENT_PARAMS = {"temperature": 0}
 
 class IntentBot(BaseBot):
-    def detect_intent(self, conversation):
+    def build_intent_prompt(self, conversation):
         intent_prompt = [
     {
         "role": "system",
@@ -26,13 +37,43 @@ class IntentBot(BaseBot):
     )
 })
 
+        return intent_prompt
+
+    def detect_intent(self, conversation):
+        prompt = self.build_intent_prompt(conversation)
+        model = model_policy.select("intent")["model"]
+        key = llm_cache.key(model, INTENT_PARAMS, prompt)
+        intent = llm_cache.get(key, "intent")
+        if intent is not None:
+            return intent
 
         response = self.client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=intent_prompt,
-            temperature = 0
+            model=model,
+            messages=prompt,
+            timeout=CLASSIFY_TIMEOUT,
+            operation="intent",
+            **INTENT_PARAMS
         )
-        intent = response.choices[0].message.content.strip().lower()
+        intent = response.choices[0].message.content.strip().lower().strip(".!")
+        llm_cache.put(key, intent)
         return intent
 
+    async def detect_intent_async(self, conversation):
+        """detect_intent for an AsyncOpenAI client"""
+        prompt = self.build_intent_prompt(conversation)
+        model = model_policy.select("intent")["model"]
+        key = llm_cache.key(model, INTENT_PARAMS, prompt)
+        intent = llm_cache.get(key, "intent")
+        if intent is not None:
+            return intent
 
+        response = await self.client.chat.completions.create(
+            model=model,
+            messages=prompt,
+            timeout=CLASSIFY_TIMEOUT,
+            operation="intent",
+            **INTENT_PARAMS
+        )
+        intent = response.choices[0].message.content.strip().lower().strip(".!")
+        llm_cache.put(key, intent)
+        return intent
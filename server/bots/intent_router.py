@@ -0,0 +1,211 @@
+import os
+import re
+import threading
+import time
+
+from bots.intent_bot import IntentBot
+from metrics import metrics
+
+INTENTS = ("conversation", "grammar", "confused")
+
+# Phrases that give the intent away, per language. Learners mix their native
+# and target languages, so rules for both (plus English) are checked.
+INTENT_RULES = {
+    "en": {
+        "grammar": [
+            r"\bgrammar\b", r"\bconjugat", r"\btenses?\b", r"\bsubjunctive\b", r"\bplural\b",
+            r"\bhow (do|would|can) (i|you) say\b", r"\bwhat does .+ mean\b", r"\bwhat is the meaning of\b",
+            r"\bdifference between\b", r"\bis (it|this|that) correct\b", r"\bcorrect (me|my)\b",
+            r"\bwhen (do|should) (i|you) use\b", r"\bwhy is it\b", r"\b(masculine|feminine)\b",
+            r"\b(verb|noun|adjective|preposition|article)s?\b",
+        ],
+        "confused": [
+            r"\bi (do not|don't|dont) (understand|get it)\b", r"\bi'?m (confused|lost)\b",
+            r"\bwhat do you mean\b", r"\b(can|could) you (repeat|say that again)\b",
+            r"\b(slower|more slowly)\b", r"^\s*(what|huh|sorry|pardon)\s*\?*\s*$",
+        ],
+    },
+    "es": {
+        "grammar": [
+            r"\bgramátic", r"\bconjuga", r"\bsubjuntivo\b", r"\bc[oó]mo se dice\b", r"\bqu[eé] significa\b",
+            r"\bqu[eé] quiere decir\b", r"\bdiferencia entre\b", r"\bes correcto\b", r"\bse dice\b",
+            r"\b(cu[aá]ndo|por qu[eé]) se usa\b", r"\bpret[eé]rito\b", r"\bser (o|y) estar\b", r"\bpor (o|y) para\b",
+        ],
+        "confused": [
+            r"\bno (entiendo|comprendo|te entiendo)\b", r"\bestoy (confundid[oa]|perdid[oa])\b",
+            r"\brepite\b", r"\bm[aá]s despacio\b", r"^\s*¿?\s*(qu[eé]|c[oó]mo)\s*\?\s*$",
+        ],
+    },
+    "fr": {
+        "grammar": [
+            r"\bgrammaire\b", r"\bconjug", r"\bsubjonctif\b", r"\bcomment (dit-on|on dit)\b",
+            r"\b(que|qu'est-ce que) veut dire\b", r"\bdiff[ée]rence entre\b", r"\bc'est correct\b",
+            r"\bpass[ée] compos[ée]\b", r"\b(masculin|f[ée]minin)\b",
+        ],
+        "confused": [
+            r"\bje (ne )?comprends pas\b", r"\bje suis (perdu|confus)", r"\br[ée]p[èe]te", r"\bplus lentement\b",
+            r"^\s*(pardon|quoi|comment)\s*\?\s*$",
+        ],
+    },
+    "de": {
+        "grammar": [
+            r"\bgrammatik\b", r"\bkonjug", r"\bwie sagt man\b", r"\bwas bedeutet\b", r"\bunterschied zwischen\b",
+            r"\bist (das|es) richtig\b", r"\b(dativ|akkusativ|genitiv)\b", r"\bder,? die (oder|und) das\b",
+        ],
+        "confused": [
+            r"\bich verstehe (das )?nicht\b", r"\bwie bitte\b", r"\bnoch ?mal\b", r"\blangsamer\b",
+            r"\bich bin verwirrt\b",
+        ],
+    },
+    "it": {
+        "grammar": [
+            r"\bgrammatica\b", r"\bconiug", r"\bcongiuntivo\b", r"\bcome si dice\b",
+            r"\b(cosa|che) (vuol dire|significa)\b", r"\bdifferenza tra\b", r"\b[eè] corretto\b",
+        ],
+        "confused": [
+            r"\bnon (capisco|ho capito)\b", r"\bpuoi ripetere\b", r"\bpi[uù] lentamente\b",
+            r"\bsono confus[oa]\b", r"^\s*come\s*\?\s*$",
+        ],
+    },
+    "zh": {
+        "grammar": [r"语法", r"怎么说", r".+是什么意思", r"有什么区别", r"对不对", r"用法"],
+        "confused": [r"不明白", r"不懂", r"听不懂", r"再说一遍", r"慢一点", r"^\s*什么意思\s*[？?]?\s*$"],
+    },
+}
+
+_COMPILED_RULES = {
+    lang: {intent: re.compile("|".join(patterns), re.IGNORECASE) for intent, patterns in rules.items()}
+    for lang, rules in INTENT_RULES.items()
+}
+
+
+def classify_locally(message, languages=("en",)):
+    """Guess the intent of a learner's message from keyword rules.
+
+    Returns (intent, confidence). A message that matches exactly one
+    intent's rules is classified with high confidence; one that matches
+    both, or a bare short question, is left to the LLM.
+    """
+    matched = []
+    for lang in dict.fromkeys(languages):
+        rules = _COMPILED_RULES.get(lang)
+        if not rules:
+            continue
+        for intent, pattern in rules.items():
+            if intent not in matched and pattern.search(message):
+                matched.append(intent)
+
+    if len(matched) == 1:
+        return matched[0], 0.9
+    if len(matched) > 1:
+        return matched[0], 0.5
+
+    # Quoted words and very short questions are often about the language itself
+    words = message.split()
+    if re.search(r"[\"“”«»]", message) or (len(words) <= 3 and message.rstrip().endswith(("?", "？"))):
+        return "conversation", 0.5
+    return "conversation", 0.8
+
+
+class RouterStats:
+    """Counters for how turns were routed and how long routing took"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.routed = 0
+        self.fallbacks = 0
+        self.local_seconds = 0.0
+        self.fallback_seconds = 0.0
+        self.by_intent = {intent: 0 for intent in INTENTS}
+        # Speculative turns whose answer was used / thrown away
+        self.speculation = {"hit": 0, "miss": 0}
+
+    def record(self, intent, local_seconds, fallback_seconds=None, speculation=None):
+        with self._lock:
+            self.routed += 1
+            self.by_intent[intent] += 1
+            self.local_seconds += local_seconds
+            if fallback_seconds is not None:
+                self.fallbacks += 1
+                self.fallback_seconds += fallback_seconds
+            if speculation:
+                self.speculation[speculation] += 1
+
+    def snapshot(self):
+        with self._lock:
+            routed = self.routed or 1
+            return {
+                "routed": self.routed,
+                "fallbacks": self.fallbacks,
+                "fallback_rate": self.fallbacks / routed,
+                "local_ms_avg": 1000 * self.local_seconds / routed,
+                "fallback_ms_avg": 1000 * self.fallback_seconds / (self.fallbacks or 1),
+                "routing_ms_avg": 1000 * (self.local_seconds + self.fallback_seconds) / routed,
+                "by_intent": dict(self.by_intent),
+                "speculation": dict(self.speculation),
+            }
+
+
+class IntentRouter:
+    """Picks the system prompt for a turn: local rules first, IntentBot when they're unsure"""
+
+    def __init__(self, threshold=None, context_messages=None):
+        self.threshold = threshold or float(os.getenv("INTENT_CONFIDENCE_THRESHOLD", "0.7"))
+        # How much of the conversation the LLM fallback sees
+        self.context_messages = context_messages or int(os.getenv("INTENT_CONTEXT_MESSAGES", "1"))
+        self.stats = RouterStats()
+
+    def classify(self, messages, user_background):
+        """Run the local rules. Returns (intent, confidence, seconds, confident)."""
+        message = messages[-1]["content"] if messages else ""
+        languages = (user_background.get("target_lang"), user_background.get("native_lang"), "en")
+        start = time.perf_counter()
+        intent, confidence = classify_locally(message, languages)
+        return intent, confidence, time.perf_counter() - start, confidence >= self.threshold
+
+    def detect(self, messages, client):
+        """Ask IntentBot. Returns (intent, seconds)."""
+        start = time.perf_counter()
+        with metrics.span("intent.detect"):
+            intent = IntentBot(messages, client).detect_intent(messages[-self.context_messages:])
+        return intent, time.perf_counter() - start
+
+    async def detect_async(self, messages, client):
+        """detect() for an AsyncOpenAI client"""
+        start = time.perf_counter()
+        with metrics.span("intent.detect"):
+            intent = await IntentBot(messages, client).detect_intent_async(messages[-self.context_messages:])
+        return intent, time.perf_counter() - start
+
+    def record(self, intent, confidence, source, local_seconds, fallback_seconds=None, speculation=None):
+        """Count a routing decision and return it as reported to the client"""
+        if intent not in INTENTS:
+            intent = "conversation"
+        self.stats.record(intent, local_seconds, fallback_seconds, speculation)
+        routing = {
+            "intent": intent,
+            "confidence": confidence,
+            "source": source,
+            "ms": 1000 * (local_seconds + (fallback_seconds or 0)),
+        }
+        if speculation:
+            routing["speculation"] = speculation
+        return routing
+
+    def route(self, messages, user_background, client):
+        """Return the routing decision for the latest user message"""
+        intent, confidence, local_seconds, confident = self.classify(messages, user_background)
+        if confident:
+            return self.record(intent, confidence, "local", local_seconds)
+
+        intent, fallback_seconds = self.detect(messages, client)
+        return self.record(intent, None, "llm", local_seconds, fallback_seconds)
+
+    async def route_async(self, messages, user_background, client):
+        """route() for an AsyncOpenAI client"""
+        intent, confidence, local_seconds, confident = self.classify(messages, user_background)
+        if confident:
+            return self.record(intent, confidence, "local", local_seconds)
+
+        intent, fallback_seconds = await self.detect_async(messages, client)
+        return self.record(intent, None, "llm", local_seconds, fallback_seconds)
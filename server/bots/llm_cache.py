@@ -0,0 +1,181 @@
+"""Memoized results of deterministic LLM calls.
+
+A temperature 0 call gives the same answer for the same model, parameters
+and messages, so there is no need to pay a round trip twice. IntentBot
+sees only the last user message by default, and short phrases like "I
+don't understand" recur across learners, so classifications hit often.
+
+Results are keyed by a hash of the model, the parameters and the
+normalized messages (Unicode NFC, whitespace collapsed). Entries expire
+after LLM_CACHE_TTL seconds, and the least recently used ones are
+evicted past LLM_CACHE_SIZE entries. LLM_CACHE selects the backend:
+
+- memory (the default with SHARED_STATE=local): an LRU dict in each worker
+- sqlite (the default with SHARED_STATE=sqlite): a table in LLM_CACHE_DB,
+  shared by all workers on the host, so a miss in one is a hit in the rest
+- off
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from metrics import metrics
+from startup import Lazy
+
+# Clean up expired and excess rows at most this often (seconds)
+SQLITE_PRUNE_INTERVAL = 60
+
+
+def normalize_messages(messages):
+    """Messages reduced to what affects a deterministic answer"""
+    return [
+        [message["role"], " ".join(unicodedata.normalize("NFC", str(message.get("content") or "")).split())]
+        for message in messages
+    ]
+
+
+def cache_key(model, params, messages):
+    payload = json.dumps(
+        {"model": model, "params": params, "messages": normalize_messages(messages)},
+        sort_keys=True, separators=(",", ":"), ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class MemoryBackend:
+    """Per-process LRU with expiry"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteBackend:
+    """LRU with expiry in a SQLite table, shared by the workers on a host"""
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._last_prune = 0
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " expires_at REAL NOT NULL,"
+            " used_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_used ON llm_cache (used_at)")
+
+    @property
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        now = time.time()
+        row = self._conn.execute(
+            "SELECT value FROM llm_cache WHERE key = ? AND expires_at >= ?", (key, now)
+        ).fetchone()
+        if row is None:
+            return None
+        self._conn.execute("UPDATE llm_cache SET used_at = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def put(self, key, value, ttl):
+        now = time.time()
+        self._conn.execute(
+            "INSERT OR REPLACE INTO llm_cache (key, value, expires_at, used_at) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value), now + ttl, now)
+        )
+        if now - self._last_prune > SQLITE_PRUNE_INTERVAL:
+            self._last_prune = now
+            self._prune(now)
+
+    def _prune(self, now):
+        conn = self._conn
+        conn.execute("DELETE FROM llm_cache WHERE expires_at < ?", (now,))
+        conn.execute(
+            "DELETE FROM llm_cache WHERE key IN ("
+            " SELECT key FROM llm_cache ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+
+
+class LLMCache:
+    """get()/put() by cache_key(), counting hits and misses per operation"""
+
+    def __init__(self, backend, ttl):
+        self.backend = backend
+        self.ttl = ttl
+
+    key = staticmethod(cache_key)
+
+    def get(self, key, operation):
+        """The cached result, or None"""
+        if self.backend is None:
+            return None
+        value = self.backend.get(key)
+        metrics.inc("llm_cache_requests_total", operation=operation, result="miss" if value is None else "hit")
+        return value
+
+    def put(self, key, value):
+        if self.backend is not None and value is not None:
+            self.backend.put(key, value, self.ttl)
+
+
+def open_llm_cache():
+    """The cache configured by LLM_CACHE, LLM_CACHE_TTL, LLM_CACHE_SIZE and LLM_CACHE_DB"""
+    # Workers that share state share the cache too
+    backend = os.getenv("LLM_CACHE", "sqlite" if os.getenv("SHARED_STATE") == "sqlite" else "memory")
+    max_entries = int(os.getenv("LLM_CACHE_SIZE", "10000"))
+    if backend == "sqlite":
+        store = SQLiteBackend(os.getenv("LLM_CACHE_DB", "llm_cache.db"), max_entries)
+    elif backend == "memory":
+        store = MemoryBackend(max_entries)
+    elif backend == "off":
+        store = None
+    else:
+        raise ValueError(f"Unknown LLM_CACHE backend: {backend}")
+    return LLMCache(store, ttl=float(os.getenv("LLM_CACHE_TTL", "86400")))
+
+
+# Opened on first use, so importing this module doesn't touch LLM_CACHE_DB
+llm_cache = Lazy("llm_cache", open_llm_cache)
+metrics.describe("llm_cache_requests_total", "Deterministic LLM calls answered from the cache, or not")
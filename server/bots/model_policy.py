@@ -0,0 +1,129 @@
+"""Which model answers a turn.
+
+Turns go to one of two tiers: "fast" (MODEL_FAST, gpt-4o-mini by default)
+or "capable" (MODEL_CAPABLE, gpt-4o). The tier is looked up by intent and
+the learner's skill_level. MODEL_POLICY can override the table with JSON
+in the same shape as DEFAULT_POLICY:
+
+    MODEL_POLICY='{"grammar": {"default": "capable"}, "conversation": {"default": "fast", "advanced": "capable"}}'
+
+Latency is tracked per model: time to first token for streamed replies,
+and the whole call otherwise. If the p95 of the capable model goes over
+its SLO (MODEL_SLO_FIRST_TOKEN_MS / MODEL_SLO_CALL_MS), its turns go to
+the fast tier for MODEL_SLO_COOLDOWN seconds. After that it is measured
+afresh. The step down is kept in shared_state, so every worker takes it
+as soon as one sees the breach.
+"""
+import json
+import os
+import threading
+import time
+from collections import deque
+
+from metrics import metrics
+from shared_state import shared_state
+
+TIERS = {
+    "fast": os.getenv("MODEL_FAST", "gpt-4o-mini"),
+    "capable": os.getenv("MODEL_CAPABLE", "gpt-4o"),
+}
+FALLBACK_TIER = "fast"
+
+# intent (or internal call) -> skill_level -> tier, with "default" for other levels
+DEFAULT_POLICY = {
+    "conversation": {"default": "fast", "advanced": "capable"},
+    "grammar": {"default": "capable"},
+    "confused": {"default": "fast", "beginner": "capable"},
+    "intent": {"default": "fast"},
+    "summary": {"default": "fast"},
+    # Grammar feedback, run as a background job after the reply
+    "feedback": {"default": "fast"},
+    # Words missing from the local dictionaries
+    "lookup": {"default": "fast"},
+    # Offline batch job (generate_readings.py), where quality beats latency
+    "reading": {"default": "capable"},
+}
+
+# Seconds
+SLO = {
+    "first_token": float(os.getenv("MODEL_SLO_FIRST_TOKEN_MS", "1500")) / 1000,
+    "call": float(os.getenv("MODEL_SLO_CALL_MS", "6000")) / 1000,
+}
+SLO_COOLDOWN = float(os.getenv("MODEL_SLO_COOLDOWN", "60"))
+SLO_WINDOW = 50
+# Observations needed before the p95 is judged
+SLO_MIN_SAMPLES = 10
+
+
+def load_policy():
+    policy = {intent: dict(levels) for intent, levels in DEFAULT_POLICY.items()}
+    override = os.getenv("MODEL_POLICY")
+    if override:
+        for intent, levels in json.loads(override).items():
+            policy.setdefault(intent, {}).update(levels)
+    for intent, levels in policy.items():
+        for level, tier in levels.items():
+            if tier not in TIERS:
+                raise ValueError(f"MODEL_POLICY: unknown tier {tier!r} for {intent}/{level}")
+    return policy
+
+
+class ModelPolicy:
+    """Picks a model per turn and steps down a tier while a model is over its latency SLO"""
+
+    def __init__(self, tiers=TIERS, policy=None, slo=SLO, cooldown=SLO_COOLDOWN, state=None):
+        self.tiers = tiers
+        self.policy = policy or load_policy()
+        self.slo = slo
+        self.cooldown = cooldown
+        # model -> time until which it is skipped, expiring with the cooldown
+        self.state = state or shared_state
+        self._lock = threading.Lock()
+        self._latency = {}
+
+    def select(self, intent, skill_level=None):
+        """Return {"model", "tier", "reason"} for a turn"""
+        levels = self.policy.get(intent) or self.policy["conversation"]
+        tier = levels.get(skill_level) or levels.get("default", FALLBACK_TIER)
+        reason = "policy"
+        if tier != FALLBACK_TIER and self.degraded(self.tiers[tier]):
+            tier, reason = FALLBACK_TIER, "slo"
+        model = self.tiers[tier]
+        metrics.inc("model_selected_total", model=model, tier=tier, reason=reason)
+        return {"model": model, "tier": tier, "reason": reason}
+
+    def degraded(self, model):
+        return self.state.get('model_degraded', model) is not None
+
+    def observe(self, model, kind, seconds):
+        """Record a latency ("first_token" or "call") and check it against the SLO"""
+        with self._lock:
+            samples = self._latency.get((model, kind))
+            if samples is None:
+                samples = self._latency[(model, kind)] = deque(maxlen=SLO_WINDOW)
+            samples.append(seconds)
+            if len(samples) < SLO_MIN_SAMPLES:
+                return
+            ordered = sorted(samples)
+            p95 = ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))]
+            if p95 <= self.slo[kind]:
+                return
+            # Judge the model on fresh samples once the cooldown is over
+            samples.clear()
+        # Another worker may have stepped it down already
+        if self.state.add('model_degraded', model, time.time() + self.cooldown, ttl=self.cooldown):
+            metrics.inc("model_slo_breaches_total", model=model, kind=kind)
+
+    def snapshot(self):
+        now = time.time()
+        remaining = {}
+        for model in set(self.tiers.values()):
+            until = self.state.get('model_degraded', model)
+            if until is not None and until > now:
+                remaining[model] = round(until - now, 1)
+        return remaining
+
+
+model_policy = ModelPolicy()
+metrics.describe("model_selected_total", "Model chosen per call, by tier and reason (policy or SLO fallback)")
+metrics.describe("model_slo_breaches_total", "Times a model's p95 latency went over its SLO")
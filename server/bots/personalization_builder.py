@@ -3,11 +3,7 @@ def build_personalization_context(user_background):
     Build a natural language context from user background and personalization data.
     Returns a string to be added to the system prompt.
     """
-    print(f"=== PERSONALIZATION BUILDER ===")
-    print(f"Received user_background: {user_background}")
-    
     if not user_background:
-        print("No user_background provided")
         return ""
     
     context_parts = []
@@ -20,7 +16,6 @@ def build_personalization_context(user_background):
     
     # Add personalization if available
     if 'personalization' in user_background and user_background['personalization']:
-        print(f"Found personalization: {user_background['personalization']}")
         personalization = user_background['personalization']
         
         # Filter out empty or "no" responses
@@ -41,9 +36,5 @@ def build_personalization_context(user_background):
             context_parts.append(f"{meaningful_data}")
             context_parts.append("")
             context_parts.append("Use this information naturally in conversation when relevant, but don't force it.")
-    else:
-        print("No personalization in user_background")
-    
-    result = "\n".join(context_parts)
-    print(f"Built context: {result}")
-    return result
\ No newline at end of file
+
+    return "\n".join(context_parts)
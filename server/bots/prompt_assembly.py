@@ -0,0 +1,98 @@
+"""Prompt assembly with a stable, shareable prefix.
+
+OpenAI caches the longest prompt prefix it has recently seen, so the
+prompt is laid out from most to least shared:
+
+    1. the intent's system prompt    (same for every user)
+    2. the user's personalization    (same for every turn of this user),
+       with the reminder to tailor replies to it
+    3. the summary of older turns    (changes every few turns)
+    4. the conversation              (grows by a turn each time)
+    5. the closing instruction
+
+The static system messages are built once per template, and the
+personalization block is memoized per user until /save_personalization
+invalidates it.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+from bots.personalization_builder import build_personalization_context
+from bots.system_prompts import SYSTEM_PROMPTS
+
+TAILOR_REMINDER = "Remember to tailor your responses to the user's skill level and interests."
+
+CLOSING_INSTRUCTION = {
+    "role": "user",
+    "content": "Use the target language wants to chat and use the native language if they have a grammar or vocabulary question. Remember to make your response short so I have a chance to speak more."
+}
+
+
+def compile_system_message(system_message):
+    return {"role": "system", "content": system_message}
+
+
+class PromptAssembler:
+    """Builds chat prompts from precompiled system messages and memoized user blocks"""
+
+    def __init__(self, max_users=None):
+        self.max_users = max_users or int(os.getenv("PROMPT_CACHE_USERS", "1024"))
+        self._templates = {text: compile_system_message(text) for text in SYSTEM_PROMPTS.values()}
+        # user_id -> (user_background it was built from, system message or None)
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+
+    def system_message(self, system_message):
+        """The static first message for a system prompt"""
+        compiled = self._templates.get(system_message)
+        if compiled is None:
+            # Bots with their own prompt text get compiled on first use
+            compiled = self._templates[system_message] = compile_system_message(system_message)
+        return compiled
+
+    def personalization(self, user_id, user_background):
+        """The user's personalization as a system message, or None if there is nothing to say"""
+        if user_id is None:
+            return self._build_personalization(user_background)
+
+        with self._lock:
+            entry = self._users.get(user_id)
+            # Comparing the background is much cheaper than rebuilding the text, and
+            # catches changes made by another worker that this one wasn't told about
+            if entry is not None and entry[0] == user_background:
+                self._users.move_to_end(user_id)
+                return entry[1]
+
+        message = self._build_personalization(user_background)
+        with self._lock:
+            self._users[user_id] = (dict(user_background), message)
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        return message
+
+    def _build_personalization(self, user_background):
+        context = build_personalization_context(user_background)
+        # The reminder only makes sense when there is something to tailor to
+        return {"role": "system", "content": f"{context}\n\n{TAILOR_REMINDER}"} if context else None
+
+    def invalidate(self, user_id):
+        """Forget a user's personalization block, e.g. after they save new preferences"""
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    def build(self, system_message, messages, user_id=None, user_background=None, summary=None):
+        """Return the message list for a chat completion"""
+        prompt = [self.system_message(system_message)]
+        personalization = self.personalization(user_id, user_background or {})
+        if personalization:
+            prompt.append(personalization)
+        if summary:
+            prompt.append({"role": "system", "content": f"Summary of the earlier conversation:\n{summary}"})
+        prompt += messages
+        prompt.append(CLOSING_INSTRUCTION)
+        return prompt
+
+
+prompt_assembler = PromptAssembler()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""Compile word lists into the memory-mapped dictionaries /lookup reads.
+
+Reads <from>-<to>.tsv word lists (word, translations separated by ";",
+part of speech) and writes <from>-<to>.dict files, plus the reverse pair
+for each list unless it has its own. The server rebuilds stale files from
+dictionary/sources when it starts; use this to compile larger lists, or
+into another directory (DICTIONARY_DIR).
+
+    python build_dictionary.py
+    python build_dictionary.py --sources ~/wordlists --out /srv/dictionary --pairs es-en,en-es
+    python build_dictionary.py --check
+
+Files are replaced atomically, so running servers switch to them within
+DICTIONARY_REFRESH seconds without a restart.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+from dictionary import DICTIONARY_DIR, Dictionary, build_all
+
+
+def check(path, samples=2000):
+    """Entry count, size and average lookup time of a compiled file"""
+    dictionary = Dictionary(path)
+    words = [dictionary._entry(position)['word'] for position in range(len(dictionary))]
+    queries = [random.choice(words) for _ in range(samples)] if words else []
+    start = time.perf_counter()
+    for word in queries:
+        if dictionary.lookup(word) is None:
+            raise ValueError(f'{path}: {word!r} is listed but not found')
+    seconds = time.perf_counter() - start
+    return {
+        "entries": len(dictionary),
+        "bytes": os.path.getsize(path),
+        "lookup_us": round(seconds / len(queries) * 1e6, 2) if queries else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile bilingual word lists into .dict files")
+    parser.add_argument("--sources", default=os.path.join(DICTIONARY_DIR, "sources"),
+                        help="directory of <from>-<to>.tsv word lists")
+    parser.add_argument("--out", default=DICTIONARY_DIR, help="where to write the .dict files")
+    parser.add_argument("--pairs", help="comma-separated pairs to build, like es-en (default: all)")
+    parser.add_argument("--no-reverse", action="store_true", help="don't build reversed pairs")
+    parser.add_argument("--check", action="store_true", help="time lookups in every file written")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.sources):
+        sys.exit(f"No word lists in {args.sources}")
+    os.makedirs(args.out, exist_ok=True)
+    pairs = [pair.strip() for pair in args.pairs.split(",")] if args.pairs else None
+
+    start = time.perf_counter()
+    written = build_all(args.sources, args.out, pairs=pairs, reverse_lists=not args.no_reverse)
+    report = {"pairs": written, "seconds": round(time.perf_counter() - start, 2), "out": args.out}
+    if args.check:
+        report["check"] = {pair: check(os.path.join(args.out, f"{pair}.dict")) for pair in written}
+    print(json.dumps(report, indent=2 if args.check else None))
+    if not written:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""Server-side conversation storage.
+
+Chat history used to live in Flask's signed cookie, which was re-signed and
+re-sent on every request and overflowed the ~4KB cookie limit after a few
+turns. The cookie now only carries a session id; turns are stored here as
+append-only rows, and per-session state (user background, personalization)
+sits next to them as a small JSON document.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+# Idle sessions are purged at most this often (seconds)
+PURGE_INTERVAL = 3600
+
+
+class ConversationStore:
+    """SQLite-backed conversation turns and session state, keyed by session id"""
+
+    def __init__(self, path, max_idle=86400):
+        self.path = path
+        self.max_idle = max_idle
+        self._local = threading.local()
+        self._last_purge = 0
+        conn = self._conn
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS sessions ('
+            ' session_id TEXT PRIMARY KEY,'
+            ' user_id TEXT,'
+            ' turn_count INTEGER NOT NULL DEFAULT 0,'
+            ' state TEXT NOT NULL,'
+            ' created_at REAL NOT NULL,'
+            ' updated_at REAL NOT NULL)'
+        )
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS turns ('
+            ' session_id TEXT NOT NULL,'
+            ' seq INTEGER NOT NULL,'
+            ' role TEXT NOT NULL,'
+            ' content TEXT NOT NULL,'
+            ' created_at REAL NOT NULL,'
+            ' tokens INTEGER,'
+            ' PRIMARY KEY (session_id, seq))'
+        )
+        # Databases created before token counts were cached
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(turns)')]
+        if 'tokens' not in columns:
+            conn.execute('ALTER TABLE turns ADD COLUMN tokens INTEGER')
+        conn.execute('CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated_at)')
+
+    @property
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def new_session(self, user_id, state=None):
+        """Start an empty conversation and return its session id"""
+        self._maybe_purge()
+        session_id = uuid.uuid4().hex
+        now = time.time()
+        self._conn.execute(
+            'INSERT INTO sessions (session_id, user_id, turn_count, state, created_at, updated_at) '
+            'VALUES (?, ?, 0, ?, ?, ?)',
+            (session_id, user_id, json.dumps(state or {}), now, now)
+        )
+        return session_id
+
+    def exists(self, session_id):
+        row = self._conn.execute('SELECT 1 FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+        return row is not None
+
+    def append(self, session_id, role, content, tokens=None):
+        """Append one turn, with its token count if known. Returns the new turn count."""
+        conn = self._conn
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT turn_count FROM sessions WHERE session_id = ?', (session_id,)
+            ).fetchone()
+            if row is None:
+                raise KeyError(session_id)
+            seq = row[0] + 1
+            conn.execute(
+                'INSERT INTO turns (session_id, seq, role, content, created_at, tokens) VALUES (?, ?, ?, ?, ?, ?)',
+                (session_id, seq, role, content, now, tokens)
+            )
+            conn.execute(
+                'UPDATE sessions SET turn_count = ?, updated_at = ? WHERE session_id = ?',
+                (seq, now, session_id)
+            )
+            conn.execute('COMMIT')
+            return seq
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def history(self, session_id, limit=None):
+        """Return the conversation as OpenAI-style messages, optionally only the last `limit` turns"""
+        if limit is None:
+            rows = self._conn.execute(
+                'SELECT role, content FROM turns WHERE session_id = ? ORDER BY seq',
+                (session_id,)
+            ).fetchall()
+        else:
+            rows = self._conn.execute(
+                'SELECT role, content FROM turns WHERE session_id = ? ORDER BY seq DESC LIMIT ?',
+                (session_id, limit)
+            ).fetchall()
+            rows.reverse()
+        return [{"role": role, "content": content} for role, content in rows]
+
+    def turns(self, session_id, after_seq=0):
+        """Return stored turns newer than after_seq, with their sequence numbers and token counts"""
+        rows = self._conn.execute(
+            'SELECT seq, role, content, tokens FROM turns WHERE session_id = ? AND seq > ? ORDER BY seq',
+            (session_id, after_seq)
+        )
+        return [
+            {"seq": seq, "role": role, "content": content, "tokens": tokens}
+            for seq, role, content, tokens in rows
+        ]
+
+    def count(self, session_id):
+        """Number of turns in the conversation, without reading them"""
+        row = self._conn.execute(
+            'SELECT turn_count FROM sessions WHERE session_id = ?', (session_id,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def reset(self, session_id):
+        """Clear the conversation but keep the session state"""
+        conn = self._conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM turns WHERE session_id = ?', (session_id,))
+            conn.execute(
+                'UPDATE sessions SET turn_count = 0, updated_at = ? WHERE session_id = ?',
+                (time.time(), session_id)
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def get_state(self, session_id):
+        row = self._conn.execute('SELECT state FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def update_state(self, session_id, fields, merge=()):
+        """Merge fields into the session state and return the new state.
+
+        Fields named in `merge` are dicts merged key by key into the stored
+        ones, so writers changing different keys of one field don't undo
+        each other.
+        """
+        conn = self._conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT state FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+            if row is None:
+                raise KeyError(session_id)
+            state = json.loads(row[0])
+            for name, value in fields.items():
+                if name in merge and isinstance(state.get(name), dict):
+                    state[name] = {**state[name], **value}
+                else:
+                    state[name] = value
+            conn.execute(
+                'UPDATE sessions SET state = ?, updated_at = ? WHERE session_id = ?',
+                (json.dumps(state), time.time(), session_id)
+            )
+            conn.execute('COMMIT')
+            return state
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def delete(self, session_id):
+        conn = self._conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM turns WHERE session_id = ?', (session_id,))
+            conn.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def purge_idle(self, max_idle=None):
+        """Delete sessions that haven't been touched for max_idle seconds. Returns how many."""
+        cutoff = time.time() - (max_idle if max_idle is not None else self.max_idle)
+        stale = [row[0] for row in self._conn.execute(
+            'SELECT session_id FROM sessions WHERE updated_at < ?', (cutoff,)
+        )]
+        for session_id in stale:
+            self.delete(session_id)
+        return len(stale)
+
+    def _maybe_purge(self):
+        now = time.time()
+        if now - self._last_purge > PURGE_INTERVAL:
+            self._last_purge = now
+            self.purge_idle()
+
+
+def open_conversation_store(db_path=None, max_idle=86400):
+    """Open the conversation store configured by CONVERSATION_DB"""
+    db_path = db_path or os.getenv('CONVERSATION_DB', 'conversations.db')
+    return ConversationStore(db_path, max_idle=max_idle)
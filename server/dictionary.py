@@ -0,0 +1,442 @@
+"""Bilingual word lookups from local, memory-mapped dictionaries.
+
+Each language pair is one file, <from>-<to>.dict, compiled from a word
+list by build_dictionary.py. The file is opened with mmap, so a lookup
+reads a few pages straight from the OS page cache (which all workers on a
+host share) and nothing is parsed at startup. Layout, little-endian:
+
+- header: magic, version, the two language codes, the entry count and
+  where the index and the prefix table start
+- records, sorted by key: key length (1 byte), the key (normalized UTF-8),
+  value length (2 bytes), the value (compact JSON)
+- index: the offset of every record, in key order (4 bytes each)
+- prefix table: for each possible first byte of a key, the position in
+  the index where those keys start (257 entries)
+
+A lookup narrows to the keys sharing its first byte with the prefix
+table and binary-searches the index, so it takes microseconds. Prefix
+searches (for autocomplete) start the same way and scan forward. A word
+that isn't listed is tried again as a plural or other inflection
+(vocab.base_forms) and as a regular verb form (verb_forms), so "hablo"
+finds "hablar" without a model call.
+
+Source word lists are tab-separated, in dictionary/sources/<from>-<to>.tsv:
+
+    casa<TAB>house; home<TAB>noun
+
+Every list is also compiled the other way round (the translations become
+keys) unless a list for that direction exists. Pairs without a file of
+their own, like es-fr, are looked up through English (PIVOT_LANG): the
+word's English translations are looked up in en-fr. Those entries say
+"via": "en", because a pivot loses some senses. Dictionaries rebuilds
+files that are missing or older than their list when it opens them, and
+picks up files rebuilt under it within DICTIONARY_REFRESH seconds.
+"""
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import unicodedata
+
+from logs import get_logger
+from metrics import metrics
+from vocab import base_forms
+
+log = get_logger("dictionary")
+
+DICTIONARY_DIR = os.getenv(
+    'DICTIONARY_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dictionary')
+)
+# Pairs without a dictionary of their own go through this language
+PIVOT_LANG = 'en'
+# Seconds between checks for rebuilt dictionary files
+REFRESH_INTERVAL = float(os.getenv('DICTIONARY_REFRESH', '30'))
+
+MAGIC = b'CBD1'
+VERSION = 1
+# magic, version, flags, from, to, entries, index offset, prefix table offset
+HEADER = struct.Struct('<4sHH4s4sIII')
+OFFSET = struct.Struct('<I')
+VALUE_LENGTH = struct.Struct('<H')
+
+# Quotes and punctuation a learner may select along with a word
+STRIP = ' \t\r\n.,;:!?¡¿"\'«»“”‘’()[]'
+# Notes in translations, like "(formal)", which aren't part of the word
+NOTE = re.compile(r'\s*\([^)]*\)')
+
+
+# Regular conjugation endings -> the infinitive endings they come from ('' when
+# the infinitive is the stem itself, as in future forms). Only headwords
+# listed as verbs are matched, so a wrong guess finds nothing.
+_AR, _ER_IR, _ALL_ES = ('ar',), ('er', 'ir'), ('ar', 'er', 'ir')
+_FR_FUTURE = ('', 'e', 'er', 're', 'ir')
+_IT_ALL = ('are', 'ere', 'ire')
+VERB_ENDINGS = {
+    'es': {
+        # present and present subjunctive
+        'o': _ALL_ES, 'as': _ALL_ES, 'a': _ALL_ES, 'amos': _AR, 'áis': _AR, 'an': _ALL_ES,
+        'es': _ALL_ES, 'e': _ALL_ES, 'emos': ('er', 'ar', ''), 'éis': ('er', 'ar', ''), 'en': _ALL_ES,
+        'imos': _ER_IR, 'ís': ('ir',),
+        # preterite
+        'é': ('ar', ''), 'aste': _AR, 'ó': _AR, 'asteis': _AR, 'aron': _AR,
+        'í': _ER_IR, 'iste': _ER_IR, 'ió': _ER_IR, 'isteis': _ER_IR, 'ieron': _ER_IR,
+        # imperfect
+        'aba': _AR, 'abas': _AR, 'ábamos': _AR, 'abais': _AR, 'aban': _AR,
+        'ía': _ER_IR, 'ías': _ER_IR, 'íamos': _ER_IR, 'íais': _ER_IR, 'ían': _ER_IR,
+        # gerund and participle
+        'ando': _AR, 'iendo': _ER_IR, 'ado': _AR, 'ada': _AR, 'ido': _ER_IR, 'ida': _ER_IR,
+        # future and conditional: infinitive + ending
+        'ás': ('',), 'á': ('',), 'án': ('',),
+    },
+    'fr': {
+        'e': ('er',), 'es': ('er',), 'ent': ('er', 're', 'ir'), 'ons': _FR_FUTURE, 'ez': _FR_FUTURE,
+        's': ('re', 'ir'), 't': ('re', 'ir'), 'is': ('ir',), 'it': ('ir',),
+        'issons': ('ir',), 'issez': ('ir',), 'issent': ('ir',),
+        'é': ('er',), 'ée': ('er',), 'és': ('er',), 'ées': ('er',), 'i': ('ir',), 'ie': ('ir',),
+        'u': ('re', 'oir'), 'ue': ('re', 'oir'), 'ant': ('er', 're'),
+        'ais': _FR_FUTURE, 'ait': _FR_FUTURE, 'ions': _FR_FUTURE, 'iez': _FR_FUTURE, 'aient': _FR_FUTURE,
+        'ai': ('', 'e'), 'as': ('', 'e'), 'a': ('', 'e'), 'ont': ('', 'e'),
+    },
+    'it': {
+        'o': _IT_ALL, 'i': _IT_ALL, 'a': ('are',), 'e': ('ere', 'ire'), 'iamo': _IT_ALL, 'amo': ('are',),
+        'ate': ('are',), 'ete': ('ere',), 'ite': ('ire',), 'ano': ('are',), 'ono': ('ere', 'ire'),
+        'isco': ('ire',), 'isci': ('ire',), 'isce': ('ire',), 'iscono': ('ire',),
+        'ato': ('are',), 'ata': ('are',), 'uto': ('ere',), 'ito': ('ire',),
+        'ando': ('are',), 'endo': ('ere', 'ire'),
+        'avo': ('are',), 'avi': ('are',), 'ava': ('are',), 'avamo': ('are',), 'avano': ('are',),
+        'evo': ('ere',), 'evi': ('ere',), 'eva': ('ere',), 'evamo': ('ere',), 'evano': ('ere',),
+        'ivo': ('ire',), 'ivi': ('ire',), 'iva': ('ire',), 'ivamo': ('ire',), 'ivano': ('ire',),
+        'erò': ('are', 'ere'), 'erai': ('are', 'ere'), 'erà': ('are', 'ere'), 'eremo': ('are', 'ere'),
+        'irò': ('ire',), 'irai': ('ire',), 'irà': ('ire',), 'iremo': ('ire',),
+    },
+    'de': {
+        'e': ('en', 'n'), 'st': ('en', 'n'), 'est': ('en',), 't': ('en', 'n'), 'et': ('en',),
+        'te': ('en',), 'test': ('en',), 'ten': ('en',), 'tet': ('en',), 'end': ('en',),
+    },
+}
+# Past participles like gelernt; the prefix is dropped before the endings are tried
+VERB_PREFIXES = {'de': ('ge',)}
+
+
+def verb_forms(word, lang):
+    """Infinitives a conjugated verb may come from, by the endings in VERB_ENDINGS"""
+    endings = VERB_ENDINGS.get(lang)
+    if not endings:
+        return
+    words = [word] + [word[len(p):] for p in VERB_PREFIXES.get(lang, ()) if word.startswith(p)]
+    for form in words:
+        # Longest ending first, so 'amos' is tried before 'os'
+        for length in range(min(len(form) - 2, 6), 0, -1):
+            infinitives = endings.get(form[-length:])
+            for infinitive in infinitives or ():
+                yield form[:-length] + infinitive
+
+
+def normalize(word):
+    """The key a word is stored and looked up under"""
+    return ' '.join(unicodedata.normalize('NFC', word).strip(STRIP).lower().split())
+
+
+def pair_name(source_lang, target_lang):
+    return f'{source_lang}-{target_lang}'
+
+
+def read_source(path):
+    """{headword: (translations, pos)} from a tab-separated word list"""
+    entries = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line.strip() or line.startswith('#'):
+                continue
+            fields = line.split('\t')
+            headword = fields[0].strip()
+            translations = [t.strip() for t in fields[1].split(';') if t.strip()] if len(fields) > 1 else []
+            pos = fields[2].strip() if len(fields) > 2 else ''
+            if not headword or not translations:
+                continue
+            known, known_pos = entries.get(headword, ([], pos))
+            entries[headword] = (known + [t for t in translations if t not in known], known_pos or pos)
+    return entries
+
+
+def reverse(entries, target_lang):
+    """The same word list, from the translations back to the headwords"""
+    reversed_entries = {}
+    for headword, (translations, pos) in entries.items():
+        for translation in translations:
+            word = NOTE.sub('', translation).strip()
+            # English verbs are listed as infinitives, but looked up bare
+            if target_lang == 'en' and word.startswith('to '):
+                word = word[3:]
+            if not word:
+                continue
+            known, known_pos = reversed_entries.get(word, ([], pos))
+            if headword not in known:
+                reversed_entries[word] = (known + [headword], known_pos or pos)
+    return reversed_entries
+
+
+def write_dictionary(path, source_lang, target_lang, entries):
+    """Compile {headword: (translations, pos)} to a .dict file; return the number of entries"""
+    records = {}
+    for headword, (translations, pos) in entries.items():
+        key = normalize(headword).encode('utf-8')
+        if not key or len(key) > 255:
+            continue
+        value = {'t': translations}
+        if pos:
+            value['p'] = pos
+        # The key is lowercased; keep the spelling for words like German nouns
+        if headword.strip() != normalize(headword):
+            value['w'] = headword.strip()
+        if key in records:
+            # Two spellings of one key: merge their translations
+            merged = records[key]
+            merged['t'] += [t for t in translations if t not in merged['t']]
+            continue
+        records[key] = value
+
+    keys = sorted(records)
+    body = bytearray()
+    offsets = []
+    for key in keys:
+        value = json.dumps(records[key], ensure_ascii=False, separators=(',', ':')).encode('utf-8')[:0xFFFF]
+        offsets.append(HEADER.size + len(body))
+        body += bytes((len(key),)) + key + VALUE_LENGTH.pack(len(value)) + value
+    body += b'\0' * (-len(body) % 4)
+
+    index_at = HEADER.size + len(body)
+    prefix_at = index_at + OFFSET.size * len(keys)
+    prefixes = []
+    position = 0
+    for first_byte in range(257):
+        while position < len(keys) and keys[position][0] < first_byte:
+            position += 1
+        prefixes.append(position)
+
+    # Written aside and renamed, so workers with the old file mapped keep reading it
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, 0, source_lang.encode('ascii'), target_lang.encode('ascii'),
+                            len(keys), index_at, prefix_at))
+        f.write(body)
+        f.write(struct.pack(f'<{len(offsets)}I', *offsets))
+        f.write(struct.pack('<257I', *prefixes))
+    os.replace(tmp_path, path)
+    return len(keys)
+
+
+class Dictionary:
+    """One compiled language pair, memory-mapped read-only"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.stat = os.stat(path)
+        magic, version, _, source_lang, target_lang, self.count, self._index_at, self._prefix_at = \
+            HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{path} is not a version {VERSION} dictionary')
+        self.source_lang = source_lang.rstrip(b'\0').decode('ascii')
+        self.target_lang = target_lang.rstrip(b'\0').decode('ascii')
+
+    def __len__(self):
+        return self.count
+
+    def lookup(self, word):
+        """{'word', 'translations', 'pos'} for a word, or None"""
+        key = normalize(word).encode('utf-8')
+        if not key:
+            return None
+        position = self._lower_bound(key)
+        if position < self.count and self._key(position) == key:
+            return self._entry(position)
+        return None
+
+    def complete(self, prefix, limit=10):
+        """Headwords starting with a prefix, in key order"""
+        key = normalize(prefix).encode('utf-8')
+        words = []
+        position = self._lower_bound(key) if key else 0
+        while position < self.count and len(words) < limit:
+            if not self._key(position).startswith(key):
+                break
+            words.append(self._entry(position)['word'])
+            position += 1
+        return words
+
+    def _offset(self, position):
+        return OFFSET.unpack_from(self._map, self._index_at + OFFSET.size * position)[0]
+
+    def _key(self, position):
+        offset = self._offset(position)
+        return self._map[offset + 1:offset + 1 + self._map[offset]]
+
+    def _lower_bound(self, key):
+        # Only keys with the same first byte can match
+        low = OFFSET.unpack_from(self._map, self._prefix_at + OFFSET.size * key[0])[0]
+        high = OFFSET.unpack_from(self._map, self._prefix_at + OFFSET.size * (key[0] + 1))[0]
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _entry(self, position):
+        offset = self._offset(position)
+        key_end = offset + 1 + self._map[offset]
+        value_length = VALUE_LENGTH.unpack_from(self._map, key_end)[0]
+        value_start = key_end + VALUE_LENGTH.size
+        value = json.loads(self._map[value_start:value_start + value_length])
+        return {
+            'word': value.get('w') or self._map[offset + 1:key_end].decode('utf-8'),
+            'translations': value['t'],
+            'pos': value.get('p', ''),
+        }
+
+
+class Dictionaries:
+    """The compiled dictionaries in a directory, by language pair"""
+
+    def __init__(self, directory=DICTIONARY_DIR, refresh_interval=REFRESH_INTERVAL, build=True):
+        self.directory = directory
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._checked = 0
+        self._pairs = {}
+        if build:
+            build_all(os.path.join(directory, 'sources'), directory, stale_only=True)
+        self._refresh()
+
+    def pairs(self):
+        self._maybe_refresh()
+        return sorted(self._pairs)
+
+    def lookup(self, word, source_lang, target_lang):
+        """The entry for a word, or for the form it is inflected from; None if neither is listed"""
+        self._maybe_refresh()
+        dictionary = self._pairs.get(pair_name(source_lang, target_lang))
+        if dictionary is None:
+            return self._pivot(word, source_lang, target_lang)
+        return self._lookup(dictionary, word, source_lang)
+
+    def _pivot(self, word, source_lang, target_lang):
+        """Look a word up through PIVOT_LANG, for pairs without a dictionary of their own"""
+        to_pivot = self._pairs.get(pair_name(source_lang, PIVOT_LANG))
+        from_pivot = self._pairs.get(pair_name(PIVOT_LANG, target_lang))
+        if to_pivot is None or from_pivot is None:
+            return None
+        entry = self._lookup(to_pivot, word, source_lang)
+        if entry is None:
+            return None
+        translations = []
+        for meaning in entry['translations']:
+            meaning = NOTE.sub('', meaning).strip()
+            # English verbs are listed as infinitives, but their keys are bare
+            if PIVOT_LANG == 'en' and meaning.startswith('to '):
+                meaning = meaning[3:]
+            found = self._lookup(from_pivot, meaning, PIVOT_LANG)
+            for translation in found['translations'] if found else ():
+                if translation not in translations:
+                    translations.append(translation)
+        if not translations:
+            return None
+        return dict(entry, translations=translations, via=PIVOT_LANG)
+
+    def _lookup(self, dictionary, word, source_lang):
+        entry = dictionary.lookup(word)
+        if entry is not None:
+            return entry
+        word = normalize(word)
+        for form in base_forms(word, source_lang):
+            entry = dictionary.lookup(form)
+            if entry is not None:
+                return dict(entry, inflected=word)
+        for form in verb_forms(word, source_lang):
+            entry = dictionary.lookup(form)
+            if entry is not None and entry['pos'] == 'verb':
+                return dict(entry, inflected=word)
+        return None
+
+    def complete(self, prefix, source_lang, target_lang, limit=10):
+        self._maybe_refresh()
+        # A pivoted pair suggests the words its first dictionary has
+        dictionary = self._pairs.get(pair_name(source_lang, target_lang)) or \
+            self._pairs.get(pair_name(source_lang, PIVOT_LANG))
+        return dictionary.complete(prefix, limit) if dictionary is not None else []
+
+    def _maybe_refresh(self):
+        if time.monotonic() - self._checked < self.refresh_interval:
+            return
+        with self._lock:
+            if time.monotonic() - self._checked >= self.refresh_interval:
+                self._refresh()
+
+    def _refresh(self):
+        self._checked = time.monotonic()
+        try:
+            names = [name for name in os.listdir(self.directory) if name.endswith('.dict')]
+        except FileNotFoundError:
+            names = []
+        pairs = {}
+        for name in names:
+            pair, path = name[:-len('.dict')], os.path.join(self.directory, name)
+            current = self._pairs.get(pair)
+            try:
+                stat = os.stat(path)
+                if current is not None and (current.stat.st_ino, current.stat.st_mtime) == (stat.st_ino, stat.st_mtime):
+                    pairs[pair] = current
+                    continue
+                pairs[pair] = Dictionary(path)
+                log.info("dictionary.loaded", pair=pair, entries=len(pairs[pair]))
+            except (OSError, ValueError) as e:
+                log.warning("dictionary.unreadable", path=path, error=str(e))
+        # Replaced files stay mapped until lookups still using them finish
+        self._pairs = pairs
+
+
+def build_all(sources_dir, out_dir, pairs=None, stale_only=False, reverse_lists=True):
+    """Compile the word lists in sources_dir; return {pair: entries} for the files written"""
+    try:
+        names = sorted(name[:-len('.tsv')] for name in os.listdir(sources_dir) if name.endswith('.tsv'))
+    except FileNotFoundError:
+        return {}
+    # pair -> (source list, whether to reverse it)
+    plan = {name: (name, False) for name in names}
+    if reverse_lists:
+        for name in names:
+            source_lang, _, target_lang = name.partition('-')
+            plan.setdefault(pair_name(target_lang, source_lang), (name, True))
+
+    written = {}
+    for pair, (source, reversed_list) in sorted(plan.items()):
+        if pairs and pair not in pairs:
+            continue
+        source_path = os.path.join(sources_dir, f'{source}.tsv')
+        out_path = os.path.join(out_dir, f'{pair}.dict')
+        if stale_only and os.path.exists(out_path) and os.path.getmtime(out_path) >= os.path.getmtime(source_path):
+            continue
+        source_lang, _, target_lang = pair.partition('-')
+        entries = read_source(source_path)
+        if reversed_list:
+            entries = reverse(entries, source_lang)
+        try:
+            written[pair] = write_dictionary(out_path, source_lang, target_lang, entries)
+        except OSError as e:
+            # A read-only deployment serves whatever was built before
+            log.warning("dictionary.build_failed", pair=pair, error=str(e))
+    return written
+
+
+def open_dictionaries():
+    return Dictionaries()
+
+
+metrics.describe('dictionary_lookups_total', 'Word lookups, by where the answer came from (dictionary, model, missing, rate_limited)')
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""Batch job that writes the graded reading passages.
+
+Generates --per-topic passages for every target language x skill level x
+topic and stores them in the reading store (READINGS_DB), where the
+server's reading cache picks them up within READINGS_REFRESH seconds.
+Passages that already exist are skipped, so an interrupted run can be
+resumed; --force rewrites them.
+
+    python generate_readings.py
+    python generate_readings.py --langs es,fr --levels beginner --per-topic 2
+    python generate_readings.py --topics food,travel --force --concurrency 8
+
+Calls go through the same pooled, retrying OpenAI client as the server,
+with the model model_policy picks for "reading" at each level.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from dotenv import load_dotenv
+
+from bots.model_policy import model_policy
+from bots.system_prompts import LANGUAGE_NAMES
+from readings import LANGUAGES, SKILL_LEVELS, TOPICS, open_reading_store, reading_id
+from upstream import create_client
+
+LEVEL_GUIDES = {
+    'beginner': 'about 120 words; short sentences in the present tense; only very common everyday words',
+    'intermediate': 'about 220 words; past and future tenses; common idioms, explained by context',
+    'advanced': 'about 350 words; natural, varied style with subordinate clauses and less common vocabulary',
+}
+
+READING_PROMPT = """You write graded reading passages for language learners.
+Write an original passage in {language} about {topic}, for a {level} learner: {guide}.
+Then pick 5 to 8 words or phrases from the passage a {level} learner may not know, and write 3 comprehension questions in {language}.
+Answer with JSON only: {{"title": "...", "text": "...", "glossary": [{{"term": "...", "meaning": "... (in English)"}}], "questions": ["..."]}}"""
+
+
+def generate(client, target_lang, skill_level, topic, number):
+    """Write one passage; return it as stored"""
+    choice = model_policy.select('reading', skill_level)
+    prompt = READING_PROMPT.format(
+        language=LANGUAGE_NAMES[target_lang], topic=topic, level=skill_level, guide=LEVEL_GUIDES[skill_level]
+    )
+    response = client.chat.completions.create(
+        model=choice['model'],
+        messages=[
+            {'role': 'system', 'content': prompt},
+            # Different passages for the same topic
+            {'role': 'user', 'content': f'Passage number {number}.'},
+        ],
+        response_format={'type': 'json_object'},
+        temperature=0.9,
+        operation='reading',
+    )
+    passage = json.loads(response.choices[0].message.content)
+    if not passage.get('title') or not passage.get('text'):
+        raise ValueError('passage without a title or text')
+    return {
+        'reading_id': reading_id(target_lang, skill_level, topic, number),
+        'target_lang': target_lang,
+        'skill_level': skill_level,
+        'topic': topic,
+        'title': passage['title'].strip(),
+        'text': passage['text'].strip(),
+        'glossary': passage.get('glossary') or [],
+        'questions': passage.get('questions') or [],
+        'model': choice['model'],
+    }
+
+
+def choices(value, allowed, name):
+    chosen = [item.strip() for item in value.split(',') if item.strip()] if value else list(allowed)
+    unknown = [item for item in chosen if item not in allowed]
+    if unknown:
+        sys.exit(f"Unknown {name}: {', '.join(unknown)} (choose from {', '.join(allowed)})")
+    return chosen
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Pre-generate graded reading passages")
+    parser.add_argument("--langs", help=f"comma-separated target languages (default: {','.join(LANGUAGES)})")
+    parser.add_argument("--levels", help="comma-separated skill levels (default: all)")
+    parser.add_argument("--topics", help="comma-separated topics (default: the built-in list)")
+    parser.add_argument("--per-topic", type=int, default=3, help="passages per language, level and topic")
+    parser.add_argument("--concurrency", type=int, default=4, help="OpenAI calls in flight")
+    parser.add_argument("--db", help="reading store path (default: READINGS_DB or readings.db)")
+    parser.add_argument("--force", action="store_true", help="rewrite passages that already exist")
+    args = parser.parse_args()
+
+    langs = choices(args.langs, LANGUAGES, "language")
+    levels = choices(args.levels, SKILL_LEVELS, "level")
+    topics = [topic.strip() for topic in args.topics.split(",")] if args.topics else list(TOPICS)
+
+    store = open_reading_store(args.db)
+    jobs = [
+        (lang, level, topic, number)
+        for lang in langs for level in levels for topic in topics for number in range(1, args.per_topic + 1)
+        if args.force or not store.exists(reading_id(lang, level, topic, number))
+    ]
+    skipped = len(langs) * len(levels) * len(topics) * args.per_topic - len(jobs)
+
+    client = create_client(os.getenv("OPENAI_API_KEY"))
+    start = time.perf_counter()
+    written = failed = 0
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        futures = {pool.submit(generate, client, *job): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                store.put(future.result())
+                written += 1
+            except Exception as e:
+                failed += 1
+                print(f"failed {reading_id(*job)}: {e}", file=sys.stderr)
+
+    print(json.dumps({
+        "written": written,
+        "skipped": skipped,
+        "failed": failed,
+        "seconds": round(time.perf_counter() - start, 1),
+        "db": store.path,
+    }))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
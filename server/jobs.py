@@ -0,0 +1,278 @@
+"""Background jobs that run after a request has been answered.
+
+Work that the learner isn't waiting for (grammar feedback on their
+message, vocabulary and skill-level updates) is submitted as a job and
+run by a small pool of worker threads, so the request only does what its
+response needs.
+
+- Every job is written to a SQLite journal (JOB_DB) before it is queued,
+  and its result or error is written back when it finishes. Results are
+  read from the journal, so any worker process can serve them.
+- At most JOB_QUEUE_SIZE jobs wait per process. Past that, submit()
+  raises QueueFull and the caller decides what to do without them.
+- A failing job is retried up to JOB_MAX_ATTEMPTS times, with jittered
+  exponential backoff.
+- Jobs left queued or running by a process that died on this host are
+  picked up again when the next queue starts, including jobs from an
+  earlier boot that had the same pid. Finished jobs are deleted
+  after JOB_RETENTION seconds.
+"""
+import json
+import os
+import queue
+import random
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+from logs import get_logger
+from metrics import metrics
+
+log = get_logger("jobs")
+
+WORKERS = int(os.getenv('JOB_WORKERS', '4'))
+QUEUE_SIZE = int(os.getenv('JOB_QUEUE_SIZE', '1000'))
+MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+RETRY_BASE = float(os.getenv('JOB_RETRY_BASE', '1'))
+RETENTION = float(os.getenv('JOB_RETENTION', str(7 * 86400)))
+
+# Finished jobs are pruned at most this often (seconds)
+PRUNE_INTERVAL = 3600
+
+
+class QueueFull(Exception):
+    """Too many jobs are waiting; the caller should shed or retry later"""
+
+
+class JobQueue:
+    """Bounded worker pool over a durable journal of jobs"""
+
+    def __init__(self, path, workers=WORKERS, queue_size=QUEUE_SIZE, max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        # The boot token tells this process from an earlier one with the same
+        # pid, as after a container restart
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self._handlers = {}
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._local = threading.local()
+        self._threads = []
+        self._last_prune = 0
+        conn = self._conn
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            ' job_id TEXT PRIMARY KEY,'
+            ' kind TEXT NOT NULL,'
+            ' user_id TEXT,'
+            ' payload TEXT NOT NULL,'
+            ' status TEXT NOT NULL,'
+            ' attempts INTEGER NOT NULL DEFAULT 0,'
+            ' result TEXT,'
+            ' error TEXT,'
+            ' owner TEXT NOT NULL,'
+            ' created_at REAL NOT NULL,'
+            ' updated_at REAL NOT NULL)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS jobs_user ON jobs (user_id, created_at)')
+        conn.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, updated_at)')
+
+    @property
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def register(self, kind, handler):
+        """Run `handler(payload)` for jobs of this kind; its return value is the job's result"""
+        self._handlers[kind] = handler
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'job-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        self._recover()
+
+    def submit(self, kind, payload, user_id=None):
+        """Journal and queue a job; return its id, or raise QueueFull"""
+        if kind not in self._handlers:
+            raise ValueError(f'No handler for job kind {kind}')
+        if self._queue.full():
+            metrics.inc('jobs_total', kind=kind, outcome='rejected')
+            raise QueueFull(f'{self._queue.qsize()} jobs waiting')
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self._conn.execute(
+            'INSERT INTO jobs (job_id, kind, user_id, payload, status, owner, created_at, updated_at) '
+            "VALUES (?, ?, ?, ?, 'queued', ?, ?, ?)",
+            (job_id, kind, user_id, json.dumps(payload), self.owner, now, now)
+        )
+        try:
+            self._queue.put_nowait(job_id)
+        except queue.Full:
+            # Filled up since the check above
+            self._conn.execute('DELETE FROM jobs WHERE job_id = ?', (job_id,))
+            metrics.inc('jobs_total', kind=kind, outcome='rejected')
+            raise QueueFull(f'{self._queue.qsize()} jobs waiting')
+        return job_id
+
+    def get(self, job_id, user_id=None):
+        """A job as a dict, or None. With user_id, only that user's jobs are found."""
+        row = self._conn.execute(
+            f'SELECT {_COLUMNS} FROM jobs WHERE job_id = ? AND (? IS NULL OR user_id = ?)',
+            (job_id, user_id, user_id)
+        ).fetchone()
+        return _job(row) if row else None
+
+    def for_user(self, user_id, kind=None, limit=20):
+        """A user's most recent jobs, newest first"""
+        rows = self._conn.execute(
+            f'SELECT {_COLUMNS} FROM jobs WHERE user_id = ? AND (? IS NULL OR kind = ?) '
+            'ORDER BY created_at DESC LIMIT ?',
+            (user_id, kind, kind, limit)
+        ).fetchall()
+        return [_job(row) for row in rows]
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _work(self):
+        while True:
+            job_id = self._queue.get()
+            try:
+                self._run(job_id)
+            except Exception:
+                log.exception('job.worker_error', job_id=job_id)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, job_id):
+        conn = self._conn
+        # Claim it, unless another process recovered it or it was pruned
+        claimed = conn.execute(
+            "UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ? "
+            "WHERE job_id = ? AND status = 'queued' AND owner = ?",
+            (time.time(), job_id, self.owner)
+        ).rowcount
+        if not claimed:
+            return
+        kind, payload, attempts = conn.execute(
+            'SELECT kind, payload, attempts FROM jobs WHERE job_id = ?', (job_id,)
+        ).fetchone()
+
+        start = time.perf_counter()
+        try:
+            result = self._handlers[kind](json.loads(payload))
+        except Exception as e:
+            metrics.observe('job_duration_seconds', time.perf_counter() - start, kind=kind)
+            if attempts < self.max_attempts:
+                delay = random.uniform(0, RETRY_BASE * 2 ** attempts)
+                log.warning('job.retry', job_id=job_id, kind=kind, attempt=attempts, error=str(e),
+                            delay=round(delay, 2))
+                conn.execute(
+                    "UPDATE jobs SET status = 'queued', error = ?, updated_at = ? WHERE job_id = ?",
+                    (str(e), time.time(), job_id)
+                )
+                metrics.inc('jobs_total', kind=kind, outcome='retried')
+                timer = threading.Timer(delay, self._requeue, (job_id,))
+                timer.daemon = True
+                timer.start()
+            else:
+                log.exception('job.failed', job_id=job_id, kind=kind, attempts=attempts)
+                self._finish(job_id, 'failed', error=str(e))
+                metrics.inc('jobs_total', kind=kind, outcome='failed')
+            return
+
+        metrics.observe('job_duration_seconds', time.perf_counter() - start, kind=kind)
+        self._finish(job_id, 'done', result=result)
+        metrics.inc('jobs_total', kind=kind, outcome='done')
+
+    def _requeue(self, job_id):
+        # A retry is already journaled, so it waits for a slot instead of being refused
+        self._queue.put(job_id)
+
+    def _finish(self, job_id, status, result=None, error=None):
+        now = time.time()
+        self._conn.execute(
+            'UPDATE jobs SET status = ?, result = ?, error = ?, updated_at = ? WHERE job_id = ?',
+            (status, None if result is None else json.dumps(result), error, now, job_id)
+        )
+        if now - self._last_prune > PRUNE_INTERVAL:
+            self._last_prune = now
+            self._conn.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?", (now - RETENTION,)
+            )
+
+    def _recover(self):
+        """Take over unfinished jobs from processes on this host that are gone"""
+        host, pid = socket.gethostname(), os.getpid()
+        rows = self._conn.execute(
+            "SELECT job_id, owner FROM jobs WHERE status IN ('queued', 'running') AND owner != ? "
+            'ORDER BY created_at',
+            (self.owner,)
+        ).fetchall()
+        recovered = 0
+        for job_id, owner in rows:
+            owner_host, owner_pid = _owner(owner)
+            if owner_host != host:
+                continue
+            # A different owner with this process's pid is from a previous boot
+            if owner_pid != pid and _alive(owner_pid):
+                continue
+            claimed = self._conn.execute(
+                "UPDATE jobs SET status = 'queued', owner = ?, updated_at = ? WHERE job_id = ? AND owner = ?",
+                (self.owner, time.time(), job_id, owner)
+            ).rowcount
+            if claimed:
+                self._queue.put(job_id)
+                recovered += 1
+        if recovered:
+            log.info('job.recovered', jobs=recovered)
+
+
+_COLUMNS = 'job_id, kind, status, attempts, result, error, created_at, updated_at'
+
+
+def _job(row):
+    job_id, kind, status, attempts, result, error, created_at, updated_at = row
+    return {
+        'job_id': job_id,
+        'kind': kind,
+        'status': status,
+        'attempts': attempts,
+        'result': None if result is None else json.loads(result),
+        'error': error,
+        'created_at': created_at,
+        'updated_at': updated_at,
+    }
+
+
+def _owner(owner):
+    """(host, pid) of a job owner, written as host:pid:boot (host:pid before boot tokens)"""
+    host, _, rest = owner.partition(':')
+    return host, int(rest.partition(':')[0])
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def open_job_queue(path=None):
+    return JobQueue(path or os.getenv('JOB_DB', 'jobs.db'))
+
+
+metrics.describe('jobs_total', 'Background jobs by kind and outcome (done, retried, failed, rejected)')
+metrics.describe('job_duration_seconds', 'Time a background job took to run, per attempt')
@@ -0,0 +1,80 @@
+"""Leveled, sampled, structured logging.
+
+Each record is one JSON line on stderr:
+
+    {"ts": 1718000000.123, "level": "info", "logger": "chat", "event": "chat.turn", ...}
+
+LOG_LEVEL (default info) sets the threshold, so per-turn debug detail such
+as user backgrounds costs nothing unless asked for. LOG_SAMPLE_RATE keeps
+that fraction of debug and info records under load; warnings and errors are
+always written. Field values are only serialized for records that are kept.
+"""
+import json
+import logging
+import os
+import random
+import sys
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "info").upper()
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+
+_root = logging.getLogger("chat_buddy")
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "logger": record.name.split(".", 1)[-1],
+            "event": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+def _configure():
+    if _root.handlers:
+        return
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JsonFormatter())
+    _root.addHandler(handler)
+    _root.setLevel(LOG_LEVEL)
+    _root.propagate = False
+
+
+class StructuredLogger:
+    """logger.info("event.name", key=value, ...)"""
+
+    def __init__(self, name):
+        self._logger = logging.getLogger(f"chat_buddy.{name}")
+
+    def _log(self, level, event, fields, exc_info=False):
+        if not self._logger.isEnabledFor(level):
+            return
+        if level < logging.WARNING and LOG_SAMPLE_RATE < 1 and random.random() >= LOG_SAMPLE_RATE:
+            return
+        self._logger.log(level, event, exc_info=exc_info, extra={"fields": fields})
+
+    def debug(self, event, **fields):
+        self._log(logging.DEBUG, event, fields)
+
+    def info(self, event, **fields):
+        self._log(logging.INFO, event, fields)
+
+    def warning(self, event, **fields):
+        self._log(logging.WARNING, event, fields)
+
+    def error(self, event, **fields):
+        self._log(logging.ERROR, event, fields)
+
+    def exception(self, event, **fields):
+        """error() with the current traceback"""
+        self._log(logging.ERROR, event, fields, exc_info=True)
+
+
+def get_logger(name):
+    _configure()
+    return StructuredLogger(name)
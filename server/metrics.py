@@ -0,0 +1,142 @@
+"""Latency and usage metrics, exposed in the Prometheus text format.
+
+Spans time the steps of a request (store access, prompt build, OpenAI
+calls, synthesis, serialization) into one histogram labelled by span name.
+Route latency, time to first token and token usage have their own series.
+Values that other components already count, like routing decisions or the
+synthesizer pool, are read by collectors when /metrics is scraped.
+
+Metrics are per process; with several workers, scrape each one or
+aggregate upstream.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds. Covers a cache hit up to a slow OpenAI completion.
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _labels(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        (key, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in pairs
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """Thread-safe registry of counters and histograms"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+        self._collectors = []
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def span(self, name, **labels):
+        """Time a block into span_duration_seconds{span=name}"""
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            # Not BaseException: a closed generator (client went away) isn't an error
+            self.inc("span_errors_total", span=name, **labels)
+            raise
+        finally:
+            self.observe("span_duration_seconds", time.perf_counter() - start, span=name, **labels)
+
+    def add_collector(self, collect):
+        """Register a function returning (name, type, labels, value) samples at scrape time"""
+        self._collectors.append(collect)
+
+    def render(self):
+        """All series in the Prometheus text exposition format"""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(
+                (key, (h.buckets, list(h.counts), h.sum, h.count)) for key, h in self._histograms.items()
+            )
+
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name in described:
+                return
+            described.add(name)
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in counters:
+            header(name, "counter")
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+        for (name, labels), (buckets, counts, total, count) in histograms:
+            header(name, "histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', str(bound))])} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+
+        for collect in self._collectors:
+            for name, kind, labels, value in collect():
+                header(name, kind)
+                lines.append(f"{name}{_format_labels(_labels(labels))} {_format_value(value)}")
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+metrics.describe("http_request_duration_seconds", "Time to handle a request, by route")
+metrics.describe("span_duration_seconds", "Time spent in each step of a request")
+metrics.describe("span_errors_total", "Steps that raised")
+metrics.describe("llm_time_to_first_token_seconds", "Time until a streamed completion produced text")
+metrics.describe("llm_tokens_total", "Tokens reported by the OpenAI API")
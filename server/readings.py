@@ -0,0 +1,165 @@
+"""Graded reading passages.
+
+Passages are written ahead of time by generate_readings.py, a few per
+target language, skill level and topic, so serving one costs no OpenAI
+call. They are kept in a SQLite table (READINGS_DB): each passage is
+stored as zlib-compressed JSON next to its indexed language, level and
+topic and an ETag of its content.
+
+ReadingCache holds the whole catalog in memory as ready-to-send JSON
+bodies and reloads it when the table changes, checking at most every
+READINGS_REFRESH seconds. A request is a dict lookup, or a 304 when the
+client already has the current version.
+"""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+
+from metrics import metrics
+
+LANGUAGES = ('en', 'es', 'fr', 'de', 'it', 'zh')
+SKILL_LEVELS = ('beginner', 'intermediate', 'advanced')
+TOPICS = ('daily life', 'food', 'travel', 'family', 'work', 'hobbies', 'city life', 'nature')
+
+# Seconds between checks for a regenerated catalog
+REFRESH_INTERVAL = float(os.getenv('READINGS_REFRESH', '30'))
+
+
+def reading_id(target_lang, skill_level, topic, number):
+    """Stable id, so regenerating a passage replaces it rather than adding one"""
+    slug = re.sub(r'[^a-z0-9]+', '-', topic.lower()).strip('-')
+    return f'{target_lang}-{skill_level}-{slug}-{number}'
+
+
+class ReadingStore:
+    """Passages in SQLite, indexed by language, level and topic"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS readings ('
+            ' reading_id TEXT PRIMARY KEY,'
+            ' target_lang TEXT NOT NULL,'
+            ' skill_level TEXT NOT NULL,'
+            ' topic TEXT NOT NULL,'
+            ' title TEXT NOT NULL,'
+            ' words INTEGER NOT NULL,'
+            ' etag TEXT NOT NULL,'
+            ' payload BLOB NOT NULL,'
+            ' created_at REAL NOT NULL)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS readings_catalog ON readings (target_lang, skill_level, topic)')
+
+    @property
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def put(self, reading):
+        """Store a passage: a dict with reading_id, target_lang, skill_level, topic, title and text"""
+        payload = json.dumps(reading, ensure_ascii=False, sort_keys=True).encode('utf-8')
+        etag = hashlib.sha256(payload).hexdigest()[:20]
+        self._conn.execute(
+            'INSERT OR REPLACE INTO readings '
+            '(reading_id, target_lang, skill_level, topic, title, words, etag, payload, created_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (reading['reading_id'], reading['target_lang'], reading['skill_level'], reading['topic'],
+             reading['title'], len(reading['text'].split()), etag, zlib.compress(payload, 9), time.time())
+        )
+
+    def exists(self, reading_id):
+        row = self._conn.execute('SELECT 1 FROM readings WHERE reading_id = ?', (reading_id,)).fetchone()
+        return row is not None
+
+    def version(self):
+        """Changes whenever a passage is added or replaced"""
+        return self._conn.execute('SELECT COUNT(*), MAX(created_at) FROM readings').fetchone()
+
+    def all(self):
+        """Yield (summary, etag, passage) for every passage, in catalog order"""
+        rows = self._conn.execute(
+            'SELECT reading_id, topic, title, words, etag, payload FROM readings '
+            'ORDER BY target_lang, skill_level, topic, reading_id'
+        )
+        for reading_id, topic, title, words, etag, payload in rows:
+            summary = {'reading_id': reading_id, 'topic': topic, 'title': title, 'words': words}
+            yield summary, etag, json.loads(zlib.decompress(payload))
+
+
+class ReadingCache:
+    """The catalog and every passage as encoded JSON with its ETag, reloaded when the store changes"""
+
+    def __init__(self, store, refresh_interval=REFRESH_INTERVAL):
+        self.store = store
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked = 0
+        self._readings = {}
+        self._catalogs = {}
+        self._refresh()
+
+    def reading(self, reading_id):
+        """(body, etag) of a passage, or None"""
+        self._maybe_refresh()
+        return self._readings.get(reading_id)
+
+    def catalog(self, target_lang, skill_level):
+        """(body, etag) listing the passages for a language and level"""
+        self._maybe_refresh()
+        catalog = self._catalogs.get((target_lang, skill_level))
+        if catalog is None:
+            catalog = _encode({'target_lang': target_lang, 'skill_level': skill_level, 'readings': []})
+        return catalog
+
+    def _maybe_refresh(self):
+        if time.monotonic() - self._checked < self.refresh_interval:
+            return
+        with self._lock:
+            if time.monotonic() - self._checked >= self.refresh_interval:
+                self._refresh()
+
+    def _refresh(self):
+        self._checked = time.monotonic()
+        version = self.store.version()
+        if version == self._version:
+            return
+        readings = {}
+        listed = {}
+        for summary, etag, passage in self.store.all():
+            readings[summary['reading_id']] = (json.dumps(passage, ensure_ascii=False).encode('utf-8'), etag)
+            listed.setdefault((passage['target_lang'], passage['skill_level']), []).append(summary)
+        catalogs = {
+            (target_lang, skill_level): _encode(
+                {'target_lang': target_lang, 'skill_level': skill_level, 'readings': summaries}
+            )
+            for (target_lang, skill_level), summaries in listed.items()
+        }
+        # Swapped in whole, so readers never see half a reload
+        self._readings, self._catalogs, self._version = readings, catalogs, version
+        metrics.inc('readings_reloads_total')
+
+
+def _encode(document):
+    body = json.dumps(document, ensure_ascii=False).encode('utf-8')
+    return body, hashlib.sha256(body).hexdigest()[:20]
+
+
+def open_reading_store(path=None):
+    return ReadingStore(path or os.getenv('READINGS_DB', 'readings.db'))
+
+
+metrics.describe('readings_reloads_total', 'Times the reading cache reloaded a changed catalog')
+metrics.describe('readings_requests_total', 'Reading requests, by kind and result (ok, not_modified, missing)')
@@ -0,0 +1,200 @@
+"""Per-user admission control for /chat.
+
+A double-clicked send button or a client retry used to run the whole turn
+twice: two OpenAI calls, and the user message appended to the conversation
+twice. RequestGuard makes concurrent duplicates share one call:
+
+- Requests are keyed by user and the Idempotency-Key header. The first
+  one runs the turn, and duplicates wait for its result. With the header,
+  a retry that arrives after the turn finished gets the stored result for
+  IDEMPOTENCY_TTL seconds. Without the header, only requests with the same
+  message that are in flight together are merged.
+- Each user may have CHAT_MAX_IN_FLIGHT turns running at once (default
+  1, so a conversation's messages are appended and answered in order).
+  Duplicates don't take a slot: they wait for the turn they duplicate.
+- A token bucket per user allows CHAT_RATE_PER_MINUTE requests a minute,
+  with bursts up to CHAT_RATE_BURST.
+
+Rejected requests get a 429 with Retry-After.
+
+The buckets, in-flight counts, kept results and the claim on a running
+turn are kept in shared_state, so with SHARED_STATE=sqlite they hold
+across workers: a duplicate that reaches another worker polls for the
+original's result instead of running the turn again.
+"""
+import hashlib
+import math
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+from metrics import metrics
+from shared_state import shared_state
+
+MAX_IN_FLIGHT = int(os.getenv('CHAT_MAX_IN_FLIGHT', '1'))
+RATE_PER_MINUTE = float(os.getenv('CHAT_RATE_PER_MINUTE', '30'))
+RATE_BURST = float(os.getenv('CHAT_RATE_BURST', '10'))
+IDEMPOTENCY_TTL = float(os.getenv('IDEMPOTENCY_TTL', '300'))
+# How long a duplicate waits for the original before giving up (seconds)
+COALESCE_TIMEOUT = float(os.getenv('COALESCE_TIMEOUT', '120'))
+
+# Buckets idle this long are full again and can be dropped
+BUCKET_IDLE = 3600
+# How often a duplicate checks on a turn running in another worker (seconds)
+REMOTE_POLL = 0.05
+
+
+class RateLimited(Exception):
+    """The request was refused; retry after `retry_after` seconds"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class ChatAborted(Exception):
+    """The request a duplicate was waiting on ended without a result"""
+
+
+class TokenBuckets:
+    """One token bucket per user, kept under `namespace` in shared_state"""
+
+    def __init__(self, rate_per_minute, burst, state=None, namespace='chat_rate'):
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        self.state = state or shared_state
+        self.namespace = namespace
+
+    def take(self, user_id):
+        """Take a token; return 0, or the seconds until one is available"""
+        if self.rate <= 0:
+            return 0
+
+        def take(bucket):
+            # Wall-clock time, so every worker refills the bucket the same way
+            now = time.time()
+            tokens, updated = bucket or (self.burst, now)
+            tokens = min(self.burst, tokens + max(0, now - updated) * self.rate)
+            if tokens >= 1:
+                return [tokens - 1, now], 0
+            return [tokens, now], (1 - tokens) / self.rate
+
+        return self.state.update(self.namespace, user_id, take, ttl=BUCKET_IDLE)
+
+
+class RequestGuard:
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT, rate_per_minute=RATE_PER_MINUTE, burst=RATE_BURST,
+                 result_ttl=IDEMPOTENCY_TTL, state=None):
+        self.max_in_flight = max_in_flight
+        self.state = state or shared_state
+        self.buckets = TokenBuckets(rate_per_minute, burst, self.state)
+        self.result_ttl = result_ttl
+        self._lock = threading.Lock()
+        # key -> Future of a turn this process runs
+        self._led = {}
+        # key -> Future of a turn another worker runs, shared by the duplicates here
+        self._awaited = {}
+
+    # --- Limits ---
+
+    def limit_rate(self, user_id):
+        """Count a request against the user's rate, or raise RateLimited"""
+        wait = self.buckets.take(user_id)
+        if wait:
+            metrics.inc('chat_guard_total', outcome='rate_limited')
+            raise RateLimited('Too many messages, slow down', math.ceil(wait))
+
+    def acquire(self, user_id):
+        """Take one of the user's in-flight slots for a turn, or raise RateLimited. Pair with release()."""
+        def admit(count):
+            count = count or 0
+            if count >= self.max_in_flight:
+                return count or None, False
+            return count + 1, True
+
+        # Expires in case the worker holding the slots dies
+        if not self.state.update('chat_in_flight', user_id, admit, ttl=COALESCE_TIMEOUT):
+            metrics.inc('chat_guard_total', outcome='in_flight_limited')
+            raise RateLimited('Another message is still being answered', 1)
+
+    def release(self, user_id):
+        self.state.incr('chat_in_flight', user_id, -1, ttl=COALESCE_TIMEOUT)
+
+    # --- Coalescing ---
+
+    @staticmethod
+    def key(user_id, message, idempotency_key=None):
+        if idempotency_key:
+            return f'{user_id}:key:{idempotency_key}'
+        digest = hashlib.sha256(message.encode('utf-8')).hexdigest()
+        return f'{user_id}:message:{digest}'
+
+    def join(self, key):
+        """Return (future, leader). The leader runs the turn and settles the future with resolve()/reject()."""
+        with self._lock:
+            future = self._led.get(key) or self._awaited.get(key)
+            if future is not None:
+                metrics.inc('chat_guard_total', outcome='coalesced')
+                return future, False
+            while True:
+                if self.state.add('chat_calls', key, {'running': True}, ttl=COALESCE_TIMEOUT):
+                    future = self._led[key] = Future()
+                    return future, True
+                call = self.state.get('chat_calls', key)
+                if call is None:
+                    # Finished between the two calls; try to claim it again
+                    continue
+                future = Future()
+                if 'result' in call:
+                    metrics.inc('chat_guard_total', outcome='replayed')
+                    future.set_result(call['result'])
+                    return future, False
+                metrics.inc('chat_guard_total', outcome='coalesced')
+                self._awaited[key] = future
+                break
+        threading.Thread(target=self._await_elsewhere, args=(key, future), daemon=True).start()
+        return future, False
+
+    def resolve(self, key, result, keep=False):
+        """Hand the turn's result to any duplicates; keep it for later retries if the client sent a key"""
+        with self._lock:
+            future = self._led.get(key)
+        if future is None:
+            return
+        if keep and self.result_ttl > 0:
+            self.state.set('chat_calls', key, {'result': result}, ttl=self.result_ttl)
+        else:
+            self.state.delete('chat_calls', key)
+        with self._lock:
+            self._led.pop(key, None)
+        future.set_result(result)
+
+    def reject(self, key, error):
+        """The turn failed; duplicates fail too, and a retry runs it again"""
+        with self._lock:
+            future = self._led.pop(key, None)
+        if future is None:
+            return
+        self.state.delete('chat_calls', key)
+        future.set_exception(error)
+
+    def _await_elsewhere(self, key, future):
+        """Poll for the result of a turn another worker is running"""
+        deadline = time.monotonic() + COALESCE_TIMEOUT
+        call = {'running': True}
+        while time.monotonic() < deadline:
+            time.sleep(REMOTE_POLL)
+            call = self.state.get('chat_calls', key)
+            if call is None or 'result' in call:
+                break
+        with self._lock:
+            self._awaited.pop(key, None)
+        if call is not None and 'result' in call:
+            future.set_result(call['result'])
+        else:
+            future.set_exception(ChatAborted())
+
+
+metrics.describe('chat_guard_total', 'Chat requests refused or merged with a duplicate, by outcome')
@@ -1,93 +1,350 @@
 #!/usr/bin/env python3
+"""Session analytics.
+
+Summarizes a directory of Flask-Session files, or the conversation store
+database, into aggregate statistics rather than dumping session contents:
+
+- total and active sessions
+- conversation length distribution
+- language pairs
+- stored bytes and estimated signed-cookie bytes (the size a session would
+  have as a client-side cookie, and how many would exceed the 4KB limit)
+
+    python session_reader.py flask_session
+    python session_reader.py flask_session --format csv --output sessions.csv
+    python session_reader.py --db conversations.db --active-within 600
+
+Session files come in three formats: cachelib's (a 4-byte expiry header
+followed by a pickle), plain pickle and JSON. The format is detected from
+the first file and only re-detected for files that don't match. Files are
+parsed in a process pool, and an index of per-file results keyed by mtime
+and size lets later runs skip files that haven't changed.
+"""
+import argparse
+import base64
+import csv
+import io
+import json
 import os
 import pickle
-import json
-from datetime import datetime
-
-def read_session_file(filepath):
-    """Safely read a Flask session file with multiple methods"""
-    print(f"\n=== Reading: {os.path.basename(filepath)} ===")
-    
-    # Check file size
-    file_size = os.path.getsize(filepath)
-    print(f"File size: {file_size} bytes")
-    
-    if file_size == 0:
-        print("File is empty")
-        return
-    
-    # Try to read raw bytes first
-    with open(filepath, 'rb') as f:
-        raw_data = f.read()
-        print(f"First 20 bytes (hex): {raw_data[:20].hex()}")
-        print(f"First 20 bytes (raw): {raw_data[:20]}")
-    
-    # Try pickle
+import sqlite3
+import struct
+import sys
+import time
+import zlib
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+# Browsers drop cookies larger than this
+COOKIE_LIMIT = 4093
+
+LENGTH_BUCKETS = ((0, 0), (1, 5), (6, 10), (11, 20), (21, 50), (51, 100), (101, None))
+
+INDEX_VERSION = 1
+
+
+# --- Decoding ---
+
+def detect_format(data):
+    """Guess how a session file was written from its first bytes"""
+    if data[:1] in (b"{", b"["):
+        return "json"
+    if data[:1] == b"\x80":
+        return "pickle"
+    if len(data) > 4 and data[4:5] == b"\x80":
+        return "cachelib"
+    return None
+
+
+def _unpack_value(value):
+    # Flask-Session 0.6+ stores msgpack-encoded bytes inside the cache pickle
+    if isinstance(value, (bytes, bytearray)):
+        try:
+            import msgspec
+            return msgspec.msgpack.decode(value)
+        except ImportError:
+            return json.loads(value)
+    return value
+
+
+def decode(data, fmt):
+    """Return (session dict, expiry timestamp or None)"""
+    if fmt == "json":
+        return json.loads(data), None
+    if fmt == "pickle":
+        return _unpack_value(pickle.loads(data)), None
+    if fmt == "cachelib":
+        expires = struct.unpack("I", data[:4])[0]
+        return _unpack_value(pickle.loads(data[4:])), expires or None
+    raise ValueError(f"Unknown session format: {fmt}")
+
+
+def cookie_bytes(session):
+    """Approximate size of the session as a Flask signed cookie.
+
+    Flask serializes the session as compact JSON, zlib-compresses it when
+    that is shorter, base64-encodes it and appends a timestamp and an
+    HMAC-SHA1 signature.
+    """
+    payload = json.dumps(session, separators=(",", ":"), default=str).encode("utf-8")
+    compressed = zlib.compress(payload)
+    body = len(base64.urlsafe_b64encode(payload).rstrip(b"="))
+    if len(compressed) < len(payload) - 1:
+        body = 1 + len(base64.urlsafe_b64encode(compressed).rstrip(b"="))
+    # ".<timestamp>.<signature>"
+    return body + 1 + 6 + 1 + 27
+
+
+def summarize_session(session):
+    """The fields the statistics need from one session"""
+    background = session.get("user_background") or {}
+    native = background.get("native_lang") or session.get("native_lang")
+    target = background.get("target_lang") or session.get("target_lang")
+    messages = session.get("messages")
+    return {
+        "user_id": session.get("user_id"),
+        "messages": len(messages) if isinstance(messages, list) else 0,
+        "language_pair": f"{native or '?'}->{target or '?'}",
+        "cookie_bytes": cookie_bytes(session),
+    }
+
+
+def analyze_file(task):
+    """Parse one session file. Runs in a worker process."""
+    path, fmt = task
     try:
-        with open(filepath, 'rb') as f:
-            session_data = pickle.load(f)
-            print("✅ Pickle format - SUCCESS")
-            print("Session data:")
-            for key, value in session_data.items():
-                if key == 'messages' and isinstance(value, list):
-                    print(f"  {key}: [{len(value)} messages]")
-                    for i, msg in enumerate(value[-3:]):  # Show last 3 messages
-                        print(f"    {i}: {msg}")
-                else:
-                    print(f"  {key}: {value}")
-            return session_data
-    except Exception as e:
-        print(f"❌ Pickle failed: {e}")
-    
-    # Try JSON
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError as e:
+        return path, {"error": str(e)}
+    record = {"bytes": len(data)}
+    if not data:
+        record["error"] = "empty"
+        return path, record
+
+    formats = [fmt] if fmt else []
+    detected = detect_format(data)
+    if detected and detected not in formats:
+        formats.append(detected)
+    for candidate in formats:
+        try:
+            session, expires = decode(data, candidate)
+        except Exception:
+            continue
+        if not isinstance(session, dict):
+            continue
+        record.update(summarize_session(session), format=candidate, expires=expires)
+        return path, record
+
+    record["error"] = "unreadable"
+    return path, record
+
+
+# --- Sources ---
+
+def load_index(path):
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            session_data = json.load(f)
-            print("✅ JSON format - SUCCESS")
-            print("Session data:", session_data)
-            return session_data
-    except Exception as e:
-        print(f"❌ JSON failed: {e}")
-    
-    # Try as text
+        with open(path) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if index.get("version") != INDEX_VERSION:
+        return {}
+    return index.get("files", {})
+
+
+def save_index(path, files):
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump({"version": INDEX_VERSION, "files": files}, f)
+    os.replace(temp_path, path)
+
+
+def scan_directory(directory, index_path=None, workers=None):
+    """Return one record per session file, reusing indexed results for unchanged files"""
+    index = load_index(index_path) if index_path else {}
+    entries = {}
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.name.startswith(".") or not entry.is_file():
+                continue
+            stat = entry.stat()
+            entries[entry.path] = (stat.st_mtime, stat.st_size)
+
+    files, changed = {}, []
+    for path, (mtime, size) in entries.items():
+        cached = index.get(path)
+        if cached and cached["mtime"] == mtime and cached["size"] == size:
+            files[path] = cached
+        else:
+            changed.append(path)
+
+    fmt = None
+    for path in changed:
+        with open(path, "rb") as f:
+            fmt = detect_format(f.read(8))
+        if fmt:
+            break
+
+    if changed:
+        workers = workers or os.cpu_count()
+        chunksize = max(1, min(256, len(changed) // (workers * 4) or 1))
+        tasks = ((path, fmt) for path in changed)
+        if workers > 1 and len(changed) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(analyze_file, tasks, chunksize=chunksize))
+        else:
+            results = [analyze_file(task) for task in tasks]
+        for path, record in results:
+            mtime, size = entries[path]
+            files[path] = {"mtime": mtime, "size": size, "record": record}
+
+    if index_path:
+        save_index(index_path, files)
+    return [dict(file["record"], mtime=file["mtime"]) for file in files.values()], len(changed)
+
+
+def scan_database(db_path):
+    """Return one record per session in the conversation store"""
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            content = f.read()
-            print("✅ Text format - SUCCESS")
-            print("Content:", content[:200] + "..." if len(content) > 200 else content)
-            return content
-    except Exception as e:
-        print(f"❌ Text failed: {e}")
-    
-    print("❌ Could not read file in any known format")
-    return None
+        turn_bytes = dict(conn.execute(
+            "SELECT session_id, SUM(LENGTH(content)) FROM turns GROUP BY session_id"
+        ))
+        records = []
+        for session_id, user_id, turn_count, state, updated_at in conn.execute(
+            "SELECT session_id, user_id, turn_count, state, updated_at FROM sessions"
+        ):
+            session = json.loads(state)
+            session["user_id"] = user_id
+            record = summarize_session(session)
+            record.update(
+                format="sqlite",
+                messages=turn_count,
+                bytes=len(state) + (turn_bytes.get(session_id) or 0),
+                mtime=updated_at,
+                expires=None,
+            )
+            # Estimate the cookie the conversation would need if it still lived client-side
+            session["messages"] = [None] * turn_count
+            record["cookie_bytes"] = cookie_bytes(session) + (turn_bytes.get(session_id) or 0)
+            records.append(record)
+        return records
+    finally:
+        conn.close()
+
+
+# --- Statistics ---
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))]
+
+
+def aggregate(records, active_within, now=None):
+    now = now or time.time()
+    readable = [r for r in records if "error" not in r]
+    active = [
+        r for r in readable
+        if (r.get("expires") is None or r["expires"] >= now) and now - r["mtime"] <= active_within
+    ]
+    lengths = [r["messages"] for r in readable]
+    cookies = [r["cookie_bytes"] for r in readable]
+    stored = [r.get("bytes", 0) for r in records]
+
+    distribution = {}
+    for low, high in LENGTH_BUCKETS:
+        label = str(low) if low == high else (f"{low}+" if high is None else f"{low}-{high}")
+        distribution[label] = sum(1 for n in lengths if n >= low and (high is None or n <= high))
+
+    return {
+        "sessions": len(records),
+        "unreadable": len(records) - len(readable),
+        "active_sessions": len(active),
+        "users": len({r["user_id"] for r in readable if r.get("user_id")}),
+        "formats": dict(Counter(r.get("format", "unknown") for r in readable)),
+        "conversation_length": {
+            "mean": sum(lengths) / len(lengths) if lengths else 0,
+            "p50": percentile(lengths, 50),
+            "p90": percentile(lengths, 90),
+            "max": max(lengths, default=0),
+            "distribution": distribution,
+        },
+        "language_pairs": dict(Counter(r["language_pair"] for r in readable).most_common()),
+        "stored_bytes": {
+            "total": sum(stored),
+            "mean": sum(stored) / len(stored) if stored else 0,
+        },
+        "cookie_bytes": {
+            "mean": sum(cookies) / len(cookies) if cookies else 0,
+            "p90": percentile(cookies, 90),
+            "max": max(cookies, default=0),
+            "over_limit": sum(1 for size in cookies if size > COOKIE_LIMIT),
+        },
+    }
+
+
+def to_csv(stats):
+    """Flatten the statistics into metric,key,value rows"""
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(["metric", "key", "value"])
+
+    def walk(prefix, value):
+        if isinstance(value, dict):
+            nested = any(isinstance(v, dict) for v in value.values())
+            for key, item in value.items():
+                if isinstance(item, dict) or nested:
+                    walk(f"{prefix}.{key}" if prefix else key, item)
+                else:
+                    writer.writerow([prefix, key, item])
+        else:
+            metric, _, key = prefix.rpartition(".")
+            writer.writerow([metric or key, key if metric else "", value])
+
+    walk("", stats)
+    return out.getvalue()
+
 
 def main():
-    session_dir = 'flask_session'
-    
-    if not os.path.exists(session_dir):
-        print(f"❌ Directory {session_dir} does not exist")
-        return
-    
-    session_files = [f for f in os.listdir(session_dir) if not f.startswith('.')]
-    
-    if not session_files:
-        print(f"❌ No session files found in {session_dir}")
-        return
-    
-    print(f"Found {len(session_files)} session files:")
-    
-    for filename in session_files:
-        filepath = os.path.join(session_dir, filename)
-        
-        # Get file timestamp
-        mtime = os.path.getmtime(filepath)
-        timestamp = datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M:%S')
-        print(f"\n📁 {filename} (modified: {timestamp})")
-        
-        read_session_file(filepath)
-    
-    print(f"\n✅ Finished reading {len(session_files)} session files")
+    parser = argparse.ArgumentParser(description="Aggregate statistics over stored chat sessions")
+    parser.add_argument("directory", nargs="?", default="flask_session", help="Flask-Session file directory")
+    parser.add_argument("--db", help="read the conversation store database instead of session files")
+    parser.add_argument("--workers", type=int, help="parser processes (default: CPU count)")
+    parser.add_argument("--index", help="index file for skipping unchanged files (default: <directory>/.session_index.json)")
+    parser.add_argument("--no-index", action="store_true")
+    parser.add_argument("--active-within", type=float, default=86400,
+                        help="seconds since last write for a session to count as active")
+    parser.add_argument("--format", choices=["json", "csv"], default="json")
+    parser.add_argument("--output", help="write here instead of stdout")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.db:
+        records, parsed = scan_database(args.db), None
+    else:
+        if not os.path.isdir(args.directory):
+            sys.exit(f"Directory {args.directory} does not exist")
+        index_path = None if args.no_index else (args.index or os.path.join(args.directory, ".session_index.json"))
+        records, parsed = scan_directory(args.directory, index_path, args.workers)
+
+    stats = aggregate(records, args.active_within)
+    stats["scan"] = {
+        "source": args.db or args.directory,
+        "parsed": len(records) if parsed is None else parsed,
+        "reused": 0 if parsed is None else len(records) - parsed,
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+
+    output = to_csv(stats) if args.format == "csv" else json.dumps(stats, indent=2) + "\n"
+    if args.output:
+        with open(args.output, "w", newline="") as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output)
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
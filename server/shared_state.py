@@ -0,0 +1,246 @@
+"""State that every worker process on a host sees the same way.
+
+Rate limits, duplicate-request results, model SLO fallbacks and the
+users.json lock used to live in each process, so with several workers a
+learner got one rate limit per worker, a retry that reached another
+worker ran the turn again, and concurrent users.json writes were lost.
+They now go through a small key-value interface with expiry:
+
+- get / set / delete, and add (set only if absent) for claims
+- incr, and update(fn) for any atomic read-modify-write
+- lock(name), held across processes
+
+Keys live in namespaces, and values are anything JSON can encode.
+SHARED_STATE selects the backend:
+
+- local (default): a dict in this process, for a single worker
+- sqlite: a table in SHARED_STATE_DB, shared by all workers on the host.
+  Each call is one short SQLite transaction (WAL mode).
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from metrics import metrics
+from startup import Lazy
+
+# Clean up expired keys at most this often (seconds)
+PRUNE_INTERVAL = 60
+# Retry interval while waiting for a lock another process holds (seconds)
+LOCK_POLL = 0.01
+
+
+class LockTimeout(Exception):
+    """A lock was not acquired in time"""
+
+
+class SharedState:
+    """Interface: namespaced keys with optional expiry (ttl in seconds)"""
+
+    def get(self, namespace, key):
+        raise NotImplementedError
+
+    def set(self, namespace, key, value, ttl=None):
+        raise NotImplementedError
+
+    def add(self, namespace, key, value, ttl=None):
+        """Set the key only if it is absent or expired; return whether it was set"""
+        raise NotImplementedError
+
+    def delete(self, namespace, key):
+        raise NotImplementedError
+
+    def update(self, namespace, key, fn, ttl=None):
+        """Atomically replace the value with fn(value)[0] and return fn(value)[1].
+
+        fn gets None for a missing key; a new value of None deletes the key.
+        """
+        raise NotImplementedError
+
+    def incr(self, namespace, key, amount=1, ttl=None):
+        """Add to a counter and return its new value; counters that reach 0 are deleted"""
+        def add(value):
+            total = (value or 0) + amount
+            return (total if total > 0 else None), total
+        return self.update(namespace, key, add, ttl)
+
+    @contextmanager
+    def lock(self, name, timeout=30, ttl=60):
+        """Hold `name` across workers; a lock whose holder died is freed after ttl seconds"""
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + timeout
+        while not self.add('lock', name, token, ttl):
+            if time.monotonic() > deadline:
+                metrics.inc('shared_state_lock_timeouts_total', lock=name)
+                raise LockTimeout(name)
+            time.sleep(LOCK_POLL)
+        try:
+            yield
+        finally:
+            self.update('lock', name, lambda held: (None if held == token else held, None))
+
+
+class LocalState(SharedState):
+    """Dict in this process"""
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+        self._last_prune = time.time()
+
+    def _live(self, namespace, key, now):
+        entry = self._values.get((namespace, key))
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires is not None and expires <= now:
+            del self._values[(namespace, key)]
+            return None
+        return entry
+
+    def _put(self, namespace, key, value, ttl, now):
+        self._values[(namespace, key)] = (value, None if ttl is None else now + ttl)
+        if now - self._last_prune > PRUNE_INTERVAL:
+            self._last_prune = now
+            self._values = {
+                name: entry for name, entry in self._values.items() if entry[1] is None or entry[1] > now
+            }
+
+    def get(self, namespace, key):
+        with self._lock:
+            entry = self._live(namespace, key, time.time())
+            return None if entry is None else entry[0]
+
+    def set(self, namespace, key, value, ttl=None):
+        with self._lock:
+            self._put(namespace, key, value, ttl, time.time())
+
+    def add(self, namespace, key, value, ttl=None):
+        now = time.time()
+        with self._lock:
+            if self._live(namespace, key, now) is not None:
+                return False
+            self._put(namespace, key, value, ttl, now)
+            return True
+
+    def delete(self, namespace, key):
+        with self._lock:
+            self._values.pop((namespace, key), None)
+
+    def update(self, namespace, key, fn, ttl=None):
+        now = time.time()
+        with self._lock:
+            entry = self._live(namespace, key, now)
+            value, result = fn(None if entry is None else entry[0])
+            if value is None:
+                self._values.pop((namespace, key), None)
+            else:
+                self._put(namespace, key, value, ttl, now)
+            return result
+
+
+class SQLiteState(SharedState):
+    """Table in a SQLite database, shared by the processes on a host"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._last_prune = 0
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS shared_state ('
+            ' namespace TEXT NOT NULL,'
+            ' key TEXT NOT NULL,'
+            ' value TEXT NOT NULL,'
+            ' expires_at REAL,'
+            ' PRIMARY KEY (namespace, key)) WITHOUT ROWID'
+        )
+
+    @property
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _read(conn, namespace, key, now):
+        row = conn.execute(
+            'SELECT value FROM shared_state WHERE namespace = ? AND key = ? '
+            'AND (expires_at IS NULL OR expires_at > ?)',
+            (namespace, key, now)
+        ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    @staticmethod
+    def _write(conn, namespace, key, value, ttl, now):
+        conn.execute(
+            'INSERT OR REPLACE INTO shared_state (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)',
+            (namespace, key, json.dumps(value), None if ttl is None else now + ttl)
+        )
+
+    def get(self, namespace, key):
+        return self._read(self._conn, namespace, key, time.time())
+
+    def set(self, namespace, key, value, ttl=None):
+        now = time.time()
+        self._write(self._conn, namespace, key, value, ttl, now)
+        self._maybe_prune(now)
+
+    def add(self, namespace, key, value, ttl=None):
+        now = time.time()
+        # An expired row counts as absent, so it is replaced rather than kept
+        added = self._conn.execute(
+            'INSERT INTO shared_state (namespace, key, value, expires_at) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at '
+            'WHERE shared_state.expires_at IS NOT NULL AND shared_state.expires_at <= ?',
+            (namespace, key, json.dumps(value), None if ttl is None else now + ttl, now)
+        ).rowcount
+        return added > 0
+
+    def delete(self, namespace, key):
+        self._conn.execute('DELETE FROM shared_state WHERE namespace = ? AND key = ?', (namespace, key))
+
+    def update(self, namespace, key, fn, ttl=None):
+        conn = self._conn
+        now = time.time()
+        # Serializes read-modify-writes across workers
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            value, result = fn(self._read(conn, namespace, key, now))
+            if value is None:
+                conn.execute('DELETE FROM shared_state WHERE namespace = ? AND key = ?', (namespace, key))
+            else:
+                self._write(conn, namespace, key, value, ttl, now)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        self._maybe_prune(now)
+        return result
+
+    def _maybe_prune(self, now):
+        if now - self._last_prune > PRUNE_INTERVAL:
+            self._last_prune = now
+            self._conn.execute('DELETE FROM shared_state WHERE expires_at <= ?', (now,))
+
+
+def open_shared_state():
+    """The backend configured by SHARED_STATE and SHARED_STATE_DB"""
+    backend = os.getenv('SHARED_STATE', 'local')
+    if backend == 'sqlite':
+        return SQLiteState(os.getenv('SHARED_STATE_DB', 'shared_state.db'))
+    if backend == 'local':
+        return LocalState()
+    raise ValueError(f'Unknown SHARED_STATE backend: {backend}')
+
+
+# Opened on first use, so importing this module doesn't touch SHARED_STATE_DB
+shared_state = Lazy('shared_state', open_shared_state)
+metrics.describe('shared_state_lock_timeouts_total', 'Shared locks not acquired in time, by lock')
@@ -0,0 +1,166 @@
+"""Speak a reply while it is still being generated.
+
+A spoken reply used to need the whole completion, then a second request
+that synthesized the whole text. Here the streamed reply is cut into
+sentences as they complete, each sentence is synthesized on a worker pool
+as soon as it is cut, and the audio comes back in sentence order. The
+first sentence can play while the model is still writing the rest.
+
+    pipeline = SpeechPipeline()
+    for event in pipeline.run(deltas, synthesize):
+        ...  # ("delta", text) or ("audio", index, sentence, result, error)
+
+run_async() does the same for async deltas, synthesizing on threads.
+"""
+import asyncio
+import os
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import anyio
+
+SPEECH_THREADS = int(os.getenv('SPEECH_PIPELINE_THREADS', '16'))
+# Shorter fragments ("Sí.", "¡Ah!") are joined to the next sentence. Measured
+# by spoken_length, so a Chinese or Japanese character counts as several
+MIN_SENTENCE_CHARS = int(os.getenv('SPEECH_MIN_SENTENCE_CHARS', '10'))
+# A run-on without an end mark is cut at a comma or space past this length
+MAX_SENTENCE_CHARS = int(os.getenv('SPEECH_MAX_SENTENCE_CHARS', '240'))
+
+# An end mark, any closing quotes or brackets, then whitespace. CJK end marks
+# need no whitespace after them.
+SENTENCE_END = re.compile(r'(?:[.!?…]+["\'”’»)\]]*\s+|[。！？]+["”’」』)]*\s*|\n+)')
+# Han and kana: each character is about a syllable, or three Latin letters of speech
+WIDE_CHARS = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]')
+WIDE_CHAR_WEIGHT = 3
+# Words whose trailing period doesn't end a sentence
+ABBREVIATIONS = {
+    'mr', 'mrs', 'ms', 'dr', 'sr', 'sra', 'srta', 'ud', 'uds', 'st', 'vs', 'etc',
+    'p.ej', 'e.g', 'i.e', 'mme', 'mlle', 'hr', 'fr', 'z.b', 'sig', 'dott',
+}
+
+
+def spoken_length(text):
+    """Length of text in Latin-letter equivalents, for comparing sentences across scripts"""
+    return len(text) + (WIDE_CHAR_WEIGHT - 1) * len(WIDE_CHARS.findall(text))
+
+
+class SentenceSplitter:
+    """Cut streamed text into sentences as soon as each one is complete"""
+
+    def __init__(self, min_chars=MIN_SENTENCE_CHARS, max_chars=MAX_SENTENCE_CHARS):
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.buffer = ''
+
+    def feed(self, text):
+        """Add streamed text; return the sentences it completed"""
+        self.buffer += text
+        sentences = []
+        start = 0
+        for match in SENTENCE_END.finditer(self.buffer):
+            end = match.end()
+            if self._is_abbreviation(self.buffer[:match.start()]):
+                continue
+            if spoken_length(self.buffer[start:end].strip()) < self.min_chars:
+                continue
+            sentences.append(self.buffer[start:end].strip())
+            start = end
+        self.buffer = self.buffer[start:]
+
+        while len(self.buffer) > self.max_chars:
+            cut = self._soft_break(self.buffer[:self.max_chars])
+            sentences.append(self.buffer[:cut].strip())
+            self.buffer = self.buffer[cut:]
+        return [sentence for sentence in sentences if sentence]
+
+    def flush(self):
+        """The rest of the text, once the stream has ended"""
+        rest, self.buffer = self.buffer.strip(), ''
+        return [rest] if rest else []
+
+    @staticmethod
+    def _is_abbreviation(text):
+        word = text.rsplit(None, 1)[-1] if text.strip() else ''
+        word = word.lstrip('¿¡("\'').lower()
+        # Initials like "J." count too
+        return word in ABBREVIATIONS or (len(word) == 1 and word.isascii() and word.isalpha())
+
+    @staticmethod
+    def _soft_break(text):
+        for mark in (';', ',', ' '):
+            index = text.rfind(mark)
+            if index > 0:
+                return index + 1
+        return len(text)
+
+
+class SpeechPipeline:
+    """Synthesize sentences of a streamed reply in parallel, yielding audio in order"""
+
+    def __init__(self, max_workers=SPEECH_THREADS):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='speech-pipeline')
+
+    def run(self, deltas, synthesize):
+        """Yield ("delta", text) for each delta and ("audio", index, sentence, result, error) per sentence.
+
+        Audio events come in sentence order, each as soon as it and all
+        earlier sentences are synthesized. `error` is the exception if
+        synthesize raised for that sentence; the other sentences still play.
+        """
+        splitter = SentenceSplitter()
+        pending = deque()
+        index = 0
+        try:
+            for delta in deltas:
+                yield ('delta', delta)
+                for sentence in splitter.feed(delta):
+                    pending.append((index, sentence, self._pool.submit(synthesize, sentence)))
+                    index += 1
+                while pending and pending[0][2].done():
+                    yield _audio_event(*pending.popleft())
+
+            for sentence in splitter.flush():
+                pending.append((index, sentence, self._pool.submit(synthesize, sentence)))
+                index += 1
+            while pending:
+                yield _audio_event(*pending.popleft())
+        finally:
+            # The client went away or generation failed: drop queued sentences
+            for _, _, future in pending:
+                future.cancel()
+
+    async def run_async(self, deltas, synthesize, limiter=None):
+        """run() for an async iterator of deltas; synthesize runs on anyio worker threads"""
+        splitter = SentenceSplitter()
+        pending = deque()
+        index = 0
+
+        def submit(sentence):
+            return asyncio.ensure_future(anyio.to_thread.run_sync(synthesize, sentence, limiter=limiter))
+
+        try:
+            async for delta in deltas:
+                yield ('delta', delta)
+                for sentence in splitter.feed(delta):
+                    pending.append((index, sentence, submit(sentence)))
+                    index += 1
+                while pending and pending[0][2].done():
+                    yield _audio_event(*pending.popleft())
+
+            for sentence in splitter.flush():
+                pending.append((index, sentence, submit(sentence)))
+                index += 1
+            while pending:
+                await asyncio.wait({pending[0][2]})
+                yield _audio_event(*pending.popleft())
+        finally:
+            for _, _, task in pending:
+                task.cancel()
+
+
+def _audio_event(index, sentence, future):
+    try:
+        return ('audio', index, sentence, future.result(), None)
+    except Exception as e:
+        return ('audio', index, sentence, None, e)
@@ -0,0 +1,275 @@
+"""Pooled speech synthesizers.
+
+Creating an Azure SpeechConfig and SpeechSynthesizer and opening its
+connection costs a noticeable chunk of every TTS request. SynthesizerPool
+keeps a bounded number of ready synthesizers per (voice, format), hands
+them out one request at a time and recycles them after too many uses, too
+much age, or a failure.
+
+Synthesizers are created by a factory, so the pool can run against Azure
+(TTS_BACKEND=azure) or against FakeSynthesizer (TTS_BACKEND=fake), which
+needs no network or SDK and is used for offline testing and benchmarks.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from logs import get_logger
+
+log = get_logger("speech_pool")
+
+# Output formats: Azure format name, mimetype, file name.
+# MP3 and Opus are a fraction of the size of WAV.
+AUDIO_FORMATS = {
+    'wav': ('Riff24Khz16BitMonoPcm', 'audio/wav', 'speech.wav'),
+    'mp3': ('Audio24Khz48KBitRateMonoMp3', 'audio/mpeg', 'speech.mp3'),
+    'opus': ('Ogg24Khz16BitMonoOpus', 'audio/ogg', 'speech.ogg'),
+}
+
+STREAM_CHUNK_SIZE = 16000
+
+
+class SynthesisError(Exception):
+    """Synthesis was canceled or failed"""
+
+
+class AzureSynthesizer:
+    """An Azure SpeechSynthesizer for one voice and output format, with its own connection"""
+
+    def __init__(self, key, region, voice, audio_format):
+        import azure.cognitiveservices.speech as speechsdk
+        self.speechsdk = speechsdk
+
+        speech_config = speechsdk.SpeechConfig(subscription=key, region=region)
+        speech_config.speech_synthesis_voice_name = voice
+        speech_config.set_speech_synthesis_output_format(
+            getattr(speechsdk.SpeechSynthesisOutputFormat, AUDIO_FORMATS[audio_format][0])
+        )
+        # audio_config=None keeps the audio in memory instead of playing it on the server
+        self.synthesizer = speechsdk.SpeechSynthesizer(speech_config=speech_config, audio_config=None)
+        self.connection = speechsdk.Connection.from_speech_synthesizer(self.synthesizer)
+        self.dropped = False
+        self.connection.disconnected.connect(self._on_disconnected)
+
+    def _on_disconnected(self, event):
+        self.dropped = True
+
+    def warm_up(self):
+        """Open the connection now rather than on the first synthesis"""
+        self.connection.open(True)
+
+    def healthy(self):
+        # A synthesizer whose connection dropped is replaced rather than
+        # paying the reconnect on a user request
+        return not self.dropped
+
+    def synthesize(self, text):
+        """Synthesize the whole clip and return its bytes"""
+        result = self.synthesizer.speak_text_async(text).get()
+        if result.reason != self.speechsdk.ResultReason.SynthesizingAudioCompleted:
+            raise SynthesisError(self._describe_failure(result))
+        return result.audio_data
+
+    def stream(self, text):
+        """Yield audio chunks as they are synthesized"""
+        speechsdk = self.speechsdk
+        result = self.synthesizer.start_speaking_text_async(text).get()
+        if result.reason != speechsdk.ResultReason.SynthesizingAudioStarted:
+            raise SynthesisError(self._describe_failure(result))
+
+        audio_stream = speechsdk.AudioDataStream(result)
+        buffer = bytes(STREAM_CHUNK_SIZE)
+        while True:
+            filled = audio_stream.read_data(buffer)
+            if filled == 0:
+                break
+            yield buffer[:filled]
+
+        if audio_stream.status != speechsdk.StreamStatus.AllData:
+            raise SynthesisError(f'Speech synthesis stream ended early: {audio_stream.status}')
+
+    def _describe_failure(self, result):
+        speechsdk = self.speechsdk
+        if result.reason == speechsdk.ResultReason.Canceled:
+            details = result.cancellation_details
+            if details.reason == speechsdk.CancellationReason.Error:
+                return f'Speech synthesis failed: {details.error_details}'
+            return f'Speech synthesis canceled: {details.reason}'
+        return f'Unexpected synthesis result: {result.reason}'
+
+    def close(self):
+        try:
+            self.connection.close()
+        except Exception:
+            pass
+
+
+class FakeSynthesizer:
+    """Offline stand-in for AzureSynthesizer.
+
+    Produces deterministic bytes whose size grows with the text, after a
+    configurable delay per clip (FAKE_TTS_LATENCY_MS).
+    """
+
+    def __init__(self, voice, audio_format, latency=None, bytes_per_char=200):
+        self.voice = voice
+        self.audio_format = audio_format
+        if latency is None:
+            latency = float(os.getenv('FAKE_TTS_LATENCY_MS', '150')) / 1000
+        self.latency = latency
+        self.bytes_per_char = bytes_per_char
+
+    def warm_up(self):
+        pass
+
+    def healthy(self):
+        return True
+
+    def _audio(self, text):
+        header = f'FAKE {self.audio_format} {self.voice}\n'.encode('utf-8')
+        body = text.encode('utf-8') or b' '
+        size = max(len(text), 1) * self.bytes_per_char
+        return header + (body * (size // len(body) + 1))[:size]
+
+    def synthesize(self, text):
+        time.sleep(self.latency)
+        return self._audio(text)
+
+    def stream(self, text):
+        audio = self._audio(text)
+        chunks = range(0, len(audio), STREAM_CHUNK_SIZE)
+        for start in chunks:
+            time.sleep(self.latency / len(chunks))
+            yield audio[start:start + STREAM_CHUNK_SIZE]
+
+    def close(self):
+        pass
+
+
+class _PooledSynthesizer:
+    def __init__(self, synthesizer):
+        self.synthesizer = synthesizer
+        self.created_at = time.monotonic()
+        self.uses = 0
+        self.failed = False
+
+
+class SynthesizerPool:
+    """Bounded pool of synthesizers per (voice, format), safe to share between threads"""
+
+    def __init__(self, factory, max_per_voice=4, max_uses=500, max_age=600, checkout_timeout=10):
+        self.factory = factory
+        self.max_per_voice = max_per_voice
+        self.max_uses = max_uses
+        self.max_age = max_age
+        self.checkout_timeout = checkout_timeout
+        self._idle = {}
+        self._size = {}
+        self._lock = threading.Condition()
+        self.stats = {'created': 0, 'reused': 0, 'recycled': 0, 'waits': 0}
+
+    def _expired(self, pooled):
+        return (
+            pooled.failed
+            or pooled.uses >= self.max_uses
+            or time.monotonic() - pooled.created_at > self.max_age
+            or not pooled.synthesizer.healthy()
+        )
+
+    def _acquire(self, key):
+        deadline = time.monotonic() + self.checkout_timeout
+        with self._lock:
+            while True:
+                idle = self._idle.setdefault(key, [])
+                while idle:
+                    pooled = idle.pop()
+                    if self._expired(pooled):
+                        self._discard(key, pooled)
+                        continue
+                    self.stats['reused'] += 1
+                    return pooled
+                if self._size.get(key, 0) < self.max_per_voice:
+                    # Reserve the slot, then build the synthesizer outside the lock
+                    self._size[key] = self._size.get(key, 0) + 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise SynthesisError('Timed out waiting for a speech synthesizer')
+                self.stats['waits'] += 1
+                self._lock.wait(remaining)
+
+        try:
+            pooled = _PooledSynthesizer(self.factory(*key))
+        except Exception:
+            with self._lock:
+                self._size[key] -= 1
+                self._lock.notify()
+            raise
+        with self._lock:
+            self.stats['created'] += 1
+        return pooled
+
+    def _discard(self, key, pooled):
+        # Called with the lock held
+        self._size[key] -= 1
+        self.stats['recycled'] += 1
+        pooled.synthesizer.close()
+
+    def _release(self, key, pooled):
+        with self._lock:
+            if self._expired(pooled):
+                self._discard(key, pooled)
+            else:
+                self._idle.setdefault(key, []).append(pooled)
+            self._lock.notify()
+
+    @contextmanager
+    def checkout(self, voice, audio_format):
+        """Borrow a synthesizer for one request"""
+        key = (voice, audio_format)
+        pooled = self._acquire(key)
+        try:
+            pooled.uses += 1
+            yield pooled.synthesizer
+        except BaseException:
+            # Includes a client disconnecting mid-stream, which leaves the
+            # synthesizer busy with the abandoned clip
+            pooled.failed = True
+            raise
+        finally:
+            self._release(key, pooled)
+
+    def warm_up(self, voices, audio_format):
+        """Create and connect one synthesizer per voice ahead of the first request"""
+        for voice in voices:
+            try:
+                with self.checkout(voice, audio_format) as synthesizer:
+                    synthesizer.warm_up()
+            except Exception as e:
+                log.warning("tts.warmup_failed", voice=voice, error=str(e))
+
+    def close(self):
+        with self._lock:
+            for key, idle in self._idle.items():
+                for pooled in idle:
+                    self._discard(key, pooled)
+                idle.clear()
+
+
+def create_speech_pool(key=None, region=None):
+    """Pool configured by TTS_BACKEND (azure|fake), TTS_POOL_SIZE and TTS_POOL_MAX_USES"""
+    backend = os.getenv('TTS_BACKEND', 'azure')
+    if backend == 'fake':
+        factory = FakeSynthesizer
+    elif backend == 'azure':
+        def factory(voice, audio_format):
+            return AzureSynthesizer(key, region, voice, audio_format)
+    else:
+        raise ValueError(f"Unknown TTS backend: {backend}")
+
+    return SynthesizerPool(
+        factory,
+        max_per_voice=int(os.getenv('TTS_POOL_SIZE', '4')),
+        max_uses=int(os.getenv('TTS_POOL_MAX_USES', '500')),
+    )
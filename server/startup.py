@@ -0,0 +1,142 @@
+"""Lazily built subsystems and worker readiness.
+
+Importing the OpenAI SDK takes most of a second, the Azure Speech SDK
+loads a native library, and the stores open databases or scan the disk.
+When all of that happens at import time, a new worker can't answer
+anything, not even a health check, until every subsystem is up, whether
+or not it will ever need it.
+
+A Lazy stands in for such an object. It builds the object on first
+attribute access, or when Startup.warm_up() runs, and forwards to it from
+then on. Startup tracks the registered subsystems for /ready: a worker is
+ready once the required ones are built. Optional ones, like the speech
+pool's connections, keep warming in the background.
+"""
+import threading
+import time
+
+from logs import get_logger
+from metrics import metrics
+
+log = get_logger("startup")
+
+_UNSET = object()
+# Close to process start: this module is imported before any subsystem
+IMPORTED_AT = time.monotonic()
+
+
+class Lazy:
+    """An object built on first use"""
+
+    def __init__(self, name, factory):
+        self.subsystem = name
+        self._factory = factory
+        self._value = _UNSET
+        self._lock = threading.Lock()
+        self.load_seconds = None
+        self.load_error = None
+
+    # Named so they don't shadow the wrapped object's own get(), name, ...
+    @property
+    def loaded(self):
+        return self._value is not _UNSET
+
+    def load(self):
+        value = self._value
+        if value is not _UNSET:
+            return value
+        with self._lock:
+            if self._value is _UNSET:
+                start = time.perf_counter()
+                try:
+                    self._value = self._factory()
+                except Exception as e:
+                    self.load_error = str(e)
+                    log.exception("subsystem.failed", subsystem=self.subsystem)
+                    raise
+                self.load_seconds = time.perf_counter() - start
+                self.load_error = None
+                metrics.observe("subsystem_load_seconds", self.load_seconds, subsystem=self.subsystem)
+                log.info("subsystem.loaded", subsystem=self.subsystem, seconds=round(self.load_seconds, 3))
+            return self._value
+
+    def __getattr__(self, attr):
+        # Only called for attributes the Lazy itself doesn't have
+        return getattr(self.load(), attr)
+
+
+class Startup:
+    """Warms registered subsystems and reports whether the worker can take traffic"""
+
+    def __init__(self):
+        self._subsystems = []
+        self._lock = threading.Lock()
+        self._warmed = False
+        self.ready = threading.Event()
+        self.seconds_to_ready = None
+
+    def register(self, lazy, required=True, warm=None):
+        """Add a subsystem; `warm(value)` runs after it is built during warm-up"""
+        self._subsystems.append((lazy, required, warm))
+        return lazy
+
+    def warm_up(self, wait_for_optional=True):
+        """Build required subsystems and mark the worker ready, then build the optional ones.
+
+        With wait_for_optional=False the optional ones load on a thread.
+        """
+        with self._lock:
+            if self._warmed:
+                return
+            self._warmed = True
+
+        failed = False
+        for lazy, required, warm in self._subsystems:
+            if required:
+                failed |= not self._load(lazy, warm)
+        if not failed:
+            self.mark_ready()
+        if wait_for_optional:
+            self._load_optional()
+        else:
+            threading.Thread(target=self._load_optional, daemon=True, name="warm-up").start()
+
+    def _load_optional(self):
+        for lazy, required, warm in self._subsystems:
+            if not required:
+                self._load(lazy, warm)
+
+    def mark_ready(self):
+        if not self.ready.is_set():
+            self.seconds_to_ready = time.monotonic() - IMPORTED_AT
+            self.ready.set()
+            log.info("startup.ready", seconds=round(self.seconds_to_ready, 3))
+
+    def _load(self, lazy, warm):
+        try:
+            value = lazy.load()
+            if warm:
+                warm(value)
+            return True
+        except Exception:
+            # Logged by Lazy, or here for the warm hook; the worker stays unready
+            if lazy.loaded:
+                log.exception("subsystem.warm_up_failed", subsystem=lazy.subsystem)
+            return False
+
+    def status(self):
+        return {
+            "ready": self.ready.is_set(),
+            "seconds_to_ready": self.seconds_to_ready,
+            "uptime": time.monotonic() - IMPORTED_AT,
+            "subsystems": {
+                lazy.subsystem: {
+                    "required": required, "loaded": lazy.loaded,
+                    "seconds": lazy.load_seconds, "error": lazy.load_error,
+                }
+                for lazy, required, _ in self._subsystems
+            },
+        }
+
+
+metrics.describe("subsystem_load_seconds", "Time to build a lazily loaded subsystem")
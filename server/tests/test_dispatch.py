@@ -0,0 +1,113 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+
+from bots.base_bot import BaseBot
+from bots.dispatch import Turn, TurnDispatcher
+from bots.intent_router import IntentRouter
+
+REPLY = ["¡Hola", "! ¿Qué", " tal?"]
+
+
+def chunk(text):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))], usage=None)
+
+
+class Stream:
+    def __init__(self):
+        self.chunks = iter([chunk(text) for text in REPLY])
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.chunks)
+
+    def close(self):
+        pass
+
+
+class AsyncStream(Stream):
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.chunks)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def close(self):
+        pass
+
+
+class FakeClient:
+    """Answers every chat call with REPLY, streamed or not"""
+
+    def __init__(self, asynchronous=False):
+        self.asynchronous = asynchronous
+        self.chat = SimpleNamespace(completions=self)
+
+    def create(self, stream=False, **kwargs):
+        if stream:
+            result = AsyncStream() if self.asynchronous else Stream()
+        else:
+            message = SimpleNamespace(content="".join(REPLY))
+            result = SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+        if self.asynchronous:
+            async def wrap():
+                return result
+            return wrap()
+        return result
+
+
+class UnsureRouter(IntentRouter):
+    """Leaves every turn to IntentBot, whose call fails"""
+
+    def classify(self, messages, user_background):
+        return "conversation", 0.5, 0.0, False
+
+    def detect(self, messages, client):
+        raise TimeoutError("intent call timed out")
+
+    async def detect_async(self, messages, client):
+        raise TimeoutError("intent call timed out")
+
+
+class DetectFailureTest(unittest.TestCase):
+    def bot(self, client):
+        return BaseBot([{"role": "user", "content": "hola"}], client, user_background={"target_lang": "es"})
+
+    def check(self, turn, reply, speculation=None):
+        self.assertEqual(reply, "".join(REPLY))
+        self.assertEqual(turn.routing["intent"], "conversation")
+        self.assertEqual(turn.routing["source"], "local_fallback")
+        self.assertEqual(turn.routing.get("speculation"), speculation)
+
+    def test_serial_answer(self):
+        dispatcher = TurnDispatcher(UnsureRouter(), speculative=False)
+        reply, turn = dispatcher.answer(self.bot(FakeClient()), FakeClient())
+        self.check(turn, reply)
+
+    def test_speculative_stream_is_kept(self):
+        dispatcher = TurnDispatcher(UnsureRouter(), speculative=True)
+        bot = self.bot(FakeClient())
+        turn = Turn(bot)
+        reply = "".join(dispatcher.stream(bot, FakeClient(), turn))
+        self.check(turn, reply, speculation="hit")
+
+    def test_speculative_async(self):
+        dispatcher = TurnDispatcher(UnsureRouter(), speculative=True)
+        client = FakeClient(asynchronous=True)
+        reply, turn = asyncio.run(dispatcher.answer_async(self.bot(client), client))
+        self.check(turn, reply, speculation="hit")
+
+    def test_serial_async(self):
+        dispatcher = TurnDispatcher(UnsureRouter(), speculative=False)
+        client = FakeClient(asynchronous=True)
+        reply, turn = asyncio.run(dispatcher.answer_async(self.bot(client), client))
+        self.check(turn, reply)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+from types import SimpleNamespace
+
+from bots.grammar_bot import GrammarBot
+
+
+class RecordingClient:
+    """Stands in for the OpenAI client and keeps the arguments of every call"""
+
+    def __init__(self, answer):
+        self.answer = answer
+        self.calls = []
+        self.chat = SimpleNamespace(completions=self)
+
+    def create(self, **kwargs):
+        self.calls.append(kwargs)
+        message = SimpleNamespace(content=self.answer)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+
+class GetFeedbackTest(unittest.TestCase):
+    background = {
+        'native_lang': 'en',
+        'target_lang': 'es',
+        'skill_level': 'beginner',
+        'personalization': {'name': 'Vera', 'hobbies': 'chess', 'completed': True},
+    }
+
+    def feedback(self, answer):
+        client = RecordingClient(answer)
+        messages = [
+            {"role": "user", "content": "Hola"},
+            {"role": "assistant", "content": "¡Hola! ¿Qué tal?"},
+            {"role": "user", "content": "Yo tengo dos perro."},
+        ]
+        bot = GrammarBot(messages, client, user_background=self.background, user_id='v@x', model='gpt-4o-mini')
+        return bot.get_feedback(), client.calls
+
+    def test_sends_only_the_instructions_and_the_last_message(self):
+        _, calls = self.feedback("OK")
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(calls[0]["operation"], "feedback")
+        self.assertEqual(calls[0]["model"], "gpt-4o-mini")
+        self.assertEqual(calls[0]["messages"], [
+            {"role": "system", "content": (
+                "You check a language learner's message in Spanish for mistakes.\n"
+                "If it has none, answer exactly: OK\n"
+                "Otherwise answer with the corrected message on the first line, then one or two short "
+                "sentences in English explaining the main mistakes. Don't continue the conversation."
+            )},
+            {"role": "user", "content": "Yo tengo dos perro."},
+        ])
+
+    def test_ok_answer(self):
+        result, _ = self.feedback("OK.")
+        self.assertEqual(result, {"ok": True})
+
+    def test_correction(self):
+        result, _ = self.feedback("Yo tengo dos perros.\n'Perro' needs the plural after 'dos'.")
+        self.assertEqual(result, {
+            "ok": False,
+            "corrected": "Yo tengo dos perros.",
+            "explanation": "'Perro' needs the plural after 'dos'.",
+        })
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import vocab
+from vocab import COMMON_RANK, FrequencyList, VocabularyTracker, frequency_list
+
+# What a beginner writes in the first weeks: food, family, colours, the week
+BEGINNER_SPANISH = [
+    "Hola, me llamo Ana. Soy de Madrid.",
+    "Me gustan las manzanas, las naranjas y los plátanos.",
+    "Yo como huevos, pan y mantequilla en el desayuno.",
+    "Mi color favorito es el azul. También me gusta el morado.",
+    "Tengo un perro y un gato. El perro es grande y el gato es pequeño.",
+    "Mi esposo trabaja en una oficina. Mi hermana es enfermera.",
+    "El lunes voy a la escuela. El sábado voy al parque con mi familia.",
+    "Hoy hace frío. En invierno llevo un abrigo, una bufanda y guantes.",
+    "Quiero comprar leche, queso, tomates y cebollas en el supermercado.",
+    "Mi casa tiene una cocina grande, un sofá y una lámpara.",
+    "Me gusta beber café con azúcar. No me gusta el té.",
+    "Tengo dos hermanos y una hermana. Mi abuela se llama Carmen.",
+    "¿Dónde está el baño? Está a la derecha de la escalera.",
+    "Los domingos comemos pollo con arroz, zanahorias y lechuga.",
+    "Mañana voy a la playa con mis primos. Llevo gafas de sol y una toalla.",
+    "Mi camisa es blanca, mi falda es roja y mis zapatos son negros.",
+    "En la nevera hay fresas, uvas, sandía y yogur.",
+    "Mi tío tiene una vaca, un caballo, tres cerdos y muchas gallinas.",
+    "Me duele la rodilla y el estómago. Necesito una farmacia.",
+    "En mi mochila tengo un lápiz, un cuaderno, una goma y tijeras.",
+]
+
+class BeginnerTranscriptTest(unittest.TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.tracker = VocabularyTracker(self.path)
+
+    def tearDown(self):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def test_beginner_stays_beginner_with_the_bundled_list(self):
+        for _ in range(3):
+            for message in BEGINNER_SPANISH:
+                self.tracker.observe('ana', 'es', message, 'en')
+        profile = self.tracker.profile('ana', 'es')
+        self.assertGreaterEqual(profile['tokens'], vocab.MIN_TOKENS)
+        self.assertEqual(self.tracker.skill_level('ana', 'es'), 'beginner')
+
+    def test_bundled_list_does_not_count_unlisted_words_as_rare(self):
+        frequencies = frequency_list('es')
+        self.assertFalse(frequencies.complete)
+        self.assertIsNone(frequencies.band('naranjas'))
+        self.assertEqual(frequencies.band('de'), 'core')
+        # The end of a short list is beginner vocabulary, not rare words
+        self.assertEqual(frequencies.band('domingo'), 'common')
+
+
+def word(rank):
+    """A made-up word for a rank; tokens are letters only"""
+    letters = ''
+    while rank:
+        rank, digit = divmod(rank, 26)
+        letters += 'abcdefghijklmnopqrstuvwxyz'[digit]
+    return 'w' + letters
+
+
+class CompleteListTest(unittest.TestCase):
+    def setUp(self):
+        self.frequencies = FrequencyList('xx', [word(rank) for rank in range(1, COMMON_RANK + 201)])
+
+    def test_bands_follow_the_configured_ranks(self):
+        self.assertTrue(self.frequencies.complete)
+        self.assertEqual(self.frequencies.band(word(1)), 'core')
+        self.assertEqual(self.frequencies.band(word(COMMON_RANK)), 'common')
+        self.assertEqual(self.frequencies.band(word(COMMON_RANK + 1)), 'rare')
+        self.assertEqual(self.frequencies.band('unlisted'), 'rare')
+
+    def test_level_rises_with_rare_words(self):
+        handle, path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        try:
+            tracker = VocabularyTracker(path)
+            rare_words = ' '.join(word(rank) for rank in range(COMMON_RANK + 1, COMMON_RANK + 201))
+            with mock.patch.object(vocab, 'frequency_list', return_value=self.frequencies):
+                tracker.observe('lea', 'xx', rare_words)
+            self.assertEqual(tracker.skill_level('lea', 'xx'), 'advanced')
+        finally:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+    def test_no_estimate_without_a_complete_list(self):
+        profile = {'tokens': 500, 'lemmas': 200, 'core': 100, 'common': 100, 'rare': 300}
+        self.assertEqual(vocab.estimate_level(profile), 'advanced')
+        self.assertIsNone(vocab.estimate_level(profile, complete=False))
+
+
+if __name__ == '__main__':
+    unittest.main()
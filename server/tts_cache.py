@@ -0,0 +1,133 @@
+"""Cache for synthesized speech.
+
+Learners often replay the same bot message, and each Azure synthesis costs
+hundreds of milliseconds. Audio is cached by a hash of (text, voice, format)
+in two tiers: a small in-memory LRU in each worker, and a size-bounded
+directory on disk shared by all workers on the host. Least recently used
+files are evicted when the directory grows past its limit.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class TTSCache:
+    def __init__(self, directory, memory_bytes=32 * 1024 * 1024, disk_bytes=512 * 1024 * 1024):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._memory = OrderedDict()
+        self._memory_used = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._disk_used = self._scan_disk_usage()
+
+    @staticmethod
+    def key(text, voice, audio_format):
+        """Content address for a clip"""
+        digest = hashlib.sha256()
+        for part in (voice, audio_format, text):
+            digest.update(part.encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.audio')
+
+    def get(self, key):
+        """Return cached audio bytes, or None on a miss"""
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                return data
+
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # Mark as recently used for disk eviction
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+
+        self._remember(key, data)
+        return data
+
+    def put(self, key, data):
+        """Store audio in both tiers"""
+        self._remember(key, data)
+
+        path = self._path(key)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write under a temp name and rename, so other workers never read a partial clip
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+        with self._lock:
+            self._disk_used += len(data)
+            over_limit = self._disk_used > self.disk_bytes
+        if over_limit:
+            self._evict_disk()
+
+    def _remember(self, key, data):
+        if len(data) > self.memory_bytes:
+            return
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return
+            self._memory[key] = data
+            self._memory_used += len(data)
+            while self._memory_used > self.memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_used -= len(evicted)
+
+    def _scan_disk(self):
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith('.audio'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _scan_disk_usage(self):
+        return sum(size for _, size, _ in self._scan_disk())
+
+    def _evict_disk(self):
+        """Delete least recently used files until the directory is at 90% of its limit"""
+        # Rescan rather than trusting our own count, since other workers write here too
+        entries = sorted(self._scan_disk())
+        used = sum(size for _, size, _ in entries)
+        target = self.disk_bytes * 0.9
+        for _, size, path in entries:
+            if used <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            used -= size
+        with self._lock:
+            self._disk_used = used
+
+
+def open_tts_cache():
+    """Open the cache configured by TTS_CACHE_DIR, TTS_CACHE_MEMORY_MB and TTS_CACHE_DISK_MB"""
+    return TTSCache(
+        os.getenv('TTS_CACHE_DIR', 'tts_cache'),
+        memory_bytes=int(os.getenv('TTS_CACHE_MEMORY_MB', '32')) * 1024 * 1024,
+        disk_bytes=int(os.getenv('TTS_CACHE_DISK_MB', '512')) * 1024 * 1024,
+    )
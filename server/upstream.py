@@ -0,0 +1,355 @@
+"""OpenAI client with tuned connection pooling, retries and hedging.
+
+The SDK's defaults suit scripts rather than a server: a 600 second read
+timeout, a small keep-alive pool and retries that ignore how long the
+call has already taken. UpstreamClient (and AsyncUpstreamClient for the
+async server) wrap an OpenAI client built on an explicitly sized httpx
+pool and add:
+
+- connect/read/write/pool timeouts, overridable per call with timeout=
+- retries of connection errors, timeouts, 408/409/429 and 5xx answers,
+  with full-jitter exponential backoff (honouring Retry-After)
+- optional hedging (UPSTREAM_HEDGE=1): when an attempt hasn't answered
+  within the recent p95 for that kind of call, a second one is sent and
+  whichever answers first is used. For streams, "answered" means the
+  first chunk arrived; the losing stream is closed.
+
+Both expose client.chat.completions.create(...) like the SDK, so bots and
+the context window use them unchanged. create() also accepts operation=,
+a label that keys the latency window and metrics (classifier calls are
+much faster than replies, so they get their own p95).
+
+The SDK itself is imported when the first client is built: it takes most
+of a second, which workers that never call OpenAI shouldn't pay.
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeout
+
+import httpx
+
+from logs import get_logger
+from metrics import metrics
+
+log = get_logger("upstream")
+
+MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100"))
+MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "20"))
+KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+
+# Seconds. The read timeout applies between bytes, so it also bounds a stalled stream.
+CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "3"))
+READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "30"))
+WRITE_TIMEOUT = float(os.getenv("UPSTREAM_WRITE_TIMEOUT", "10"))
+POOL_TIMEOUT = float(os.getenv("UPSTREAM_POOL_TIMEOUT", "5"))
+
+RETRIES = int(os.getenv("UPSTREAM_RETRIES", "2"))
+BACKOFF_BASE = float(os.getenv("UPSTREAM_BACKOFF_BASE", "0.25"))
+BACKOFF_MAX = float(os.getenv("UPSTREAM_BACKOFF_MAX", "4"))
+
+HEDGE = os.getenv("UPSTREAM_HEDGE", "0") == "1"
+# Fixed hedge delay in ms; unset means the rolling p95 of that operation
+HEDGE_AFTER_MS = os.getenv("UPSTREAM_HEDGE_AFTER_MS")
+HEDGE_MIN_DELAY = float(os.getenv("UPSTREAM_HEDGE_MIN_DELAY", "0.05"))
+# Calls observed before the p95 is trusted
+HEDGE_MIN_SAMPLES = int(os.getenv("UPSTREAM_HEDGE_MIN_SAMPLES", "20"))
+HEDGE_THREADS = int(os.getenv("UPSTREAM_HEDGE_THREADS", "64"))
+
+LATENCY_WINDOW = 500
+
+
+def timeout(connect=CONNECT_TIMEOUT, read=READ_TIMEOUT):
+    """An httpx timeout for one call, e.g. a shorter read for quick classifier calls"""
+    return httpx.Timeout(connect=connect, read=read, write=WRITE_TIMEOUT, pool=POOL_TIMEOUT)
+
+
+def _limits():
+    return httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_KEEPALIVE,
+                        keepalive_expiry=KEEPALIVE_EXPIRY)
+
+
+def retryable(error):
+    from openai import APIConnectionError, APIStatusError
+
+    if isinstance(error, APIConnectionError):  # includes APITimeoutError
+        return True
+    if isinstance(error, APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return False
+
+
+def backoff(attempt, error=None):
+    """Seconds to wait before retry number attempt (0-based)"""
+    response = getattr(error, "response", None)
+    if response is not None:
+        try:
+            return min(float(response.headers.get("retry-after")), BACKOFF_MAX)
+        except (TypeError, ValueError):
+            pass
+    # Full jitter, so retries from many workers don't arrive together
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+class LatencyWindow:
+    """Recent latencies per (operation, streamed), for the hedge threshold"""
+
+    def __init__(self, size=LATENCY_WINDOW):
+        self.size = size
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def observe(self, key, seconds):
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = deque(maxlen=self.size)
+            samples.append(seconds)
+
+    def percentile(self, key, pct):
+        with self._lock:
+            samples = sorted(self._samples.get(key, ()))
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(pct / 100 * len(samples)))]
+
+
+class PeekedStream:
+    """A completion stream whose first chunk has already been read"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._iterator = iter(stream)
+        self._first = [next(self._iterator, None)]
+
+    def __iter__(self):
+        for chunk in self._first:
+            if chunk is not None:
+                yield chunk
+        self._first = []
+        yield from self._iterator
+
+    def close(self):
+        self.stream.close()
+
+
+class AsyncPeekedStream:
+    """PeekedStream for an async completion stream"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._iterator = stream.__aiter__()
+        self._first = []
+
+    async def peek(self):
+        try:
+            self._first = [await self._iterator.__anext__()]
+        except StopAsyncIteration:
+            pass
+        return self
+
+    async def __aiter__(self):
+        for chunk in self._first:
+            yield chunk
+        self._first = []
+        async for chunk in self._iterator:
+            yield chunk
+
+    async def close(self):
+        await self.stream.close()
+
+
+class _Completions:
+    def __init__(self, upstream):
+        self.create = upstream.create
+
+
+class _Chat:
+    def __init__(self, upstream):
+        self.completions = _Completions(upstream)
+
+
+class _Upstream:
+    """Shared retry and hedge bookkeeping"""
+
+    def __init__(self, client, retries=RETRIES, hedge=HEDGE, hedge_after_ms=HEDGE_AFTER_MS):
+        self.client = client
+        self.retries = retries
+        self.hedge = hedge
+        self.hedge_after = float(hedge_after_ms) / 1000 if hedge_after_ms else None
+        self.latency = LatencyWindow()
+        self.chat = _Chat(self)
+
+    def hedge_delay(self, key):
+        """Seconds to wait before hedging, or None to not hedge this call"""
+        if not self.hedge:
+            return None
+        if self.hedge_after is not None:
+            return self.hedge_after
+        p95 = self.latency.percentile(key, 95)
+        return None if p95 is None else max(p95, HEDGE_MIN_DELAY)
+
+    def _retrying(self, error, operation, attempt):
+        if attempt >= self.retries or not retryable(error):
+            return None
+        delay = backoff(attempt, error)
+        metrics.inc("upstream_retries_total", operation=operation, error=type(error).__name__)
+        log.warning("upstream.retry", operation=operation, attempt=attempt + 1,
+                    error=str(error), delay=round(delay, 3))
+        return delay
+
+
+class UpstreamClient(_Upstream):
+    """Retrying, optionally hedging wrapper around an OpenAI client"""
+
+    def __init__(self, client, **options):
+        super().__init__(client, **options)
+        self._pool = ThreadPoolExecutor(max_workers=HEDGE_THREADS, thread_name_prefix="upstream-hedge")
+
+    def close(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self.client.close()
+
+    def create(self, operation="chat", **kwargs):
+        key = (operation, bool(kwargs.get("stream")))
+        delay = self.hedge_delay(key)
+        if delay is None:
+            return self._call(key, kwargs)
+
+        primary = self._pool.submit(self._call, key, kwargs)
+        try:
+            return primary.result(timeout=delay)
+        except FutureTimeout:
+            pass
+
+        metrics.inc("upstream_hedges_total", operation=operation)
+        backup = self._pool.submit(self._call, key, kwargs)
+        attempts = {primary: "primary", backup: "backup"}
+        pending = set(attempts)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            winner = next((future for future in done if future.exception() is None), None)
+            if winner is None and pending:
+                continue
+            if winner is None:
+                # Both failed; report the first attempt's error
+                return primary.result()
+            metrics.inc("upstream_hedge_wins_total", operation=operation, attempt=attempts[winner])
+            for loser in attempts:
+                if loser is not winner:
+                    loser.add_done_callback(_discard)
+            return winner.result()
+
+    def _call(self, key, kwargs):
+        operation = key[0]
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                response = self.client.chat.completions.create(**kwargs)
+                if kwargs.get("stream"):
+                    # Errors before the first chunk can still be retried
+                    response = PeekedStream(response)
+            except Exception as e:
+                delay = self._retrying(e, operation, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self.latency.observe(key, time.perf_counter() - start)
+            return response
+
+
+def _discard(future):
+    """Close a hedged stream that lost the race"""
+    if future.exception() is None and hasattr(future.result(), "close"):
+        future.result().close()
+
+
+class AsyncUpstreamClient(_Upstream):
+    """UpstreamClient for an AsyncOpenAI client"""
+
+    async def close(self):
+        await self.client.close()
+
+    async def create(self, operation="chat", **kwargs):
+        key = (operation, bool(kwargs.get("stream")))
+        delay = self.hedge_delay(key)
+        if delay is None:
+            return await self._call(key, kwargs)
+
+        primary = asyncio.ensure_future(self._call(key, kwargs))
+        attempts = {primary: "primary"}
+        winner = None
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if done:
+                winner = primary
+                return primary.result()
+
+            metrics.inc("upstream_hedges_total", operation=operation)
+            backup = asyncio.ensure_future(self._call(key, kwargs))
+            attempts[backup] = "backup"
+            pending = set(attempts)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((task for task in done if task.exception() is None), None)
+                if winner is None and pending:
+                    continue
+                if winner is None:
+                    # Both failed; report the first attempt's error
+                    return primary.result()
+                metrics.inc("upstream_hedge_wins_total", operation=operation, attempt=attempts[winner])
+                return winner.result()
+        finally:
+            # Cancel the loser (or both, if our caller was cancelled) and close a losing stream
+            for task in attempts:
+                if not task.done():
+                    task.cancel()
+                elif task is not winner and not task.cancelled() and task.exception() is None:
+                    await task.result().close()
+
+    async def _call(self, key, kwargs):
+        operation = key[0]
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                response = await self.client.chat.completions.create(**kwargs)
+                if kwargs.get("stream"):
+                    response = await AsyncPeekedStream(response).peek()
+            except Exception as e:
+                delay = self._retrying(e, operation, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self.latency.observe(key, time.perf_counter() - start)
+            return response
+
+
+def create_client(api_key):
+    """UpstreamClient over a pooled OpenAI client. OPENAI_BASE_URL is honoured by the SDK."""
+    from openai import OpenAI
+
+    http_client = httpx.Client(limits=_limits(), timeout=timeout())
+    # Retries are ours, so the SDK's are turned off
+    return UpstreamClient(OpenAI(api_key=api_key, http_client=http_client, max_retries=0))
+
+
+def create_async_client(api_key):
+    from openai import AsyncOpenAI
+
+    http_client = httpx.AsyncClient(limits=_limits(), timeout=timeout())
+    return AsyncUpstreamClient(AsyncOpenAI(api_key=api_key, http_client=http_client, max_retries=0))
+
+
+metrics.describe("upstream_retries_total", "OpenAI calls retried, by error")
+metrics.describe("upstream_hedges_total", "OpenAI calls that sent a hedged second attempt")
+metrics.describe("upstream_hedge_wins_total", "Which attempt answered first after hedging")
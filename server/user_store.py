@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""User account storage.
+
+The app used to parse and rewrite the whole users.json file on every request.
+Accounts now live behind a small UserStore interface with a SQLite backend
+(one row per user, WAL mode so several workers can read while one writes) and
+an in-process read cache in front of it. The JSON backend is kept for
+existing setups, and users.json files can be imported/exported from the
+command line:
+
+    python user_store.py import users.json
+    python user_store.py export users.json
+"""
+import argparse
+import copy
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from logs import get_logger
+from shared_state import shared_state
+
+log = get_logger("user_store")
+
+
+class UserStore:
+    """Interface for user account storage, keyed by username/email"""
+
+    def get(self, user_id):
+        """Return the user record, or None if the user doesn't exist"""
+        raise NotImplementedError
+
+    def create(self, user_id, user):
+        """Add a new user. Returns False if the user already exists."""
+        raise NotImplementedError
+
+    def update(self, user_id, fields):
+        """Merge fields into a user record. Returns the updated record, or None if missing."""
+        raise NotImplementedError
+
+    def items(self):
+        """Return a list of (user_id, user) pairs for every user"""
+        raise NotImplementedError
+
+    def version(self):
+        """Token that changes whenever another writer modifies the store"""
+        return None
+
+    def import_json(self, path, overwrite=False):
+        """Copy users from a users.json file into this store. Returns the number imported."""
+        with open(path, 'r') as f:
+            users = json.load(f)
+
+        imported = 0
+        for user_id, user in users.items():
+            if self.create(user_id, user):
+                imported += 1
+            elif overwrite:
+                self.update(user_id, user)
+                imported += 1
+        return imported
+
+    def export_json(self, path):
+        """Write every user to a users.json file. Returns the number exported."""
+        users = dict(self.items())
+        with open(path, 'w') as f:
+            json.dump(users, f, indent=2)
+        return len(users)
+
+
+class JsonUserStore(UserStore):
+    """The original users.json file. Every call reads or rewrites the whole file.
+
+    Writes hold a shared_state lock as well as a thread lock, so workers
+    sharing state don't overwrite each other's changes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._lock_name = f'users.json:{os.path.abspath(path)}'
+
+    def _load(self):
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        return {}
+
+    def _save(self, users):
+        # Write to a temp file and swap it in so readers never see a partial file
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(users, f, indent=2)
+        os.replace(temp_path, self.path)
+
+    def get(self, user_id):
+        return self._load().get(user_id)
+
+    def create(self, user_id, user):
+        with self._lock, shared_state.lock(self._lock_name):
+            users = self._load()
+            if user_id in users:
+                return False
+            users[user_id] = user
+            self._save(users)
+            return True
+
+    def update(self, user_id, fields):
+        with self._lock, shared_state.lock(self._lock_name):
+            users = self._load()
+            if user_id not in users:
+                return None
+            users[user_id].update(fields)
+            self._save(users)
+            return users[user_id]
+
+    def items(self):
+        return list(self._load().items())
+
+    def version(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+
+class SqliteUserStore(UserStore):
+    """One row per user in a SQLite database, safe across threads and processes"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        # A connection that never writes, so PRAGMA data_version on it changes
+        # whenever any other connection (thread or process) commits.
+        self._watch = self._connect()
+        self._watch_lock = threading.Lock()
+        with self._watch:
+            self._watch.execute(
+                'CREATE TABLE IF NOT EXISTS users ('
+                ' user_id TEXT PRIMARY KEY,'
+                ' data TEXT NOT NULL,'
+                ' updated_at REAL NOT NULL)'
+            )
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    @property
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def get(self, user_id):
+        row = self._conn.execute('SELECT data FROM users WHERE user_id = ?', (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def create(self, user_id, user):
+        cursor = self._conn.execute(
+            'INSERT INTO users (user_id, data, updated_at) VALUES (?, ?, ?) '
+            'ON CONFLICT(user_id) DO NOTHING',
+            (user_id, json.dumps(user), time.time())
+        )
+        return cursor.rowcount == 1
+
+    def update(self, user_id, fields):
+        conn = self._conn
+        # BEGIN IMMEDIATE takes the write lock up front so the read-modify-write
+        # can't interleave with another worker's update
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT data FROM users WHERE user_id = ?', (user_id,)).fetchone()
+            if row is None:
+                conn.execute('ROLLBACK')
+                return None
+            user = json.loads(row[0])
+            user.update(fields)
+            conn.execute(
+                'UPDATE users SET data = ?, updated_at = ? WHERE user_id = ?',
+                (json.dumps(user), time.time(), user_id)
+            )
+            conn.execute('COMMIT')
+            return user
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def items(self):
+        rows = self._conn.execute('SELECT user_id, data FROM users ORDER BY user_id')
+        return [(user_id, json.loads(data)) for user_id, data in rows]
+
+    def version(self):
+        with self._watch_lock:
+            return self._watch.execute('PRAGMA data_version').fetchone()[0]
+
+
+class CachedUserStore(UserStore):
+    """In-process read cache in front of another store.
+
+    Entries are dropped on local writes, and the whole cache is dropped when
+    the backing store reports that another worker has written to it.
+    """
+
+    def __init__(self, store, max_entries=10000):
+        self.store = store
+        self.max_entries = max_entries
+        self._cache = {}
+        self._version = store.version()
+        # Bumped on every invalidation so a read that raced with a write
+        # doesn't put the stale record back in the cache
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _check_version(self):
+        version = self.store.version()
+        if version != self._version:
+            self._cache.clear()
+            self._version = version
+            self._generation += 1
+
+    def get(self, user_id):
+        with self._lock:
+            self._check_version()
+            if user_id in self._cache:
+                return copy.deepcopy(self._cache[user_id])
+            generation = self._generation
+
+        user = self.store.get(user_id)
+        if user is not None:
+            with self._lock:
+                if generation == self._generation:
+                    if len(self._cache) >= self.max_entries:
+                        self._cache.clear()
+                    self._cache[user_id] = user
+        return copy.deepcopy(user)
+
+    def create(self, user_id, user):
+        created = self.store.create(user_id, user)
+        self.invalidate(user_id)
+        return created
+
+    def update(self, user_id, fields):
+        user = self.store.update(user_id, fields)
+        self.invalidate(user_id)
+        return user
+
+    def items(self):
+        return self.store.items()
+
+    def version(self):
+        return self.store.version()
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._cache.pop(user_id, None)
+            self._generation += 1
+
+
+def open_user_store(backend=None, db_path=None, json_path=None):
+    """Open the configured user store (USER_STORE=sqlite|json).
+
+    A fresh SQLite database is seeded from an existing users.json so
+    switching backends doesn't lose accounts.
+    """
+    backend = backend or os.getenv('USER_STORE', 'sqlite')
+    db_path = db_path or os.getenv('USER_DB', 'users.db')
+    json_path = json_path or os.getenv('USER_FILE', 'users.json')
+
+    if backend == 'json':
+        return CachedUserStore(JsonUserStore(json_path))
+    if backend != 'sqlite':
+        raise ValueError(f"Unknown user store backend: {backend}")
+
+    is_new = not os.path.exists(db_path)
+    store = SqliteUserStore(db_path)
+    if is_new and os.path.exists(json_path):
+        count = store.import_json(json_path)
+        log.info("user_store.imported", count=count, source=json_path, db=db_path)
+    return CachedUserStore(store)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import or export user accounts')
+    parser.add_argument('action', choices=['import', 'export'])
+    parser.add_argument('json_file', help='users.json file to read or write')
+    parser.add_argument('--db', default=os.getenv('USER_DB', 'users.db'), help='SQLite user database')
+    parser.add_argument('--overwrite', action='store_true', help='Replace users that already exist')
+    args = parser.parse_args()
+
+    store = SqliteUserStore(args.db)
+    if args.action == 'import':
+        count = store.import_json(args.json_file, overwrite=args.overwrite)
+        print(f"Imported {count} users into {args.db}")
+    else:
+        count = store.export_json(args.json_file)
+        print(f"Exported {count} users to {args.json_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+"""Per-learner vocabulary and a skill level estimated from it.
+
+Every user message is tokenized as it is appended to the conversation, and
+each word is reduced to the form it has in the target language's frequency
+list (plurals and common endings are stripped until a listed form is
+found). The tracker keeps, per user and language:
+
+- a count and first-seen time for every lemma used
+- running totals of tokens by frequency band: core (the VOCAB_CORE_RANK
+  most frequent words), common (up to VOCAB_COMMON_RANK) and rare (less
+  frequent or not listed)
+
+A turn only touches the rows for its own words, and the level is read off
+the running totals, so the cost is proportional to the new tokens and
+there's no model call. Learners who use more words beyond the common
+ones, across a large enough vocabulary, move up a level; see LEVEL_RULES.
+
+Frequency lists are text files with one word per line, most frequent
+first, in the frequency/ directory or VOCAB_FREQUENCY_DIR. A second
+column (a count, as in the usual "word count" lists) is ignored, so a
+larger list can be dropped in to replace the small bundled one.
+
+The bundled lists are shorter than VOCAB_COMMON_RANK: they are a learner's
+first few hundred words, not a frequency ranking. With such a list the
+core band is scaled to its length, the rest of the list is common, and
+unlisted words are not counted as rare, since plenty of beginner words
+(manzana, naranja) are missing from it. There is then no evidence for a
+higher level, so none is estimated and the learner keeps their level
+until a list of at least VOCAB_COMMON_RANK words is installed.
+"""
+import functools
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import Counter
+
+from logs import get_logger
+
+log = get_logger("vocab")
+
+FREQUENCY_DIR = os.getenv('VOCAB_FREQUENCY_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'frequency'))
+CORE_RANK = int(os.getenv('VOCAB_CORE_RANK', '150'))
+COMMON_RANK = int(os.getenv('VOCAB_COMMON_RANK', '1000'))
+# Target-language tokens seen before the level is estimated at all
+MIN_TOKENS = int(os.getenv('VOCAB_MIN_TOKENS', '60'))
+
+# Highest level first: (level, distinct lemmas at least, share of tokens in the rare band at least)
+LEVEL_RULES = (
+    ('advanced', 150, 0.45),
+    ('intermediate', 60, 0.15),
+)
+DEFAULT_LEVEL = 'beginner'
+
+# Han characters are words of their own; other scripts split on non-letters
+TOKEN = re.compile(r'[㐀-䶿一-鿿]|[^\W\d_㐀-䶿一-鿿]+')
+
+# Ending -> replacement, tried in order until the word is in the list
+SUFFIXES = {
+    'en': (('ies', 'y'), ('es', ''), ('s', ''), ('ed', ''), ('ed', 'e'), ('ing', ''), ('ing', 'e')),
+    'es': (('es', ''), ('s', ''), ('a', 'o'), ('as', 'o'), ('os', 'o')),
+    'fr': (('s', ''), ('x', ''), ('es', ''), ('e', ''), ('ée', 'é')),
+    'it': (('i', 'o'), ('i', 'e'), ('e', 'a'), ('a', 'o')),
+    'de': (('en', ''), ('n', ''), ('e', ''), ('er', ''), ('es', ''), ('s', '')),
+}
+
+
+def base_forms(word, lang):
+    """Forms an inflected word may come from, by the endings in SUFFIXES"""
+    for ending, replacement in SUFFIXES.get(lang, ()):
+        if word.endswith(ending) and len(word) > len(ending) + 1:
+            yield word[:-len(ending)] + replacement
+
+
+class FrequencyList:
+    """Word -> rank (1 is the most frequent) for one language"""
+
+    def __init__(self, lang, words):
+        self.lang = lang
+        self.ranks = {}
+        for rank, word in enumerate(words, 1):
+            self.ranks.setdefault(word, rank)
+        # Only a list reaching COMMON_RANK tells rare words from unlisted common ones
+        self.complete = len(words) >= COMMON_RANK
+        if self.complete:
+            self.core_rank, self.common_rank = CORE_RANK, COMMON_RANK
+        else:
+            self.core_rank, self.common_rank = round(len(words) * CORE_RANK / COMMON_RANK), len(words)
+
+    def lemma(self, word):
+        """The listed form of a word, or the word itself if none is found"""
+        if word in self.ranks:
+            return word
+        for candidate in base_forms(word, self.lang):
+            if candidate in self.ranks:
+                return candidate
+        return word
+
+    def band(self, lemma):
+        """core, common or rare; None for an unlisted word when the list is too short to tell"""
+        rank = self.ranks.get(lemma)
+        if rank is None:
+            return 'rare' if self.complete else None
+        if rank <= self.core_rank:
+            return 'core'
+        if rank <= self.common_rank:
+            return 'common'
+        return 'rare'
+
+
+@functools.lru_cache(maxsize=None)
+def frequency_list(lang):
+    """The frequency list for a language code; empty if there is none"""
+    words = []
+    try:
+        with open(os.path.join(FREQUENCY_DIR, f'{lang}.txt'), encoding='utf-8') as f:
+            for line in f:
+                fields = line.split()
+                if fields:
+                    words.append(unicodedata.normalize('NFC', fields[0].lower()))
+    except FileNotFoundError:
+        pass
+    frequencies = FrequencyList(lang, words)
+    if not frequencies.complete:
+        log.info("vocab.short_frequency_list", lang=lang, words=len(words), needed=COMMON_RANK)
+    return frequencies
+
+
+def lemmas(text, lang, native_lang=None):
+    """The target-language lemmas in a message, in order"""
+    target = frequency_list(lang)
+    native = frequency_list(native_lang) if native_lang and native_lang != lang else None
+    found = []
+    for match in TOKEN.finditer(unicodedata.normalize('NFC', text)):
+        token = match.group()
+        word = token.lower()
+        lemma = target.lemma(word)
+        if lemma not in target.ranks:
+            # Not a known word: skip likely names, native-language words and stray letters
+            if token[0].isupper() and lang != 'de' and match.start() > 0:
+                continue
+            if native is not None and native.lemma(word) in native.ranks:
+                continue
+            if len(word) < 3 and lang != 'zh':
+                continue
+        found.append(lemma)
+    return found
+
+
+def estimate_level(profile, complete=True):
+    """Skill level from a profile's totals, or None with too little evidence.
+
+    `complete` is whether the language's frequency list can tell rare words
+    apart (FrequencyList.complete); without that there is no estimate.
+    """
+    if profile['tokens'] < MIN_TOKENS or not complete:
+        return None
+    # Tokens that were put in a band
+    banded = profile['core'] + profile['common'] + profile['rare']
+    if not banded:
+        return None
+    rare = profile['rare'] / banded
+    for level, min_lemmas, min_share in LEVEL_RULES:
+        if profile['lemmas'] >= min_lemmas and rare >= min_share:
+            return level
+    return DEFAULT_LEVEL
+
+
+class VocabularyTracker:
+    """Lemma counts and band totals per user and language, in SQLite"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS vocab_lemmas ('
+            ' user_id TEXT NOT NULL,'
+            ' lang TEXT NOT NULL,'
+            ' lemma TEXT NOT NULL,'
+            ' count INTEGER NOT NULL,'
+            ' first_seen REAL NOT NULL,'
+            ' PRIMARY KEY (user_id, lang, lemma)) WITHOUT ROWID'
+        )
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS vocab_profiles ('
+            ' user_id TEXT NOT NULL,'
+            ' lang TEXT NOT NULL,'
+            ' tokens INTEGER NOT NULL,'
+            ' lemmas INTEGER NOT NULL,'
+            ' core INTEGER NOT NULL,'
+            ' common INTEGER NOT NULL,'
+            ' rare INTEGER NOT NULL,'
+            ' skill_level TEXT,'
+            ' updated_at REAL NOT NULL,'
+            ' PRIMARY KEY (user_id, lang))'
+        )
+
+    @property
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def observe(self, user_id, lang, text, native_lang=None):
+        """Add a message's words to the user's vocabulary; return the updated profile"""
+        counts = Counter(lemmas(text, lang, native_lang))
+        if not counts:
+            return self.profile(user_id, lang)
+        frequencies = frequency_list(lang)
+        now = time.time()
+        conn = self._conn
+        # Serializes writers across workers, so band totals match the lemma rows
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            placeholders = ','.join('?' * len(counts))
+            known = {row[0] for row in conn.execute(
+                f'SELECT lemma FROM vocab_lemmas WHERE user_id = ? AND lang = ? AND lemma IN ({placeholders})',
+                (user_id, lang, *counts)
+            )}
+            conn.executemany(
+                'INSERT INTO vocab_lemmas (user_id, lang, lemma, count, first_seen) VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT (user_id, lang, lemma) DO UPDATE SET count = count + excluded.count',
+                [(user_id, lang, lemma, count, now) for lemma, count in counts.items()]
+            )
+            profile = self._profile(conn, user_id, lang) or {
+                'tokens': 0, 'lemmas': 0, 'core': 0, 'common': 0, 'rare': 0, 'skill_level': None,
+            }
+            profile['tokens'] += sum(counts.values())
+            profile['lemmas'] += len(counts.keys() - known)
+            for lemma, count in counts.items():
+                band = frequencies.band(lemma)
+                if band is not None:
+                    profile[band] += count
+            profile['skill_level'] = estimate_level(profile, frequencies.complete) or profile['skill_level']
+            conn.execute(
+                'INSERT OR REPLACE INTO vocab_profiles '
+                '(user_id, lang, tokens, lemmas, core, common, rare, skill_level, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (user_id, lang, profile['tokens'], profile['lemmas'], profile['core'], profile['common'],
+                 profile['rare'], profile['skill_level'], now)
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return profile
+
+    def profile(self, user_id, lang):
+        """Totals and estimated level, or None for a learner with no words yet"""
+        return self._profile(self._conn, user_id, lang)
+
+    def skill_level(self, user_id, lang, default=DEFAULT_LEVEL):
+        profile = self.profile(user_id, lang) if user_id and lang else None
+        return (profile and profile['skill_level']) or default
+
+    @staticmethod
+    def _profile(conn, user_id, lang):
+        row = conn.execute(
+            'SELECT tokens, lemmas, core, common, rare, skill_level FROM vocab_profiles '
+            'WHERE user_id = ? AND lang = ?',
+            (user_id, lang)
+        ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('tokens', 'lemmas', 'core', 'common', 'rare', 'skill_level'), row))
+
+
+def open_vocab_tracker(path=None):
+    return VocabularyTracker(path or os.getenv('VOCAB_DB', 'vocab.db'))